@@ -0,0 +1,17 @@
+import argparse
+import yaml
+
+from src.Aggregator import Aggregator
+
+parser = argparse.ArgumentParser(description="Edge aggregator of one cluster")
+parser.add_argument('--cluster', type=int, required=True, help='Cluster whose updates this aggregator averages')
+
+args = parser.parse_args()
+
+with open('config.yaml') as file:
+    config = yaml.safe_load(file)
+
+
+if __name__ == "__main__":
+    aggregator = Aggregator(config, args.cluster)
+    aggregator.start()
@@ -1,8 +1,10 @@
 import argparse
+import yaml
 import numpy as np
 
 parser = argparse.ArgumentParser(description="Add topo")
 parser.add_argument('--topo', type=int, nargs='+', help="Topo", required=False, default=[0])
+parser.add_argument('--network', action='store_true', help="Use the emulated links of config.yaml as communication costs")
 args = parser.parse_args()
 topo = args.topo
 
@@ -39,6 +41,12 @@ a2_3 = 11.684686209372796
 # 5G
 # a1_2 = 50
 # a2_3 = 50
+if args.network:
+    # ns per byte of the emulated links, to compare the prediction with the round times of the server log
+    with open('config.yaml') as file:
+        links = yaml.safe_load(file)["network"]["links"]
+    a1_2 = 1e9 / links[0]["bandwidth"]
+    a2_3 = 1e9 / links[1]["bandwidth"] if len(links) > 1 else a1_2
 
 # layer1_exe = t_exe_1
 # layer1_comm_data = [x * a1_2 for x in size_data]
@@ -0,0 +1,59 @@
+import argparse
+import time
+import uuid
+import pickle
+import yaml
+import pika
+import torch
+
+from src.Transport import BatchingTransport, RabbitTransport
+
+parser = argparse.ArgumentParser(description="Activation messages through RabbitMQ, with and without frame batching")
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 16, 32, 64, 128], help='Training batch sizes')
+parser.add_argument('--frame-sizes', type=int, nargs='+', default=[1, 4, 16], help='Messages per frame, 1 is unbatched')
+parser.add_argument('--shape', type=int, nargs='+', default=[64, 8, 8], help='Activation shape of one sample')
+parser.add_argument('--messages', type=int, default=500, help='Micro-batches sent per run')
+
+args = parser.parse_args()
+
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file)
+
+
+def run(channel, batch_size, frame_size):
+    queue_name = f'benchmark_{uuid.uuid4()}'
+    channel.queue_declare(queue=queue_name, durable=False)
+    transport = BatchingTransport(RabbitTransport(channel), max_messages=frame_size, max_bytes=1 << 30, max_delay=1.0)
+    activation = torch.randn(batch_size, *args.shape).numpy()
+    labels = torch.randint(0, 10, (batch_size,))
+
+    start = time.time()
+    for _ in range(args.messages):
+        message = pickle.dumps({"data_id": uuid.uuid4(), "label_count": None, "data": activation, "label": labels,
+                                "trace": [uuid.uuid4()], "test": False})
+        transport.publish(queue_name, message)
+    transport.flush(force=True)
+    received = 0
+    while received < args.messages:
+        body = transport.get(queue_name)
+        if body:
+            pickle.loads(body)
+            received += 1
+    elapsed = time.time() - start
+
+    channel.queue_delete(queue=queue_name)
+    return args.messages / elapsed, transport.sent_bytes / elapsed, transport.sent_frames
+
+
+if __name__ == "__main__":
+    credentials = pika.PlainCredentials(config["rabbit"]["username"], config["rabbit"]["password"])
+    connection = pika.BlockingConnection(pika.ConnectionParameters(config["rabbit"]["address"], 5672,
+                                                                   config["rabbit"]["virtual-host"], credentials))
+    channel = connection.channel()
+
+    print(f"{'batch':>6} {'frame':>6} {'frames':>7} {'msg/s':>10} {'MB/s':>10}")
+    for batch_size in args.batch_sizes:
+        for frame_size in args.frame_sizes:
+            messages_per_second, bytes_per_second, frames = run(channel, batch_size, frame_size)
+            print(f"{batch_size:>6} {frame_size:>6} {frames:>7} {messages_per_second:>10.1f} {bytes_per_second / 1e6:>10.2f}")
+    connection.close()
@@ -0,0 +1,99 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+import torchvision
+import torchvision.transforms as transforms
+
+from src.model import build_stage
+from src.Optimizer import OptimizerManager, RESET, KEEP
+
+parser = argparse.ArgumentParser(description="Time to accuracy and optimizer step time, fresh SGD per round against the optimizer manager")
+parser.add_argument('--model', type=str, default='VGG16', help='Model name')
+parser.add_argument('--data', type=str, default='CIFAR10', help='CIFAR10 or MNIST')
+parser.add_argument('--rounds', type=int, default=20, help='Maximum number of rounds')
+parser.add_argument('--samples', type=int, default=2000, help='Training samples per round')
+parser.add_argument('--test-samples', type=int, default=1000, help='Test samples of the accuracy')
+parser.add_argument('--target', type=float, default=0.4, help='Target accuracy')
+parser.add_argument('--lr', type=float, default=0.01, help='Learning rate')
+parser.add_argument('--momentum', type=float, default=0.5, help='Momentum')
+parser.add_argument('--batch-size', type=int, default=32, help='Batch size')
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+
+args = parser.parse_args()
+
+# name -> (policy, foreach, fused), the first one is a new per-parameter SGD every round as before
+VARIANTS = {
+    "fresh": (RESET, False, False),
+    "reset-foreach": (RESET, True, False),
+    "keep-foreach": (KEEP, True, False),
+}
+if str(args.device).startswith("cuda"):
+    VARIANTS["keep-fused"] = (KEEP, True, True)
+
+
+def datasets():
+    if args.data == "MNIST":
+        transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5,), (0.5,))])
+        train_set = torchvision.datasets.MNIST(root='./data', train=True, download=True, transform=transform)
+        test_set = torchvision.datasets.MNIST(root='./data', train=False, download=True, transform=transform)
+    else:
+        transform = transforms.Compose([transforms.ToTensor(),
+                                        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))])
+        train_set = torchvision.datasets.CIFAR10(root='./data', train=True, download=True, transform=transform)
+        test_set = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=transform)
+    return train_set, torch.utils.data.Subset(test_set, range(args.test_samples))
+
+
+def accuracy(model, test_loader):
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for data, labels in test_loader:
+            correct += (model(data.to(args.device)).argmax(dim=1).cpu() == labels).sum().item()
+    return correct / len(test_loader.dataset)
+
+
+def run(policy, foreach, fused, train_set, test_loader):
+    torch.manual_seed(1)
+    model = build_stage(args.model, args.data, 0, 0).to(args.device)
+    manager = OptimizerManager(policy, foreach, fused)
+    criterion = nn.CrossEntropyLoss()
+    generator = torch.Generator().manual_seed(1)
+    step_time = []
+    reached = None
+    start = time.time()
+    for round_id in range(1, args.rounds + 1):
+        if policy == RESET and not foreach:
+            manager = OptimizerManager(policy, foreach, fused)
+        optimizer = manager.get(model, args.lr, args.momentum, args.device)
+        indices = torch.randperm(len(train_set), generator=generator)[:args.samples].tolist()
+        train_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_set, indices), batch_size=args.batch_size,
+                                                   shuffle=True)
+        model.train()
+        for data, labels in train_loader:
+            optimizer.zero_grad()
+            loss = criterion(model(data.to(args.device)), labels.to(args.device))
+            loss.backward()
+            if str(args.device).startswith("cuda"):
+                torch.cuda.synchronize()
+            step_start = time.time()
+            optimizer.step()
+            if str(args.device).startswith("cuda"):
+                torch.cuda.synchronize()
+            step_time.append(time.time() - step_start)
+        if accuracy(model, test_loader) >= args.target:
+            reached = (round_id, time.time() - start)
+            break
+    return reached, sum(step_time) / len(step_time)
+
+
+if __name__ == "__main__":
+    train_set, test_set = datasets()
+    test_loader = torch.utils.data.DataLoader(test_set, batch_size=256)
+    print(f"{'variant':>14} {'rounds':>7} {'time (s)':>9} {'step (ms)':>10}")
+    for name, (policy, foreach, fused) in VARIANTS.items():
+        reached, step_time = run(policy, foreach, fused, train_set, test_loader)
+        rounds, seconds = reached if reached else (f">{args.rounds}", float('nan'))
+        print(f"{name:>14} {rounds:>7} {seconds:>9.1f} {step_time * 1000:>10.3f}")
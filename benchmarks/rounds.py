@@ -0,0 +1,223 @@
+import argparse
+import copy
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import yaml
+
+import torch
+import torchvision
+import torchvision.transforms as transforms
+
+import src.model
+from src.RpcClient import RpcClient
+from src.Scheduler import Scheduler
+from src.Server import Server
+from src.Simulation import MemoryBroker
+
+# Training modes: gradients sent back across the cut, the same with weight stashing, or a local loss on an
+# auxiliary head per stage
+MODES = ["backprop", "weight-stashing", "local-loss"]
+
+# Cut layers of every model, spread over its early, middle and late layers
+CUTS = {
+    "VGG16": [7, 14, 28],
+    "MobileNetv1": [10, 40, 70],
+    "ViT": [5, 7, 9],
+}
+
+parser = argparse.ArgumentParser(description="Split learning rounds of every model and cut layer, run in process over the in-memory broker")
+parser.add_argument('--models', type=str, nargs='+', default=None, help='Models as {model}_{data}, all of src.model by default')
+parser.add_argument('--cuts', type=int, nargs='+', default=None, help='Cut layers, the ones of CUTS by default')
+parser.add_argument('--rounds', type=int, default=2, help='Global rounds per run')
+parser.add_argument('--samples', type=int, default=500, help='Training samples of the first-layer client per round')
+parser.add_argument('--batch-size', type=int, default=32, help='Training batch size')
+parser.add_argument('--device', type=str, default='cpu', help='Device of all clients')
+parser.add_argument('--modes', type=str, nargs='+', default=MODES[:1], choices=MODES, help='Training modes to compare')
+parser.add_argument('--test-samples', type=int, default=0, help='Test samples of the accuracy after each round, 0 skips it')
+parser.add_argument('--output', type=str, default='benchmark_rounds.json', help='JSON file of the results')
+parser.add_argument('--case', type=str, nargs=4, default=None, help=argparse.SUPPRESS)  # model data cut mode, run in a child process
+
+args = parser.parse_args()
+
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file)
+
+
+def models():
+    """(model, data) of every class of `src.model`."""
+    for name in dir(src.model):
+        model_name, _, data_name = name.rpartition('_')
+        if model_name in CUTS and data_name in ('CIFAR10', 'MNIST'):
+            yield model_name, data_name
+
+
+def case_config(model_name, data_name, cut, mode):
+    """Two clients, one per layer, that average their parameters on the server every round."""
+    case = copy.deepcopy(config)
+    case["server"]["model"] = model_name
+    case["server"]["data-name"] = data_name
+    case["server"]["clients"] = [1, 1]
+    case["server"]["no-cluster"]["cut-layers"] = [cut]
+    case["server"]["client-cluster"]["enable"] = False
+    case["server"]["global-round"] = args.rounds
+    case["server"]["parameters"]["load"] = False
+    case["server"]["parameters"]["save"] = True
+    case["server"]["validation"] = False
+    case["server"]["aggregation"]["mode"] = "sync"
+    case["server"]["membership"]["heartbeat-timeout"] = 0
+    case["server"]["data-distribution"]["non-iid"] = False
+    case["server"]["data-distribution"]["num-sample"] = args.samples
+    case["learning"]["batch-size"] = args.batch_size
+    case["learning"]["local-loss"] = mode == "local-loss"
+    case["learning"]["pipeline"]["weight-stashing"] = mode == "weight-stashing"
+    case["network"]["enable"] = False
+    case["log_path"] = tempfile.gettempdir()
+    return case
+
+
+def cut_link(queue, size):
+    # Counted by the broker in `link_stats`, without any delay
+    if queue.startswith("intermediate_queue_1"):
+        return "1->2", 0, 0
+    if queue.startswith("gradient_queue_1"):
+        return "2->1", 0, 0
+    return None
+
+
+def accuracy(model_name, data_name, state_dict):
+    if data_name == "MNIST":
+        transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5,), (0.5,))])
+        test_set = torchvision.datasets.MNIST(root='./data', train=False, download=True, transform=transform)
+    else:
+        transform = transforms.Compose([transforms.ToTensor(),
+                                        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))])
+        test_set = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=transform)
+    test_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(test_set, range(args.test_samples)), batch_size=256)
+    model = src.model.build_stage(model_name, data_name, 0, 0)
+    model.load_state_dict(state_dict)
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for data, labels in test_loader:
+            correct += (model(data).argmax(dim=1) == labels).sum().item()
+    return correct / len(test_loader.dataset)
+
+
+class BenchmarkServer(Server):
+    def __init__(self, *server_args, **kwargs):
+        super().__init__(*server_args, **kwargs)
+        self.round_times = []
+        self.aggregation_times = []
+        self.accuracies = []
+
+    def report_round(self):
+        self.round_times.append(time.time() - self.round_start_time)
+        super().report_round()
+
+    def aggregate_global(self):
+        start = time.time()
+        result = super().aggregate_global()
+        self.aggregation_times.append(time.time() - start)
+        if args.test_samples and result:
+            self.accuracies.append(accuracy(self.model_name, self.data_name, self.concatenate_state_dict()))
+        return result
+
+
+def run_case(model_name, data_name, cut, mode):
+    case = case_config(model_name, data_name, cut, mode)
+    broker = MemoryBroker(cut_link)
+    server = BenchmarkServer(case, connection_factory=broker.connect)
+    server_thread = threading.Thread(target=server.start, daemon=True)
+    server_thread.start()
+
+    cold_start = {}
+    samples = []
+    train_time = []
+
+    def run_client(layer_id):
+        client_id = uuid.uuid4()
+        scheduler = Scheduler(client_id, layer_id, broker.connect().channel(), args.device)
+
+        def train(*train_args, **kwargs):
+            # Registration to the first training call: dataset, model stage and parameters
+            cold_start.setdefault(layer_id, time.time() - registered)
+            start = time.time()
+            result = scheduler.train_on_device(*train_args, **kwargs)
+            if layer_id == 1:
+                samples.append(len(train_args[9].dataset))
+                train_time.append(time.time() - start)
+            return result
+
+        client = RpcClient(client_id, layer_id, None, None, None, train, args.device, connection_factory=broker.connect)
+        registered = time.time()
+        client.send_to_server({"action": "REGISTER", "client_id": client_id, "layer_id": layer_id, "performance": -1,
+                               "address": None, "host": None, "message": "Hello from Client!"})
+        client.wait_response()
+
+    clients = [threading.Thread(target=run_client, args=(layer_id,), daemon=True) for layer_id in (1, 2)]
+    for client in clients:
+        client.start()
+    server_thread.join()
+    for client in clients:
+        client.join(timeout=10)
+
+    total_samples = sum(samples)
+    return {
+        "model": model_name,
+        "data": data_name,
+        "cut": cut,
+        "mode": mode,
+        "device": args.device,
+        "rounds": len(server.round_times),
+        "samples": total_samples,
+        "samples_per_second": total_samples / max(sum(train_time), 1e-9),
+        "bytes_per_sample": {link: stats["bytes"] / max(total_samples, 1) for link, stats in broker.link_stats.items()},
+        "round_wall_time": server.round_times,
+        "aggregation_time": server.aggregation_times,
+        "accuracy": server.accuracies,
+        "cold_start_time": {str(layer_id): seconds for layer_id, seconds in sorted(cold_start.items())},
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+if __name__ == "__main__":
+    if args.case:
+        model_name, data_name, cut, mode = args.case
+        print(f"BENCHMARK {json.dumps(run_case(model_name, data_name, int(cut), mode))}")
+        sys.exit()
+
+    results = []
+    selected = args.models
+    for model_name, data_name in models():
+        if selected and f"{model_name}_{data_name}" not in selected:
+            continue
+        for cut in args.cuts or CUTS[model_name]:
+            for mode in args.modes:
+                # One process per run, so peak RSS and cold start do not carry over
+                child = subprocess.run([sys.executable, "-m", "benchmarks.rounds", "--case", model_name, data_name, str(cut), mode,
+                                        "--rounds", str(args.rounds), "--samples", str(args.samples),
+                                        "--batch-size", str(args.batch_size), "--device", args.device,
+                                        "--test-samples", str(args.test_samples)],
+                                       stdout=subprocess.PIPE, text=True, cwd=os.getcwd())
+                lines = [line for line in child.stdout.splitlines() if line.startswith("BENCHMARK ")]
+                if child.returncode or not lines:
+                    print(f"{model_name}_{data_name} cut {cut} {mode}: failed with exit code {child.returncode}")
+                    results.append({"model": model_name, "data": data_name, "cut": cut, "mode": mode, "error": child.returncode})
+                    continue
+                result = json.loads(lines[-1][len("BENCHMARK "):])
+                results.append(result)
+                print(f"{model_name}_{data_name} cut {cut} {mode}: {result['samples_per_second']:.1f} samples/s, "
+                      f"bytes/sample {result['bytes_per_sample']}, round {result['round_wall_time']}, "
+                      f"aggregation {result['aggregation_time']}, accuracy {result['accuracy']}, "
+                      f"cold start {result['cold_start_time']}, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
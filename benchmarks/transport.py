@@ -0,0 +1,87 @@
+import argparse
+import time
+import uuid
+
+from src.Transport import RabbitTransport, TcpTransport, SharedMemoryTransport
+
+parser = argparse.ArgumentParser(description="Round-trip latency and throughput of the data-plane transports on localhost")
+parser.add_argument('--backends', type=str, nargs='+', default=['rabbitmq', 'tcp', 'shm'], help='rabbitmq, tcp and/or shm')
+parser.add_argument('--sizes', type=int, nargs='+', default=[1 << 10, 1 << 16, 1 << 20, 1 << 23], help='Message sizes in bytes')
+parser.add_argument('--round-trips', type=int, default=200, help='Ping-pong exchanges per size')
+parser.add_argument('--messages', type=int, default=200, help='Messages streamed per size')
+parser.add_argument('--window', type=int, default=4, help='Messages in flight while streaming')
+
+args = parser.parse_args()
+
+
+def wait(transport, queue):
+    while True:
+        body = transport.get(queue)
+        if body is not None:
+            return body
+
+
+def endpoints(backend):
+    """Return two connected transports and the queues leading to each of them."""
+    if backend == 'rabbitmq':
+        # Only needed with a broker, tcp runs without pika installed
+        import yaml
+        import pika
+
+        with open('config.yaml', 'r') as file:
+            config = yaml.safe_load(file)
+        credentials = pika.PlainCredentials(config["rabbit"]["username"], config["rabbit"]["password"])
+        connection = pika.BlockingConnection(pika.ConnectionParameters(config["rabbit"]["address"], 5672,
+                                                                       config["rabbit"]["virtual-host"], credentials))
+        transport = RabbitTransport(connection.channel())
+        ping, pong = f'benchmark_{uuid.uuid4()}', f'benchmark_{uuid.uuid4()}'
+        transport.declare(ping)
+        transport.declare(pong)
+        return transport, transport, ping, pong
+    if backend == 'shm':
+        first_id, second_id = uuid.uuid4(), uuid.uuid4()
+        first, second = SharedMemoryTransport(first_id, size=1 << 26), SharedMemoryTransport(second_id, size=1 << 26)
+        host = first.host
+    else:
+        first_id, second_id = "first", "second"
+        first, second = TcpTransport(), TcpTransport()
+        host = None
+    peers = {first_id: {"host": host, "address": first.address},
+             second_id: {"host": host, "address": second.address}}
+    first.set_peers(peers)
+    second.set_peers(peers)
+    return first, second, f"benchmark_{second_id}", f"benchmark_{first_id}"
+
+
+def run(backend, size):
+    first, second, ping, pong = endpoints(backend)
+    body = bytes(size)
+
+    start = time.time()
+    for _ in range(args.round_trips):
+        first.publish(ping, body)
+        second.publish(pong, wait(second, ping))
+        wait(first, pong)
+    latency = (time.time() - start) / args.round_trips
+
+    start = time.time()
+    sent = received = 0
+    while received < args.messages:
+        if sent < args.messages and sent - received < args.window:
+            first.publish(ping, body)
+            sent += 1
+        else:
+            wait(second, ping)
+            received += 1
+    throughput = args.messages * size / (time.time() - start)
+    first.close()
+    second.close()
+    return latency, throughput
+
+
+if __name__ == "__main__":
+    print(f"{'backend':>9} {'bytes':>9} {'round-trip ms':>14} {'MB/s':>10}")
+    for backend in args.backends:
+        for size in args.sizes:
+            latency, throughput = run(backend, size)
+            print(f"{backend:>9} {size:>9} {latency * 1000:>14.3f} {throughput / 1e6:>10.1f}")
@@ -1,11 +1,13 @@
 import pika
 import uuid
+import socket
 import argparse
 import yaml
 
 import torch
 
 import src.Log
+import src.Transport
 from src.RpcClient import RpcClient
 from src.Scheduler import Scheduler
 
@@ -15,6 +17,7 @@ parser.add_argument('--layer_id', type=int, required=True, help='ID of layer, st
 parser.add_argument('--device', type=str, required=False, help='Device of client')
 parser.add_argument('--event_time', type=bool, default=False, required=False, help='Log event time for debug mode')
 parser.add_argument('--performance', type=int, required=False, help='Cluster by device')
+parser.add_argument('--address', type=str, required=False, help='Data-plane address of the tcp transport')
 
 args = parser.parse_args()
 
@@ -50,10 +53,26 @@ if args.performance is None:
 else:
     performance = args.performance
 
+transport_config = config["learning"]["transport"]
+transport = src.Transport.RabbitTransport(channel)
+if transport_config["backend"] == "tcp":
+    transport = src.Transport.TcpTransport(transport, args.address or transport_config["address"], transport_config["port"])
+elif transport_config["backend"] != "rabbitmq":
+    raise ValueError(f"Transport '{transport_config['backend']}' is not valid.")
+if transport_config["shared-memory"]:
+    # Peers on this host are reached through shared memory, the others through the backend above
+    transport = src.Transport.SharedMemoryTransport(client_id, transport, transport_config["ring-size"])
+
 if __name__ == "__main__":
     src.Log.print_with_color("[>>>] Client sending registration message to server...", "red")
-    data = {"action": "REGISTER", "client_id": client_id, "layer_id": args.layer_id, "performance": performance, "message": "Hello from Client!"}
-    scheduler = Scheduler(client_id, args.layer_id, channel, device, args.event_time)
+    data = {"action": "REGISTER", "client_id": client_id, "layer_id": args.layer_id, "performance": performance,
+            "address": transport.address, "host": socket.gethostname(), "message": "Hello from Client!"}
+    scheduler = Scheduler(client_id, args.layer_id, channel, device, args.event_time, transport)
     client = RpcClient(client_id, args.layer_id, address, username, password, scheduler.train_on_device, device)
     client.send_to_server(data)
-    client.wait_response()
+    client.start_heartbeat(config["server"]["membership"]["heartbeat-interval"])
+    try:
+        client.wait_response()
+    except KeyboardInterrupt:
+        src.Log.print_with_color("[>>>] Client leaving...", "red")
+        client.send_to_server({"action": "LEAVE", "client_id": client_id, "layer_id": args.layer_id})
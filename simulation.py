@@ -0,0 +1,91 @@
+import argparse
+import threading
+import time
+import uuid
+import yaml
+
+import torch
+
+import src.Log
+from src.Aggregator import Aggregator
+from src.RpcClient import RpcClient
+from src.Scheduler import Scheduler
+from src.Server import Server
+from src.Simulation import MemoryBroker
+
+
+parser = argparse.ArgumentParser(description="Run the server and every client in one process, without RabbitMQ")
+parser.add_argument('--device', type=str, required=False, help='Device of all clients')
+parser.add_argument('--latency', type=float, nargs='+', default=[], help='Latency (s) of each link between layers')
+parser.add_argument('--bandwidth', type=float, nargs='+', default=[], help='Bandwidth (bytes/s) of each link between layers')
+
+args = parser.parse_args()
+
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file)
+
+device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def link_delay(queue, size):
+    # Activations of layer l go from l to l + 1 through `intermediate_queue_{l}...`, gradients come back
+    # through `gradient_queue_{l}_...`, both cross link l
+    if queue.startswith("intermediate_queue_"):
+        layer = int(queue.split("_")[2])
+        name = f"{layer}->{layer + 1}"
+    elif queue.startswith("gradient_queue_"):
+        layer = int(queue.split("_")[2])
+        name = f"{layer + 1}->{layer}"
+    else:
+        return None
+    latency = args.latency[layer - 1] if layer <= len(args.latency) else 0
+    bandwidth = args.bandwidth[layer - 1] if layer <= len(args.bandwidth) else 0
+    return name, latency, bandwidth
+
+
+def client_performances():
+    # (layer, performance) of every client, the performance is the cluster of a fixed partition
+    cluster_config = config["server"]["client-cluster"]
+    if cluster_config["enable"] and not cluster_config["auto-partition"]:
+        for cluster, infor_cluster in enumerate(config["server"]["cluster"]["infor-cluster"]):
+            for layer_id, count in enumerate(infor_cluster, start=1):
+                for _ in range(count):
+                    yield layer_id, cluster
+    else:
+        for layer_id, count in enumerate(config["server"]["clients"], start=1):
+            for _ in range(count):
+                yield layer_id, -1
+
+
+def run_client(broker, layer_id, performance):
+    client_id = uuid.uuid4()
+    channel = broker.connect().channel()
+    scheduler = Scheduler(client_id, layer_id, channel, device)
+    client = RpcClient(client_id, layer_id, None, None, None, scheduler.train_on_device, device,
+                       connection_factory=broker.connect)
+    client.send_to_server({"action": "REGISTER", "client_id": client_id, "layer_id": layer_id, "performance": performance,
+                           "address": None, "host": None, "message": "Hello from Client!"})
+    client.start_heartbeat(config["server"]["membership"]["heartbeat-interval"])
+    client.wait_response()
+
+
+if __name__ == "__main__":
+    broker = MemoryBroker(link_delay)
+    server = Server(config, connection_factory=broker.connect)
+    server_thread = threading.Thread(target=server.start, daemon=True)
+
+    start = time.time()
+    server_thread.start()
+    if config["server"]["aggregation"]["aggregators"]:
+        cluster_config = config["server"]["client-cluster"]
+        num_cluster = config["server"]["cluster"]["num-cluster"] if cluster_config["enable"] else 1
+        for cluster in range(num_cluster):
+            aggregator = Aggregator(config, cluster, connection_factory=broker.connect)
+            threading.Thread(target=aggregator.start, daemon=True).start()
+    for layer_id, performance in client_performances():
+        threading.Thread(target=run_client, args=(broker, layer_id, performance), daemon=True).start()
+    server_thread.join()
+
+    src.Log.print_with_color(f"Simulation finished in {time.time() - start:.2f}s", "green")
+    for name, stats in sorted(broker.link_stats.items()):
+        src.Log.print_with_color(f"Link {name}: {stats['messages']} messages, {stats['bytes'] / 1e6:.2f} MB", "green")
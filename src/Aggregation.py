@@ -0,0 +1,174 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class AsyncBuffer:
+    """
+    Buffered asynchronous aggregation (FedBuff-style) of one (cluster, layer) model. Updates are merged
+    as they arrive, weighted by data size and discounted by staleness (1 + staleness) ^ -exponent:
+
+        x <- x + mixing * sum_i(w_i * (x_i - x)) / sum_i(size_i)
+
+    With no staleness and mixing = 1 a flush is the plain weighted average.
+    """
+    def __init__(self, buffer_size, mixing=1.0, staleness_exponent=0.5, max_staleness=None):
+        self.buffer_size = buffer_size
+        self.mixing = mixing
+        self.staleness_exponent = staleness_exponent
+        self.max_staleness = max_staleness
+
+        self.state_dict = None
+        self.version = 0
+        self.buffer = []
+        self.merged_size = 0
+        self.dropped = 0
+
+    def reset(self, state_dict):
+        self.state_dict = state_dict
+        self.buffer = []
+        self.merged_size = 0
+
+    def add(self, state_dict, size, version):
+        staleness = self.version - version
+        if self.max_staleness is not None and staleness > self.max_staleness:
+            self.dropped += 1
+            return False
+        self.buffer.append((state_dict, size, staleness))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.buffer:
+            return
+        total_size = sum(size for _, size, _ in self.buffer)
+        if total_size == 0:
+            self.buffer = []
+            return
+
+        if self.state_dict is None:
+            # Nothing to mix with yet, start from the weighted average
+            base = self.buffer[0][0]
+            new_state_dict = {}
+            for key in base.keys():
+                value = sum(state_dict[key].float() * size for state_dict, size, _ in self.buffer) / total_size
+                new_state_dict[key] = value.to(base[key].dtype)
+        else:
+            new_state_dict = {}
+            for key, value in self.state_dict.items():
+                current = value.float()
+                delta = sum((state_dict[key].float() - current) * size * (1 + staleness) ** -self.staleness_exponent
+                            for state_dict, size, staleness in self.buffer) / total_size
+                new_state_dict[key] = (current + self.mixing * delta).to(value.dtype)
+        for key, value in new_state_dict.items():
+            if torch.isnan(value).any():
+                print(f"Warning: NaN detected in {key}, replacing with zero.")
+                new_state_dict[key] = torch.nan_to_num(value)
+
+        self.state_dict = new_state_dict
+        self.merged_size += total_size
+        self.version += 1
+        self.buffer = []
+
+
+def weighted_average(state_dicts, sizes):
+    """
+    Average of the state dicts weighted by data size, as the server averages a layer: floating point
+    tensors are averaged, integer ones (BatchNorm counters) use a floor division. NaN are replaced by zero.
+    Only the keys held by every state dict are averaged.
+    """
+    denominator = sum(sizes)
+    if not state_dicts or denominator == 0:
+        return None
+    average = {}
+    for key in state_dicts[0].keys():
+        if any(key not in state_dict for state_dict in state_dicts[1:]):
+            # Frozen layers are only uploaded once, the others keep their previous average
+            continue
+        for state_dict in state_dicts:
+            if torch.isnan(state_dict[key]).any():
+                print(f"Warning: NaN detected in {key}, replacing with zero.")
+                state_dict[key] = torch.nan_to_num(state_dict[key])
+        if state_dicts[0][key].dtype != torch.long:
+            average[key] = sum(state_dict[key].float() * size for state_dict, size in zip(state_dicts, sizes)) / denominator
+        else:
+            average[key] = sum(state_dict[key] * size for state_dict, size in zip(state_dicts, sizes)) // denominator
+    return average
+
+
+class ParallelAverager:
+    """
+    Weighted averages sharded over a thread pool: each model (a layer of a cluster) is split into groups of
+    about `group_size` elements, and every group is averaged as its own task. Torch releases the GIL, so the
+    groups of all layers and clusters run in parallel; while tasks are pending, the intra-op threads of torch
+    are divided among the workers so they do not oversubscribe the cores, then set back. Task time is
+    accounted per name for `report`.
+    """
+    def __init__(self, workers=0, group_size=1 << 22):
+        cores = os.cpu_count() or 1
+        self.workers = workers or cores
+        self.group_size = group_size
+        self.threads = max(1, cores // self.workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.start = None
+        # Tasks submitted and not done yet, and the thread count of torch to restore after the last one
+        self.pending = 0
+        self.saved_threads = None
+
+    def groups(self, state_dict):
+        group, numel = [], 0
+        for key, value in state_dict.items():
+            group.append(key)
+            numel += value.numel()
+            if numel >= self.group_size:
+                yield group
+                group, numel = [], 0
+        if group:
+            yield group
+
+    def submit(self, name, state_dicts, sizes):
+        """Start averaging the keys common to all `state_dicts`, return the futures to pass to `result`."""
+        if self.start is None:
+            self.start = time.time()
+        # A client uploading its frozen layers for the first time sends more keys than the others
+        common = {key: value for key, value in state_dicts[0].items() if all(key in state_dict for state_dict in state_dicts[1:])}
+        groups = list(self.groups(common))
+        with self.lock:
+            if self.pending == 0 and groups:
+                self.saved_threads = torch.get_num_threads()
+                torch.set_num_threads(self.threads)
+            self.pending += len(groups)
+        return [self.pool.submit(self.timed, name, [{key: state_dict[key] for key in keys} for state_dict in state_dicts], sizes)
+                for keys in groups]
+
+    def timed(self, name, state_dicts, sizes):
+        start = time.time()
+        try:
+            return weighted_average(state_dicts, sizes)
+        finally:
+            with self.lock:
+                self.timings[name] = self.timings.get(name, 0) + time.time() - start
+                self.pending -= 1
+                if self.pending == 0:
+                    torch.set_num_threads(self.saved_threads)
+
+    @staticmethod
+    def result(futures):
+        average = {}
+        for future in futures:
+            average.update(future.result())
+        return average
+
+    def report(self):
+        """Wall time since the first task and task time per name, then start over."""
+        wall_time = time.time() - self.start if self.start is not None else 0
+        timings = self.timings
+        self.timings = {}
+        self.start = None
+        return wall_time, timings
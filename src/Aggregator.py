@@ -0,0 +1,91 @@
+import pika
+import pickle
+
+import src.Log
+import src.Aggregation
+import src.Stream
+
+
+class Aggregator:
+    """
+    Edge aggregator of one cluster. Clients of the cluster send their UPDATE to `aggregate_queue_{cluster}`
+    instead of `rpc_queue`: the aggregator keeps the parameters and forwards the rest of the message to the
+    server, which still runs the rounds. Once the server has collected the cluster it sends AGGREGATE, and
+    the aggregator answers with one weighted average per layer (AGGREGATED).
+    """
+    def __init__(self, config, cluster, connection_factory=None):
+        address = config["rabbit"]["address"]
+        username = config["rabbit"]["username"]
+        password = config["rabbit"]["password"]
+        virtual_host = config["rabbit"]["virtual-host"]
+
+        self.cluster = cluster
+        self.queue = f'aggregate_queue_{cluster}'
+        self.updates = {}  # client_id -> (layer_id, parameters, size, optimizer_state)
+        self.uploads = src.Stream.Uploads()  # chunked UPDATEs per client
+
+        if connection_factory is not None:
+            # In-process simulation
+            self.connection = connection_factory()
+        else:
+            credentials = pika.PlainCredentials(username, password)
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(address, 5672, f'{virtual_host}', credentials))
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.queue, durable=False)
+        self.channel.queue_declare(queue='rpc_queue', durable=False)
+        self.channel.basic_qos(prefetch_count=10)
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self.on_request)
+        self.handlers = {"UPDATE": self.on_update,
+                         "UPDATE_CHUNK": self.on_update_chunk,
+                         "AGGREGATE": self.on_aggregate}
+
+    def start(self):
+        src.Log.print_with_color(f"Aggregator of cluster {self.cluster} is waiting for updates", "green")
+        self.channel.start_consuming()
+
+    def on_request(self, ch, method, props, body):
+        message = pickle.loads(body)
+        handler = self.handlers.get(message["action"])
+        if handler is None:
+            src.Log.print_with_color(f"Unknown action {message['action']}", "yellow")
+        else:
+            handler(message)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def on_update_chunk(self, message):
+        update = self.uploads.add_chunk(str(message["client_id"]), message)
+        if update is not None:
+            self.on_update(update)
+
+    def on_update(self, message):
+        client_id = str(message["client_id"])
+        if message["chunks"] is not None:
+            if not self.uploads.ready(client_id, message):
+                return
+            error = self.uploads.assemble(client_id, message)
+            if error is not None:
+                src.Log.print_with_color(f"Chunked parameters of {client_id} are broken ({error})", "yellow")
+        src.Log.print_with_color(f"[<<<] Received parameters of layer {message['layer_id']} from {client_id}", "blue")
+        if message["parameters"]:
+            self.updates[client_id] = (message["layer_id"], message["parameters"], message["size"], message["optimizer_state"])
+        # The server decides whether this update counts, it only needs the control part
+        self.send_to_server(dict(message, parameters=None, optimizer_state=None))
+
+    def on_aggregate(self, message):
+        clients = set(message["clients"])
+        parameters, sizes, optimizer_states = [], [], []
+        for layer_id in range(1, message["num_layers"] + 1):
+            updates = [update for client_id, update in self.updates.items() if client_id in clients and update[0] == layer_id]
+            layer_sizes = [size for (_, _, size, _) in updates]
+            parameters.append(src.Aggregation.weighted_average([state_dict for (_, state_dict, _, _) in updates], layer_sizes))
+            sizes.append(sum(layer_sizes))
+            states = [state for (_, _, _, state) in updates]
+            optimizer_states.append(src.Aggregation.weighted_average(states, layer_sizes) if states and all(states) else None)
+        # Updates left over were not counted by the server (late or excluded)
+        self.updates = {}
+        src.Log.print_with_color(f"[>>>] Sent the average of {len(clients)} updates of cluster {self.cluster}", "red")
+        self.send_to_server({"action": "AGGREGATED", "client_id": f"aggregator_{self.cluster}", "cluster": self.cluster,
+                             "parameters": parameters, "sizes": sizes, "optimizer_states": optimizer_states})
+
+    def send_to_server(self, message):
+        self.channel.basic_publish(exchange='', routing_key='rpc_queue', body=pickle.dumps(message))
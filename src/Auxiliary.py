@@ -0,0 +1,28 @@
+import torch.nn as nn
+
+
+class AuxiliaryHead(nn.Module):
+    """
+    Small classifier on the cut activations of a non-final stage, trained with the local loss of the
+    stage. It stays on the client: it is neither uploaded nor part of the aggregated model. `sample` is
+    a batch of activations, giving the input size: feature maps are average pooled, token sequences
+    use their first (class) token.
+    """
+    def __init__(self, sample, num_classes):
+        super().__init__()
+        self.tokens = sample.dim() == 3
+        if sample.dim() == 4:
+            self.pool = nn.Sequential(nn.AdaptiveAvgPool2d(1), nn.Flatten(1))
+            features = sample.shape[1]
+        elif self.tokens:
+            self.pool = None
+            features = sample.shape[2]
+        else:
+            self.pool = nn.Flatten(1)
+            features = sample[0].numel()
+        self.linear = nn.Linear(features, num_classes)
+
+    def forward(self, x):
+        if self.tokens:
+            return self.linear(x[:, 0])
+        return self.linear(self.pool(x))
@@ -0,0 +1,119 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+import src.Utils
+
+DTYPES = {"float16": np.float16, "float32": np.float32}
+
+
+def stochastic_transforms(dataset):
+    """Names of the random transforms of a torchvision dataset, their output differs between epochs."""
+    transform = getattr(dataset, "transform", None)
+    transforms = getattr(transform, "transforms", [transform] if transform is not None else [])
+    return [type(t).__name__ for t in transforms if type(t).__name__.startswith("Random")]
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """Samples of a subset together with their index in the full dataset, the key of the cache."""
+    def __init__(self, subset):
+        self.subset = subset
+
+    def __len__(self):
+        return len(self.subset)
+
+    def __getitem__(self, idx):
+        data, label = self.subset[idx]
+        return data, label, self.subset.indices[idx]
+
+
+def version(state_dict):
+    """Version of the frozen tensors, the cached activations are only valid for these parameters."""
+    sha256 = hashlib.sha256()
+    for key, tensor_hash in sorted(src.Utils.state_dict_hashes(state_dict).items()):
+        sha256.update(f"{key}:{tensor_hash}".encode())
+    return sha256.hexdigest()
+
+
+class ActivationCache:
+    """
+    Output of the frozen prefix of the first stage per sample, kept across rounds while the frozen
+    parameters do not change. Rows are stored as `dtype` numpy arrays, in memory or in a memory-mapped
+    file under `path`, and evicted least recently used beyond `max_bytes`. The cached samples of a batch
+    are served from the cache, only the others go through the prefix.
+    """
+    def __init__(self, dtype="float16", max_bytes=1 << 30, path="", name="activations"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Activation cache dtype '{dtype}' is not valid.")
+        self.dtype = DTYPES[dtype]
+        self.max_bytes = max_bytes
+        self.path = path
+        self.name = name
+        self.version = None
+        self.rows = OrderedDict()  # sample index -> row, or slot of the memory map
+        self.shape = None
+        self.memmap = None
+        self.free = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def reset(self, model_version):
+        if model_version != self.version:
+            self.version = model_version
+            self.rows.clear()
+            self.free = list(range(len(self.memmap))) if self.memmap is not None else []
+
+    def capacity(self, shape):
+        row_bytes = int(np.prod(shape)) * np.dtype(self.dtype).itemsize
+        return max(1, self.max_bytes // row_bytes)
+
+    def get(self, indices, device):
+        """Return the cached rows of a batch (None if there is none), their positions and those of the missing samples."""
+        keys = [int(index) for index in indices]
+        hit = [position for position, key in enumerate(keys) if key in self.rows]
+        missing = [position for position, key in enumerate(keys) if key not in self.rows]
+        self.hits += len(hit)
+        self.misses += len(missing)
+        if not hit:
+            return None, hit, missing
+        for position in hit:
+            self.rows.move_to_end(keys[position])
+        if self.memmap is not None:
+            batch = np.stack([self.memmap[self.rows[keys[position]]] for position in hit])
+        else:
+            batch = np.stack([self.rows[keys[position]] for position in hit])
+        return torch.from_numpy(batch.astype(np.float32)).to(device), hit, missing
+
+    def put(self, indices, activations):
+        activations = activations.detach().to("cpu").numpy().astype(self.dtype)
+        if self.shape is None:
+            self.shape = activations.shape[1:]
+            if self.path:
+                os.makedirs(self.path, exist_ok=True)
+                slots = self.capacity(self.shape)
+                self.memmap = np.memmap(os.path.join(self.path, f"{self.name}.dat"), dtype=self.dtype, mode="w+",
+                                        shape=(slots,) + tuple(self.shape))
+                self.free = list(range(slots))
+        for index, row in zip(indices, activations):
+            key = int(index)
+            if key in self.rows:
+                self.rows.move_to_end(key)
+                continue
+            if len(self.rows) >= self.capacity(self.shape):
+                _, evicted = self.rows.popitem(last=False)
+                self.evictions += 1
+                if self.memmap is not None:
+                    self.free.append(evicted)
+            if self.memmap is not None:
+                slot = self.free.pop()
+                self.memmap[slot] = row
+                self.rows[key] = slot
+            else:
+                self.rows[key] = row.copy()
+
+    def stats(self):
+        return {"rows": len(self.rows), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import torch
+
+from src.model import stage_range, stage_state_dict, vit_layer_index
+
+
+class CheckpointStore:
+    """
+    Per-layer checkpoint shards with a JSON manifest, one directory per saved round.
+
+    Layout:
+        {root}/manifest.json            -> latest round and its shards
+        {root}/round_{n}/layer_{i}.pt   -> parameters of layer i (0-based), keys of the full model
+    """
+    def __init__(self, root, model_name, keep_rounds=3, legacy_file=None):
+        self.root = root
+        self.model_name = model_name
+        self.keep_rounds = keep_rounds
+        self.manifest = None
+        self.cache = {}
+
+        manifest_path = os.path.join(self.root, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                self.manifest = json.load(file)
+        elif legacy_file and os.path.exists(legacy_file):
+            # Import the old monolithic `{model}_{data}.pth` file once
+            self.save(torch.load(legacy_file, weights_only=True), 0)
+
+    def exists(self):
+        return self.manifest is not None
+
+    def latest_round(self):
+        return self.manifest["round"] if self.manifest else None
+
+    def layer_of(self, key):
+        if self.model_name != 'ViT':
+            return int(key.split(".", 1)[0])
+        return vit_layer_index(key) - 1
+
+    def save(self, state_dict_full, round_id):
+        """Save a round, `round_id` grows across runs: `prune` keeps the highest ones."""
+        shards = {}
+        for key, value in state_dict_full.items():
+            shards.setdefault(self.layer_of(key), {})[key] = value.detach().cpu()
+
+        round_name = f"round_{round_id}"
+        round_dir = os.path.join(self.root, round_name)
+        tmp_dir = round_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        manifest = {"model_name": self.model_name, "round": round_id, "dir": round_name, "shards": {}}
+        for layer, shard in sorted(shards.items()):
+            filename = f"layer_{layer}.pt"
+            torch.save(shard, os.path.join(tmp_dir, filename))
+            manifest["shards"][str(layer)] = {"file": filename, "keys": list(shard.keys())}
+
+        # Publish the round directory first, then switch the manifest, so a crash never leaves a
+        # manifest pointing at half-written shards.
+        shutil.rmtree(round_dir, ignore_errors=True)
+        os.replace(tmp_dir, round_dir)
+        manifest_path = os.path.join(self.root, "manifest.json")
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(manifest, file)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+        self.manifest = manifest
+        self.cache = {}
+        self.prune()
+
+    def prune(self):
+        rounds = []
+        for name in os.listdir(self.root):
+            if name.startswith("round_") and not name.endswith(".tmp"):
+                rounds.append(int(name[len("round_"):]))
+        for round_id in sorted(rounds)[:-self.keep_rounds]:
+            if round_id != self.manifest["round"]:
+                shutil.rmtree(os.path.join(self.root, f"round_{round_id}"), ignore_errors=True)
+
+    def load_stage(self, start, end):
+        """
+        Return the state dict of stage [start, end) with the keys `build_stage` expects. Only the
+        shards of that range are read (memory-mapped) and the result is reused for every client
+        asking for the same range until the next save.
+        """
+        if self.manifest is None:
+            return None
+        cache_key = (self.manifest["round"], start, end)
+        if cache_key in self.cache:
+            return self.cache[cache_key]
+
+        first, last = stage_range(start, end)
+        round_dir = os.path.join(self.root, self.manifest["dir"])
+        state_dict = {}
+        for layer, shard in self.manifest["shards"].items():
+            layer = int(layer)
+            if layer >= first and (last is None or layer < last):
+                path = os.path.join(round_dir, shard["file"])
+                state_dict.update(torch.load(path, mmap=True, weights_only=True))
+
+        state_dict = stage_state_dict(self.model_name, state_dict, start, end)
+        self.cache[cache_key] = state_dict
+        return state_dict
@@ -0,0 +1,114 @@
+import torch
+import torch.nn as nn
+
+from src.model import stage_range, vit_layer_index
+
+NONE = "none"              # every layer of the stage trains
+PREFIX = "prefix"          # the first `layers` layers of the stage are frozen
+CLASSIFIER = "classifier"  # only the last layer of the model trains, stages without it are frozen
+ALL = "all"                # the whole stage is frozen
+
+
+def schedule_policy(schedule, round_id, layer_id):
+    """Policy of a stage in a global round: the last phase of `schedule` started at or before `round_id`."""
+    policy = None
+    for phase in schedule:
+        if phase["round"] <= round_id:
+            stages = phase["stages"]
+            policy = stages[layer_id - 1] if layer_id <= len(stages) else None
+    if policy is None or policy["policy"] == NONE:
+        return None
+    return policy
+
+
+def key_layer(model_name, key, start):
+    """Layer of the full model (from 1, as the cut layers) holding a state dict key of a stage starting at `start`."""
+    if model_name == 'ViT':
+        return vit_layer_index(key)
+    return start + int(key.split(".", 1)[0]) + 1
+
+
+def frozen_keys(model_name, keys, layers, policy):
+    """State dict keys of the stage `layers` that `policy` freezes."""
+    if not policy:
+        return set()
+    start, end = stage_range(layers[0], layers[1])
+    keys = list(keys)
+    if policy["policy"] == ALL:
+        return set(keys)
+    if policy["policy"] == PREFIX:
+        return {key for key in keys if key_layer(model_name, key, start) <= start + policy["layers"]}
+    if policy["policy"] == CLASSIFIER:
+        if end is not None:
+            return set(keys)
+        classifier = max(key_layer(model_name, key, start) for key in keys)
+        return {key for key in keys if key_layer(model_name, key, start) != classifier}
+    raise ValueError(f"Freezing policy '{policy['policy']}' is not valid.")
+
+
+def stage_frozen(policy, layers):
+    """Whether `policy` freezes every layer of the stage `layers`, known without its state dict keys."""
+    if not policy:
+        return False
+    start, end = stage_range(layers[0], layers[1])
+    if policy["policy"] == ALL:
+        return True
+    if policy["policy"] == CLASSIFIER:
+        return end is not None
+    if policy["policy"] == PREFIX:
+        return end is not None and policy["layers"] >= end - start
+    return False
+
+
+class Freezer:
+    """
+    Freeze the `frozen` state dict keys of a stage for one round: their parameters get no gradient (so no
+    optimizer state either) and their modules stay in eval mode, which keeps BatchNorm statistics fixed.
+    When the frozen layers are a prefix of a sequential stage (or the whole stage), `prefix_forward` runs
+    them without autograd and `forward` only the layers that train.
+    """
+    def __init__(self, model, frozen):
+        self.model = model
+        self.frozen = set(frozen)
+        params = dict(model.named_parameters())
+        for name, param in params.items():
+            param.requires_grad_(name not in self.frozen)
+        self.all_frozen = bool(params) and all(name in self.frozen for name in params)
+        names = {key.rsplit(".", 1)[0] for key in self.frozen if "." in key}
+        self.frozen_modules = [module for name, module in model.named_modules() if name in names]
+
+        self.prefix = None
+        self.rest = model
+        if self.frozen and isinstance(model, nn.Sequential):
+            children = list(model.named_children())
+            count = 0
+            for name, child in children:
+                keys = [f"{name}.{key}" for key in child.state_dict().keys()]
+                if keys and not all(key in self.frozen for key in keys):
+                    break
+                count += 1
+            if count:
+                self.prefix = nn.Sequential(*[child for _, child in children[:count]])
+                self.rest = nn.Sequential(*[child for _, child in children[count:]])
+        elif self.all_frozen:
+            self.prefix = model
+            self.rest = nn.Sequential()
+
+    def train(self):
+        self.model.train()
+        for module in self.frozen_modules:
+            module.eval()
+        if self.prefix is not None:
+            self.prefix.eval()
+
+    def prefix_forward(self, x):
+        if self.prefix is None:
+            return x
+        with torch.no_grad():
+            return self.prefix(x)
+
+    def forward(self, x):
+        if self.all_frozen:
+            with torch.no_grad():
+                return self.rest(x)
+        return self.rest(x)
@@ -0,0 +1,78 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as f
+
+NORMAL = "normal"
+FEDPROX = "FedProx"
+REBAFL = "ReBaFL"
+
+
+class RegularizedLoss:
+    """
+    Training loss of a client for one round, for the `compute_loss` modes:
+    - normal: cross entropy.
+    - FedProx: cross entropy + mu / 2 * sum of ||w - w_global|| over the parameter tensors.
+    - ReBaFL: balanced softmax loss + the FedProx term + lambda_aug * ||mean feature - mean global feature||.
+
+    The global parameters are a frozen copy of each tensor taken when the round starts, and the proximal
+    term is one multi-tensor subtraction and one multi-tensor norm over all of them. The balanced softmax weights are computed once
+    per label distribution. The global feature target of ReBaFL, the mean output of the frozen global
+    model, is computed every `target-every` steps and reused in between.
+    """
+    def __init__(self, compute_loss, model, global_model=None, device="cpu", epsilon=1e-6):
+        self.mode = compute_loss["mode"]
+        self.config = compute_loss.get(self.mode, {})
+        self.model = model
+        self.device = device
+        self.epsilon = epsilon
+        self.criterion = nn.CrossEntropyLoss()
+        self.class_weights = {}
+        self.steps = 0
+        self.target = None
+
+        if self.mode in (FEDPROX, REBAFL):
+            self.params = [param for param in model.parameters() if param.requires_grad]
+            self.snapshot = [param.detach().clone().to(device) for param in self.params]
+        self.global_model = None
+        if self.mode == REBAFL and global_model is not None:
+            self.global_model = global_model.to(device).eval()
+            for param in self.global_model.parameters():
+                param.requires_grad_(False)
+            self.target_every = self.config.get("target-every", 1)
+
+    def prox_term(self):
+        if not self.params:
+            return torch.zeros((), device=self.device)
+        # The norm of an unchanged tensor gets a zero subgradient
+        return torch.stack(torch._foreach_norm(torch._foreach_sub(self.params, self.snapshot))).sum()
+
+    def weights(self, label_count):
+        key = tuple(label_count)
+        if key not in self.class_weights:
+            class_counts = torch.tensor(label_count, dtype=torch.float32, device=self.device)
+            class_probs = class_counts / (class_counts.sum() + self.epsilon)
+            weights = 1.0 / (class_probs + self.epsilon)
+            self.class_weights[key] = weights / weights.sum()
+        return self.class_weights[key]
+
+    def balanced_softmax_loss(self, logits, labels, label_count):
+        log_probs = f.log_softmax(logits, dim=1)
+        return (-self.weights(label_count)[labels] * log_probs.gather(1, labels.unsqueeze(1)).squeeze(1)).mean()
+
+    def feature_target(self, inputs):
+        if self.target is None or self.steps % self.target_every == 0:
+            with torch.no_grad():
+                self.target = self.global_model(inputs.detach()).mean(dim=0)
+        self.steps += 1
+        return self.target
+
+    def __call__(self, output, labels, label_count=None, inputs=None):
+        if self.mode == FEDPROX:
+            return self.criterion(output, labels) + (self.config["mu"] / 2) * self.prox_term()
+        if self.mode == REBAFL:
+            loss = self.balanced_softmax_loss(output, labels, label_count)
+            loss = loss + (self.config["mu"] / 2) * self.prox_term()
+            if self.global_model is not None:
+                loss = loss + self.config["lambda_aug"] * torch.norm(output.mean(dim=0) - self.feature_target(inputs), p=2)
+            return loss
+        return self.criterion(output, labels)
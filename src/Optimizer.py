@@ -0,0 +1,57 @@
+import torch.optim as optim
+
+RESET = "reset"      # momentum starts from zero every round, like a new optimizer
+KEEP = "keep"        # momentum of the client carries over to the next round
+AVERAGE = "average"  # momentum is averaged by the server together with the parameters
+
+
+class OptimizerManager:
+    """
+    Keep the SGD optimizer of a client across rounds, so its momentum buffers survive aggregation
+    according to `policy`. Steps use the multi-tensor (foreach) kernels, or the fused kernel on CUDA.
+    """
+    def __init__(self, policy=KEEP, foreach=True, fused=False):
+        if policy not in (RESET, KEEP, AVERAGE):
+            raise ValueError(f"Optimizer state policy '{policy}' is not valid.")
+        self.policy = policy
+        self.foreach = foreach
+        self.fused = fused
+        self.model = None
+        self.optimizer = None
+
+    def kernel(self, device):
+        if self.fused and str(device).startswith("cuda"):
+            return {"fused": True}
+        return {"foreach": self.foreach}
+
+    def get(self, model, lr, momentum, device, state=None):
+        """Return the optimizer of `model` for this round, `state` is the averaged momentum sent by the server."""
+        if self.optimizer is None or self.model is not model:
+            # A rebuilt model (new cut layers) has new parameters, its state starts over
+            self.optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum, **self.kernel(device))
+            self.model = model
+        else:
+            for group in self.optimizer.param_groups:
+                group["lr"] = lr
+                group["momentum"] = momentum
+            if self.policy == RESET:
+                self.optimizer.state.clear()
+        if self.policy == AVERAGE and state:
+            self.load_state(state)
+        return self.optimizer
+
+    def state(self):
+        """Momentum buffers by parameter name, uploaded with the parameters when the server averages them."""
+        if self.policy != AVERAGE or self.optimizer is None:
+            return None
+        buffers = {}
+        for name, param in self.model.named_parameters():
+            buffer = self.optimizer.state.get(param, {}).get("momentum_buffer")
+            if buffer is not None:
+                buffers[name] = buffer.detach().to("cpu").clone()
+        return buffers
+
+    def load_state(self, state):
+        for name, param in self.model.named_parameters():
+            if name in state:
+                self.optimizer.state[param]["momentum_buffer"] = state[name].to(param.device).clone()
@@ -0,0 +1,80 @@
+TRAINING = "TRAINING"        # clients are training, waiting for NOTIFY from first-layer clients
+COLLECTING = "COLLECTING"    # PAUSE sent, waiting for UPDATE messages
+AGGREGATING = "AGGREGATING"  # local aggregation of this cluster is running
+WAITING = "WAITING"          # last local round collected, waiting for the other clusters
+
+
+class ClusterRound:
+    """
+    Round state of one cluster. It replaces the counters that were spread over the server
+    (`current_clients`, `current_infor_cluster`, `first_layer_clients_in_each_cluster`...).
+    """
+    def __init__(self, cluster, clients_per_layer, local_round):
+        self.cluster = cluster
+        self.clients_per_layer = list(clients_per_layer)
+        self.local_round = local_round
+        self.state = TRAINING
+        self.current_local_round = 0
+        self.finished_first_layer = set()
+        self.updated = [0 for _ in self.clients_per_layer]
+        self.expected = list(self.clients_per_layer)
+
+    def is_global(self):
+        return self.current_local_round == self.local_round - 1
+
+    def finish_training(self, client_id):
+        """Count a NOTIFY of a first-layer client, return True when the whole first layer is done."""
+        self.finished_first_layer.add(client_id)
+        if len(self.finished_first_layer) >= self.clients_per_layer[0]:
+            self.stop_training()
+            return True
+        return False
+
+    def stop_training(self):
+        self.finished_first_layer = set()
+        self.state = COLLECTING
+
+    def close(self):
+        """Deadline passed: the round is complete with the updates received so far."""
+        self.expected = list(self.updated)
+
+    def add_client(self, layer_id):
+        # Only called at a round boundary, `next_global_round` updates `expected`
+        self.clients_per_layer[layer_id - 1] += 1
+
+    def remove_client(self, layer_id, client_id, counted=False):
+        """A client left. It is no longer expected in this round unless its update is already accounted for."""
+        self.clients_per_layer[layer_id - 1] -= 1
+        self.finished_first_layer.discard(client_id)
+        if not counted:
+            self.expected[layer_id - 1] -= 1
+
+    def is_complete(self):
+        """The cluster can only train with at least one client in every layer."""
+        return all(clients > 0 for clients in self.clients_per_layer)
+
+    def update(self, layer_id):
+        self.updated[layer_id - 1] += 1
+
+    def collected(self, layers=None):
+        """All expected updates are in, only counting the `layers` (indices) that upload this round if given."""
+        if layers is None:
+            layers = range(len(self.updated))
+        return all(self.updated[layer] >= self.expected[layer] for layer in layers)
+
+    def next_local_round(self):
+        self.current_local_round += 1
+        self.updated = [0 for _ in self.clients_per_layer]
+        self.expected = list(self.clients_per_layer)
+        self.state = TRAINING
+
+    def next_global_round(self):
+        self.current_local_round = 0
+        self.updated = [0 for _ in self.clients_per_layer]
+        self.expected = list(self.clients_per_layer)
+        self.state = TRAINING
+
+    def __repr__(self):
+        return (f"ClusterRound(cluster={self.cluster}, state={self.state}, "
+                f"local_round={self.current_local_round}/{self.local_round}, updated={self.updated}, "
+                f"clients={self.clients_per_layer})")
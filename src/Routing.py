@@ -0,0 +1,68 @@
+import time
+import bisect
+import hashlib
+
+SHARED = "shared"                        # every downstream client races on one shared queue
+LEAST_OUTSTANDING = "least-outstanding"  # fewest micro-batches waiting for a gradient
+THROUGHPUT = "throughput"                # shortest expected completion, from the measured round-trip time
+HASH = "hash"                            # consistent hashing of the micro-batch id
+
+
+class Router:
+    """
+    Choose the downstream client of every micro-batch sent by a client, which then publishes it to
+    `intermediate_queue_{layer}_{client_id}` of that client. Gradients still come back along `trace`.
+    """
+    def __init__(self, policy, targets, virtual_nodes=64, smoothing=0.2):
+        if policy not in (LEAST_OUTSTANDING, THROUGHPUT, HASH):
+            raise ValueError(f"Routing policy '{policy}' is not valid.")
+        self.policy = policy
+        self.targets = [str(target) for target in targets]
+        self.smoothing = smoothing
+
+        self.in_flight = {}  # data_id -> (target, sent time)
+        self.outstanding = {target: 0 for target in self.targets}
+        self.sent = {target: 0 for target in self.targets}
+        self.latency = {target: None for target in self.targets}
+        self.ring = sorted((self.hash(f"{target}#{i}"), target) for target in self.targets for i in range(virtual_nodes))
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+    def route(self, data_id):
+        if data_id in self.in_flight:
+            # Retransmission, the previous target is given up
+            self.forget(data_id)
+
+        if self.policy == HASH:
+            index = bisect.bisect(self.ring, (self.hash(data_id),)) % len(self.ring)
+            target = self.ring[index][1]
+        elif self.policy == LEAST_OUTSTANDING:
+            target = min(self.targets, key=lambda t: self.outstanding[t])
+        else:
+            # Untried targets have no latency yet and are chosen first
+            target = min(self.targets, key=lambda t: (self.outstanding[t] + 1) * (self.latency[t] or 0))
+
+        self.in_flight[data_id] = (target, time.time())
+        self.outstanding[target] += 1
+        self.sent[target] += 1
+        return target
+
+    def answered(self, data_id):
+        if data_id not in self.in_flight:
+            return
+        target, sent_time = self.forget(data_id)
+        latency = time.time() - sent_time
+        if self.latency[target] is None:
+            self.latency[target] = latency
+        else:
+            self.latency[target] += self.smoothing * (latency - self.latency[target])
+
+    def forget(self, data_id):
+        target, sent_time = self.in_flight.pop(data_id)
+        self.outstanding[target] -= 1
+        return target, sent_time
+
+    def stats(self):
+        return {target: {"sent": self.sent[target], "latency": self.latency[target]} for target in self.targets}
@@ -1,5 +1,6 @@
 import time
 import pickle
+import threading
 import pika
 import random
 import copy
@@ -7,18 +8,22 @@ import torch
 import torchvision
 import torchvision.transforms as transforms
 
-from torch import nn
 from collections import defaultdict
 from tqdm import tqdm
 
+import src.Cache
+import src.Freezing
 import src.Log
 import src.Model
+import src.Optimizer
+import src.Stream
+import src.Utils
 from src.Model import ViT
 from src.model import *
 
 
 class RpcClient:
-    def __init__(self, client_id, layer_id, address, username, password, train_func, device):
+    def __init__(self, client_id, layer_id, address, username, password, train_func, device, connection_factory=None):
         self.client_id = client_id
         self.layer_id = layer_id
         self.address = address
@@ -26,14 +31,24 @@ class RpcClient:
         self.password = password
         self.train_func = train_func
         self.device = device
+        self.connection_factory = connection_factory
 
         self.channel = None
         self.connection = None
         self.response = None
         self.model = None
+        self.cut_layers = None
         self.global_model = None
+        self.optimizers = None
+        # Frozen tensors are uploaded once per model, the server keeps them afterwards
+        self.frozen_uploaded = False
         self.cluster = None
         self.label_count = None
+        self.parameters = {}
+        self.parameter_cache = {}
+        self.downloads = {}  # transfer -> ChunkAssembler of a chunked PARAMETERS
+        self.cached_uploaded = set()
+        self.cached_received = set()
         self.connect()
 
         self.train_set = None
@@ -47,15 +62,31 @@ class RpcClient:
             method_frame, header_frame, body = self.channel.basic_get(queue=reply_queue_name, auto_ack=True)
             if body:
                 status = self.response_message(body)
-            time.sleep(0.5)
+            else:
+                time.sleep(0.5)
 
     def response_message(self, body):
         self.response = pickle.loads(body)
-        src.Log.print_with_color(f"[<<<] Client received: {self.response['message']}", "blue")
         action = self.response["action"]
+        if action == "PARAMETERS_CHUNK":
+            # Tensors go to the cache as their blocks arrive
+            self.downloads.setdefault(self.response["transfer"], src.Stream.ChunkAssembler()).add(self.response)
+            return True
+        src.Log.print_with_color(f"[<<<] Client received: {self.response['message']}", "blue")
         state_dict = self.response["parameters"]
 
-        if action == "START":
+        if action == "PARAMETERS":
+            # Shared parameters of our (cluster, layer), the START message refers to them by digest
+            if self.response["chunks"] is not None:
+                assembler = self.downloads.pop(self.response["transfer"], src.Stream.ChunkAssembler())
+                error = assembler.check(self.response["chunks"], self.response["digest"])
+                if error is not None:
+                    src.Log.print_with_color(f"Chunked parameters are broken ({error}), missing tensors will be fetched", "yellow")
+                self.parameter_cache.update(assembler.tensors)
+            self.parameters[self.response["digest"]] = state_dict
+            return True
+        elif action == "START":
+            state_dict = self.load_parameters(self.response["parameters_ref"], self.response["parameters_hashes"])
             special = self.response["special"]
             model_name = self.response["model_name"]
             cut_layers = self.response['layers']
@@ -64,7 +95,8 @@ class RpcClient:
             clip_grad_norm = self.response['clip_grad_norm']
             data_name = self.response["data_name"]
 
-            if self.label_count is None:
+            if label_count is not None:
+                # Data shards are redistributed when clients join or leave
                 self.label_count = label_count
             if self.response['cluster'] is not None:
                 self.cluster = self.response['cluster']
@@ -103,45 +135,46 @@ class RpcClient:
                 for idx, (_, label) in tqdm(enumerate(self.train_set)):
                     self.label_to_indices[int(label)].append(idx)
 
-            # Load model
-            if self.model is None:
-                if 'MNIST' in data_name:
-                    klass = globals()[f'{model_name}_MNIST']
-                else:
-                    klass = globals()[f'{model_name}_{data_name}']
-
-                if model_name != 'ViT':
-                    full_model = klass()
-                    if cut_layers[1] != 0:
-                        from_layer = cut_layers[0]
-                        to_layer = cut_layers[1]
-                        if to_layer == -1:
-                            self.model = nn.Sequential(*nn.ModuleList(full_model.children())[from_layer:])
-                        else:
-                            self.model = nn.Sequential(*nn.ModuleList(full_model.children())[from_layer:to_layer])
-                    else:
-                        self.model = nn.Sequential(*nn.ModuleList(full_model.children())[:])
-
-                else:
-                    if cut_layers[1] != 0:
-                        if cut_layers[1] == -1:
-                            self.model = klass(start_layer=cut_layers[0])
-                        else:
-                            self.model = klass(start_layer=cut_layers[0], end_layer=cut_layers[1])
-                    else:
-                        self.model = klass()
+            # Load model, rebuilt when the server moves this client to a cluster with other cut layers
+            if self.model is None or cut_layers != self.cut_layers:
+                self.model = build_stage(model_name, data_name, cut_layers[0], cut_layers[1])
                 self.model.to(self.device)
+                self.cut_layers = cut_layers
+                self.global_model = None
+                self.frozen_uploaded = False
             batch_size = self.response["batch_size"]
             lr = self.response["lr"]
             momentum = self.response["momentum"]
             compute_loss = self.response["compute_loss"]
             control_count = self.response["control_count"]
+            micro_batch_timeout = self.response["micro_batch_timeout"]
+            max_retransmit = self.response["max_retransmit"]
+            routing = self.response["routing"]
+            next_clients = self.response["next_clients"]
+            batching = self.response["batching"]
+            peers = self.response["peers"]
+            network = self.response["network"]
+            optimizer_config = self.response["optimizer"]
+            optimizer_state = self.response["optimizer_state"]
+            if self.optimizers is None:
+                self.optimizers = src.Optimizer.OptimizerManager(optimizer_config["state"], optimizer_config["foreach"],
+                                                                 optimizer_config["fused"])
+
+            freeze = self.response["freeze"]
+            activation_cache = self.response["activation_cache"]
+            local_loss = self.response["local_loss"]
+            pipeline = self.response["pipeline"]
+            upstream_frozen = self.response["upstream_frozen"]
+            round_id = self.response["round"]
+            previous_clients = self.response["previous_clients"]
+            frozen = src.Freezing.frozen_keys(model_name, self.model.state_dict().keys(), cut_layers, freeze)
 
-            # Read parameters and load to model
+            # Read parameters and load to model, the server leaves out the frozen tensors we already hold
             if state_dict:
-                self.model.load_state_dict(state_dict)
-            if self.response["cluster"] is not None and compute_loss["mode"] != 'normal':
-                self.global_model = copy.copy(self.model)
+                self.model.load_state_dict(state_dict, strict=freeze is None)
+            if compute_loss["mode"] == 'ReBaFL':
+                # Frozen copy for the feature target, FedProx only needs the parameters
+                self.global_model = copy.deepcopy(self.model)
 
             # Start training
             if self.layer_id == 1:
@@ -150,40 +183,168 @@ class RpcClient:
                     selected_indices.extend(random.sample(self.label_to_indices[label], count))
 
                 subset = torch.utils.data.Subset(self.train_set, selected_indices)
+                if activation_cache["enable"] and frozen and cut_layers[1] != 0:
+                    random_transforms = src.Cache.stochastic_transforms(self.train_set)
+                    if random_transforms and activation_cache["drop-augmentation"]:
+                        src.Log.print_with_color(f"Activation cache: drop the augmentations {random_transforms}", "yellow")
+                        self.train_set.transform.transforms = [t for t in self.train_set.transform.transforms
+                                                               if type(t).__name__ not in random_transforms]
+                    elif random_transforms:
+                        # A cached activation would replay the same augmented sample every epoch
+                        src.Log.print_with_color(f"Activation cache disabled by the augmentations {random_transforms}", "yellow")
+                        activation_cache = None
+                    if activation_cache:
+                        subset = src.Cache.IndexedDataset(subset)
                 train_loader = torch.utils.data.DataLoader(subset, batch_size=batch_size, shuffle=True)
                 if cut_layers[1] != 0:
-                    result, size = self.train_func(self.model, self.global_model, self.label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, train_loader, self.cluster, special, alone_train=False)
+                    result, size = self.train_func(self.model, self.global_model, self.label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, train_loader, self.cluster, special, alone_train=False,
+                                                   micro_batch_timeout=micro_batch_timeout, max_retransmit=max_retransmit,
+                                                   routing=routing, next_clients=next_clients, batching=batching,
+                                                   peers=peers, network=network, optimizers=self.optimizers,
+                                                   optimizer_state=optimizer_state, frozen=frozen,
+                                                   activation_cache=activation_cache, local_loss=local_loss, pipeline=pipeline,
+                                                   round_id=round_id, upstream_frozen=upstream_frozen)
                 else:
-                    result, size = self.train_func(self.model, self.global_model, self.label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, train_loader, self.cluster, special, alone_train=True)
+                    result, size = self.train_func(self.model, self.global_model, self.label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, train_loader, self.cluster, special, alone_train=True,
+                                                   optimizers=self.optimizers, optimizer_state=optimizer_state, frozen=frozen)
             else:
-                result, size = self.train_func(self.model, self.global_model, self.label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, None, self.cluster, special)
+                result, size = self.train_func(self.model, self.global_model, self.label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, None, self.cluster, special,
+                                               micro_batch_timeout=micro_batch_timeout, routing=routing, next_clients=next_clients,
+                                               batching=batching, peers=peers, network=network, optimizers=self.optimizers,
+                                               optimizer_state=optimizer_state, frozen=frozen, local_loss=local_loss,
+                                               pipeline=pipeline, round_id=round_id, previous_clients=previous_clients,
+                                               upstream_frozen=upstream_frozen)
+
+            if not self.response["upload"]:
+                # Stage not aggregated this round, keep the model and only report the result
+                data = {"action": "UPDATE", "client_id": self.client_id, "layer_id": self.layer_id,
+                        "result": result, "size": size, "cluster": self.cluster,
+                        "message": "Sent result to Server", "parameters": None,
+                        "parameters_hashes": None, "optimizer_state": None, "chunks": None}
+                self.send_to_server(data)
+                return True
 
             # Stop training, then send parameters to server
             model_state_dict = self.model.state_dict()
             if self.device != "cpu":
                 for key in model_state_dict:
                     model_state_dict[key] = model_state_dict[key].to('cpu')
+            parameters_hashes = src.Utils.state_dict_hashes(model_state_dict)
+            for key, tensor_hash in parameters_hashes.items():
+                self.parameter_cache[tensor_hash] = model_state_dict[key].clone()
+            self.cached_uploaded = set(parameters_hashes.values())
+            self.prune_parameter_cache()
+            if frozen and self.frozen_uploaded:
+                # Hashes still cover the whole stage, so the server knows we hold the frozen tensors
+                model_state_dict = {key: value for key, value in model_state_dict.items() if key not in frozen}
+            self.frozen_uploaded = True
             data = {"action": "UPDATE", "client_id": self.client_id, "layer_id": self.layer_id,
                     "result": result, "size": size, "cluster": self.cluster,
-                    "message": "Sent parameters to Server", "parameters": model_state_dict}
+                    "message": "Sent parameters to Server", "parameters": model_state_dict,
+                    "parameters_hashes": parameters_hashes, "optimizer_state": self.optimizers.state(), "chunks": None}
+            queue = f'aggregate_queue_{self.cluster}' if self.response["aggregator"] else 'rpc_queue'
+            chunk_size = self.response["chunk_size"]
+            if chunk_size:
+                # Stream the tensors in blocks, the UPDATE itself only closes the transfer. All of them go
+                # through one channel, the broker keeps their order only within a channel
+                self.connect()
+                self.channel.queue_declare(queue, durable=False)
+                data["chunks"] = 0
+                for chunk in src.Stream.chunk_update(data["parameters"], data["optimizer_state"], chunk_size):
+                    self.channel.basic_publish(exchange='', routing_key=queue,
+                                               body=pickle.dumps(dict(chunk, action="UPDATE_CHUNK", client_id=self.client_id)))
+                    data["chunks"] = chunk["sequence"] + 1
+                data["parameters"] = None
+                data["optimizer_state"] = None
+                self.channel.basic_publish(exchange='', routing_key=queue, body=pickle.dumps(data))
+            else:
+                self.send_to_server(data, queue)
             src.Log.print_with_color("[>>>] Client sent parameters to server", "red")
-            self.send_to_server(data)
             return True
         elif action == "STOP":
             return False
 
-    def connect(self):
+    def load_parameters(self, parameters_ref, parameters_hashes):
+        """
+        Build the state dict announced by START from the local tensor cache, the broadcast blob and,
+        on a cache miss, a FETCH request to the server.
+        """
+        # Missing if the broadcast was lost, the tensors are then fetched
+        blob = self.parameters.pop(parameters_ref, None) if parameters_ref is not None else None
+        # Blobs this START does not refer to (another cluster or layer, an earlier round) are never used
+        self.parameters.clear()
+        if parameters_hashes is None:
+            return None
+        if blob is not None:
+            self.parameter_cache.update(pickle.loads(blob))
+
+        missing = [tensor_hash for tensor_hash in set(parameters_hashes.values()) if tensor_hash not in self.parameter_cache]
+        if missing:
+            src.Log.print_with_color(f"[>>>] Fetch {len(missing)} missing tensors from server", "red")
+            self.send_to_server({"action": "FETCH", "client_id": self.client_id, "layer_id": self.layer_id,
+                                 "hashes": missing})
+            reply_queue_name = f'reply_{self.client_id}'
+            held = []
+            while True:
+                method_frame, header_frame, body = self.channel.basic_get(queue=reply_queue_name, auto_ack=False)
+                if body:
+                    response = pickle.loads(body)
+                    if response["action"] == "PARAMETERS" and response["digest"] is None:
+                        self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+                        self.parameter_cache.update(pickle.loads(response["parameters"]))
+                        break
+                    # PAUSE, STOP or blocks of a download stay unacked (so not delivered again) until the reply is in
+                    held.append(method_frame.delivery_tag)
+                else:
+                    time.sleep(0.1)
+            for delivery_tag in held:
+                self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            if response["error"] is not None:
+                src.Log.print_with_color(f"[<<<] Cannot fetch the parameters ({response['error']}), keep the current ones", "yellow")
+                return None
+
+        self.cached_received = set(parameters_hashes.values())
+        state_dict = {key: self.parameter_cache[tensor_hash] for key, tensor_hash in parameters_hashes.items()}
+        self.prune_parameter_cache()
+        return state_dict
+
+    def prune_parameter_cache(self):
+        # Keep the tensors of the last uploaded and the last received state dict, the server assumes the same
+        keep = self.cached_uploaded | self.cached_received
+        self.parameter_cache = {tensor_hash: tensor for tensor_hash, tensor in self.parameter_cache.items() if tensor_hash in keep}
+
+    def start_heartbeat(self, interval):
+        """Tell the server this client is alive every `interval` seconds, from a thread with its own connection."""
+        def send_heartbeats():
+            connection = self.new_connection()
+            channel = connection.channel()
+            channel.queue_declare('rpc_queue', durable=False)
+            message = pickle.dumps({"action": "HEARTBEAT", "client_id": self.client_id, "layer_id": self.layer_id})
+            while True:
+                channel.basic_publish(exchange='', routing_key='rpc_queue', body=message)
+                connection.sleep(interval)
+
+        if interval:
+            threading.Thread(target=send_heartbeats, daemon=True).start()
+
+    def new_connection(self):
+        if self.connection_factory is not None:
+            # In-process simulation
+            return self.connection_factory()
         credentials = pika.PlainCredentials(self.username, self.password)
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.address, 5672, '/', credentials))
+        return pika.BlockingConnection(pika.ConnectionParameters(self.address, 5672, '/', credentials))
+
+    def connect(self):
+        self.connection = self.new_connection()
         self.channel = self.connection.channel()
 
-    def send_to_server(self, message):
+    def send_to_server(self, message, queue='rpc_queue'):
         self.connect()
         self.response = None
 
-        self.channel.queue_declare('rpc_queue', durable=False)
+        self.channel.queue_declare(queue, durable=False)
         self.channel.basic_publish(exchange='',
-                                   routing_key='rpc_queue',
+                                   routing_key=queue,
                                    body=pickle.dumps(message))
 
         return self.response
@@ -4,15 +4,22 @@ import pickle
 from tqdm import tqdm
 
 import torch
-import torch.optim as optim
-import torch.nn as nn
-import torch.nn.functional as f
 
+import src.Auxiliary
+import src.Cache
+import src.Freezing
 import src.Log
+import src.Loss
+import src.Optimizer
+import src.Routing
+import src.Stash
+import src.Transport
+
+END_DRAIN_TIMEOUT = 30  # seconds without data after PAUSE before giving up on missing end-of-round markers
 
 
 class Scheduler:
-    def __init__(self, client_id, layer_id, channel, device, event_time=False):
+    def __init__(self, client_id, layer_id, channel, device, event_time=False, transport=None):
         self.client_id = client_id
         self.layer_id = layer_id
         self.channel = channel
@@ -20,24 +27,43 @@ class Scheduler:
         self.data_count = 0
 
         self.event_time = event_time
+        self.timeouts = 0
+        self.retransmits = 0
+        self.router = None
+        self.optimizers = src.Optimizer.OptimizerManager(src.Optimizer.RESET)
+        self.optimizer_state = None
+        self.loss = None
+        self.freezer = None
+        self.activation_cache = None
+        self.cache_active = False
+        # Auxiliary head of the local loss mode, kept with the model it was built for
+        self.head = None
+        self.head_model = None
+        self.head_optimizers = src.Optimizer.OptimizerManager(src.Optimizer.KEEP)
+        self.stash = None
+        # Every stage before this one is frozen: no gradient crosses the input cut, and none comes back to a frozen stage
+        self.upstream_frozen = False
+        self.wait_gradients = True
+        # End-of-round markers of the local loss mode: run closed by every upstream client -> senders seen
+        self.round_id = None
+        self.next_clients = []
+        self.previous_clients = []
+        self.round_ends = {}
+        self.closed_rounds = set()
+        # Data plane (activations and gradients), RabbitMQ unless a direct transport is given
+        self.data_transport = transport if transport is not None else src.Transport.RabbitTransport(channel)
+        self.transport = src.Transport.BatchingTransport(self.data_transport)
+        self.emulation = None
         self.time_event_forward = []
         self.time_event_backward = []
 
-    def balanced_softmax_loss(self, logits, labels, class_counts, epsilon=1e-6):
-        class_counts = torch.tensor(class_counts, dtype=torch.int64).to(self.device)
-        log_probs = f.log_softmax(logits, dim=1)
-        class_probs = class_counts / (class_counts.sum() + epsilon)
-        weights = 1.0 / (class_probs + epsilon)
-        weights = weights / weights.sum()
-        loss = (-weights[labels] * log_probs[range(labels.shape[0]), labels]).mean()
-        return loss
-
     def send_intermediate_output(self, data_id, label_count, output, labels, trace, test=False, cluster=None, special=False):
-        if special is True:
+        if self.router is not None:
+            forward_queue_name = f'intermediate_queue_{self.layer_id}_{self.router.route(data_id)}'
+        elif special is True:
             forward_queue_name = f'intermediate_queue_{self.layer_id}'
         else:
             forward_queue_name = f'intermediate_queue_{self.layer_id}_{cluster}'
-        self.channel.queue_declare(forward_queue_name, durable=False)
 
         if trace:
             trace.append(self.client_id)
@@ -51,26 +77,62 @@ class Scheduler:
                  "test": test}
             )
 
-        self.channel.basic_publish(
-            exchange='',
-            routing_key=forward_queue_name,
-            body=message
-        )
+        self.transport.publish(forward_queue_name, message)
 
     def send_gradient(self, data_id, gradient, trace):
         to_client_id = trace[-1]
         trace.pop(-1)
         backward_queue_name = f'gradient_queue_{self.layer_id - 1}_{to_client_id}'
-        self.channel.queue_declare(queue=backward_queue_name, durable=False)
 
         message = pickle.dumps(
             {"data_id": data_id, "data": gradient.detach().cpu().numpy(), "trace": trace, "test": False})
 
-        self.channel.basic_publish(
-            exchange='',
-            routing_key=backward_queue_name,
-            body=message
-        )
+        self.transport.publish(backward_queue_name, message)
+
+    def send_end_of_round(self, round_id, cluster=None, special=False):
+        """Close a run on every downstream client, the marker follows the last micro-batch sent to it."""
+        for target in self.next_clients:
+            if self.router is not None:
+                forward_queue_name = f'intermediate_queue_{self.layer_id}_{target}'
+            elif special is True:
+                forward_queue_name = f'intermediate_queue_{self.layer_id}'
+            else:
+                forward_queue_name = f'intermediate_queue_{self.layer_id}_{cluster}'
+            self.transport.publish(forward_queue_name, pickle.dumps({"end": round_id, "sender": str(self.client_id), "to": target}))
+        self.transport.flush(force=True)
+
+    def receive_end_of_round(self, marker, forward_queue_name):
+        """Count an end-of-round marker, return its run once every upstream client closed it."""
+        if marker["to"] != str(self.client_id):
+            # Taken from a shared queue by the wrong consumer, put it back
+            self.transport.publish(forward_queue_name, pickle.dumps(marker))
+            self.transport.flush(force=True)
+            return None
+        round_id = tuple(marker["end"])
+        senders = self.round_ends.setdefault(round_id, set())
+        senders.add(marker["sender"])
+        if not senders.issuperset(self.previous_clients):
+            return None
+        self.round_ends.pop(round_id)
+        self.closed_rounds.add(round_id)
+        return round_id
+
+    def drain_round(self, pause):
+        """Run a PAUSE waits for: its queue is drained once the markers of that run arrived, None if there is none."""
+        if pause.get("round") is None or not self.previous_clients:
+            return None
+        round_id = tuple(pause["round"])
+        return None if round_id in self.closed_rounds else round_id
+
+    def drained(self, draining, last_data):
+        """The run a PAUSE waits for is closed, or no data came for END_DRAIN_TIMEOUT seconds."""
+        if draining in self.closed_rounds:
+            return True
+        if time.time() - last_data <= END_DRAIN_TIMEOUT:
+            return False
+        missing = sorted(set(self.previous_clients) - self.round_ends.get(draining, set()))
+        src.Log.print_with_color(f"No end-of-round marker from {missing} after {END_DRAIN_TIMEOUT}s, stop draining", "yellow")
+        return True
 
     def send_to_server(self, message):
         self.channel.queue_declare('rpc_queue', durable=False)
@@ -79,55 +141,90 @@ class Scheduler:
                                    body=pickle.dumps(message))
 
     def train_on_first_layer(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, control_count=5,
-                             train_loader=None, cluster=None, special=False):
-        optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
+                             train_loader=None, cluster=None, special=False, micro_batch_timeout=0, max_retransmit=0):
+        optimizer = self.optimizers.get(model, lr, momentum, self.device, self.optimizer_state)
         data_iter = iter(train_loader)
 
         backward_queue_name = f'gradient_queue_{self.layer_id}_{self.client_id}'
+        broadcast_queue_name = f'reply_{self.client_id}'
         self.channel.queue_declare(queue=backward_queue_name, durable=False)
         self.channel.basic_qos(prefetch_count=10)
         num_forward = 0
         num_backward = 0
         end_data = False
+        paused = False
+        last_check = time.time()
         data_store = {}
+        in_flight = {}  # data_id -> [sent time, retransmits, labels]
 
         model.to(self.device)
         with tqdm(total=len(train_loader), desc="Processing", unit="step") as pbar:
             while True:
                 # Training model
-                model.train()
+                self.freezer.train()
                 optimizer.zero_grad()
+                self.transport.flush()
                 # Process gradient
-                method_frame, header_frame, body = self.channel.basic_get(queue=backward_queue_name, auto_ack=True)
-                if method_frame and body:
+                body = self.transport.get(backward_queue_name)
+                if body:
+                    received_data = pickle.loads(body)
+                    data_id = received_data["data_id"]
+                    if data_id not in data_store:
+                        # Gradient of a dropped or already answered micro-batch
+                        continue
                     if self.event_time:
                         self.time_event_backward.append(time.time())
                     num_backward += 1
-                    received_data = pickle.loads(body)
                     gradient_numpy = received_data["data"]
                     gradient = torch.tensor(gradient_numpy).to(self.device)
-                    data_id = received_data["data_id"]
 
                     data_input = data_store.pop(data_id)
-                    output = model(data_input)
-                    output.backward(gradient=gradient)
-                    optimizer.step()
+                    in_flight.pop(data_id)
+                    if self.router is not None:
+                        self.router.answered(data_id)
+                    if self.stash is not None:
+                        # Backward through the weights this micro-batch was forwarded with
+                        applied, _ = self.stash.backward(data_id, data_input, gradient)
+                        if applied:
+                            optimizer.step()
+                            self.stash.step()
+                    elif not self.freezer.all_frozen:
+                        output = self.freezer.forward(data_input)
+                        output.backward(gradient=gradient)
+                        optimizer.step()
                     if self.event_time:
                         self.time_event_backward.append(time.time())
                 else:
+                    now = time.time()
+                    if micro_batch_timeout:
+                        num_backward += self.check_in_flight(model, data_store, in_flight, label_count, micro_batch_timeout,
+                                                             max_retransmit, cluster, special)
+                    # Server may stop a straggler before the end of its data
+                    if not paused and now - last_check > 1.0:
+                        last_check = now
+                        method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
+                        if body and pickle.loads(body)["action"] == "PAUSE":
+                            src.Log.print_with_color("[<<<] Paused by server before the end of data", "yellow")
+                            paused = True
+                            end_data = True
                     # speed control
                     if len(data_store) > control_count:
                         continue
                     # Process forward message
                     try:
-                        training_data, labels = next(data_iter)
+                        if paused:
+                            raise StopIteration
+                        batch = next(data_iter)
+                        training_data, labels = batch[0], batch[1]
                         if self.event_time:
                             self.time_event_forward.append(time.time())
-                        training_data = training_data.to(self.device)
                         data_id = uuid.uuid4()
-                        data_store[data_id] = training_data
-                        intermediate_output = model(training_data)
+                        # Output of the frozen prefix, the backward only recomputes the layers that train
+                        data_store[data_id] = self.prefix_output(training_data, batch[2] if len(batch) > 2 else None)
+                        intermediate_output = self.freezer.forward(data_store[data_id])
                         intermediate_output = intermediate_output.detach().requires_grad_(True)
+                        if self.stash is not None:
+                            self.stash.forward(data_id)
                         if self.event_time:
                             self.time_event_forward.append(time.time())
 
@@ -138,6 +235,14 @@ class Scheduler:
                         pbar.update(1)
 
                         self.send_intermediate_output(data_id, label_count, intermediate_output, labels, trace=None, test=False, cluster=cluster, special=special)
+                        if self.wait_gradients:
+                            in_flight[data_id] = [time.time(), 0, labels]
+                        else:
+                            # A frozen stage gets no gradient back, the micro-batch is done once sent
+                            data_store.pop(data_id)
+                            num_backward += 1
+                            if self.router is not None and data_id in self.router.in_flight:
+                                self.router.forget(data_id)
 
                     except StopIteration:
                         end_data = True
@@ -145,13 +250,17 @@ class Scheduler:
                     break
 
             notify_data = {"action": "NOTIFY", "client_id": self.client_id, "layer_id": self.layer_id,
-                           "message": "Finish training!", "cluster": cluster}
+                           "message": "Finish training!", "cluster": cluster, "paused": paused,
+                           "timeouts": self.timeouts, "retransmits": self.retransmits,
+                           "routing": self.router.stats() if self.router else None}
 
         # Finish epoch training, send notify to server
         src.Log.print_with_color("[>>>] Finish training!", "red")
+        self.transport.flush(force=True)
         self.send_to_server(notify_data)
+        if paused:
+            return True
 
-        broadcast_queue_name = f'reply_{self.client_id}'
         while True:  # Wait for broadcast
             method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
             if body:
@@ -161,12 +270,199 @@ class Scheduler:
                     return True
             time.sleep(0.5)
 
-    def train_on_last_layer(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, cluster, special=False):
-        optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
+    def local_step(self, model, output, labels, label_count, lr, momentum, clip_grad_norm, optimizer):
+        """Train the stage on the loss of its auxiliary head, nothing comes back from downstream."""
+        if self.head is None or self.head_model is not model:
+            self.head = src.Auxiliary.AuxiliaryHead(output, len(label_count)).to(self.device)
+            self.head_model = model
+        head_optimizer = self.head_optimizers.get(self.head, lr, momentum, self.device)
+        head_optimizer.zero_grad()
+        loss = self.loss(self.head(output), labels, label_count)
+        if torch.isnan(loss).any():
+            src.Log.print_with_color("NaN detected in loss", "yellow")
+            return False
+        loss.backward()
+        if clip_grad_norm and clip_grad_norm > 0:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm)
+        optimizer.step()
+        head_optimizer.step()
+        return True
+
+    def train_on_first_layer_local(self, model, label_count, lr, momentum, clip_grad_norm, train_loader=None, cluster=None,
+                                   special=False):
+        optimizer = self.optimizers.get(model, lr, momentum, self.device, self.optimizer_state)
+        broadcast_queue_name = f'reply_{self.client_id}'
         result = True
+        paused = False
+        last_check = time.time()
 
-        criterion = nn.CrossEntropyLoss()
-        if special:
+        model.to(self.device)
+        for batch in tqdm(train_loader, desc="Processing", unit="step"):
+            # Server may stop a straggler before the end of its data
+            now = time.time()
+            if now - last_check > 1.0:
+                last_check = now
+                method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
+                if body and pickle.loads(body)["action"] == "PAUSE":
+                    src.Log.print_with_color("[<<<] Paused by server before the end of data", "yellow")
+                    paused = True
+                    break
+            training_data, labels = batch[0], batch[1]
+            if self.event_time:
+                self.time_event_forward.append(time.time())
+            self.freezer.train()
+            optimizer.zero_grad()
+            output = self.freezer.forward(self.prefix_output(training_data, batch[2] if len(batch) > 2 else None))
+            if not self.freezer.all_frozen:
+                result = self.local_step(model, output, labels.to(self.device), label_count, lr, momentum, clip_grad_norm,
+                                         optimizer) and result
+            if self.event_time:
+                self.time_event_forward.append(time.time())
+
+            data_id = uuid.uuid4()
+            self.send_intermediate_output(data_id, label_count, output, labels, trace=None, test=False, cluster=cluster, special=special)
+            if self.router is not None:
+                # No gradient will answer it
+                self.router.forget(data_id)
+            self.data_count += 1
+            self.transport.flush()
+
+        notify_data = {"action": "NOTIFY", "client_id": self.client_id, "layer_id": self.layer_id,
+                       "message": "Finish training!", "cluster": cluster, "paused": paused,
+                       "timeouts": 0, "retransmits": 0, "routing": self.router.stats() if self.router else None}
+        src.Log.print_with_color("[>>>] Finish training!", "red")
+        self.transport.flush(force=True)
+        if self.round_id is not None:
+            self.send_end_of_round(self.round_id, cluster, special)
+        self.send_to_server(notify_data)
+        if paused:
+            return result
+
+        while True:  # Wait for broadcast
+            method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
+            if body:
+                received_data = pickle.loads(body)
+                src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
+                if received_data["action"] == "PAUSE":
+                    return result
+            time.sleep(0.5)
+
+    def train_on_middle_layer_local(self, model, lr, momentum, clip_grad_norm, cluster=None, special=False, routed=False):
+        optimizer = self.optimizers.get(model, lr, momentum, self.device, self.optimizer_state)
+        result = True
+
+        if routed:
+            forward_queue_name = f'intermediate_queue_{self.layer_id - 1}_{self.client_id}'
+        else:
+            forward_queue_name = f'intermediate_queue_{self.layer_id - 1}'
+        self.channel.queue_declare(queue=forward_queue_name, durable=False)
+        self.channel.basic_qos(prefetch_count=10)
+        print('Waiting for intermediate output. To exit press CTRL+C')
+        model.to(self.device)
+        draining = None
+        last_data = time.time()
+        while True:
+            if draining is not None and self.drained(draining, last_data):
+                self.transport.flush(force=True)
+                return result
+            self.transport.flush()
+            body = self.transport.get(forward_queue_name)
+            if body:
+                last_data = time.time()
+                received_data = pickle.loads(body)
+                if "end" in received_data:
+                    round_id = self.receive_end_of_round(received_data, forward_queue_name)
+                    if round_id is not None:
+                        # Everything upstream of this run went through us, close it downstream too
+                        self.send_end_of_round(list(round_id), cluster, special)
+                    continue
+                if self.event_time:
+                    self.time_event_forward.append(time.time())
+                data_id = received_data["data_id"]
+                labels = received_data["label"].to(self.device)
+                label_count = received_data["label_count"]
+
+                self.freezer.train()
+                optimizer.zero_grad()
+                output = self.freezer.forward(torch.tensor(received_data["data"]).to(self.device))
+                if not self.freezer.all_frozen:
+                    result = self.local_step(model, output, labels, label_count, lr, momentum, clip_grad_norm, optimizer) and result
+                self.data_count += 1
+                if self.event_time:
+                    self.time_event_forward.append(time.time())
+                self.send_intermediate_output(data_id, label_count, output, received_data["label"], received_data["trace"],
+                                              received_data["test"], cluster=cluster, special=special)
+                if self.router is not None:
+                    self.router.forget(data_id)
+            else:
+                # Check training process
+                broadcast_queue_name = f'reply_{self.client_id}'
+                method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
+                if body:
+                    received_data = pickle.loads(body)
+                    src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
+                    if received_data["action"] == "PAUSE":
+                        self.transport.flush(force=True)
+                        draining = self.drain_round(received_data)
+                        if draining is None:
+                            return result
+                        last_data = time.time()
+
+    def prefix_output(self, training_data, indices):
+        if not self.cache_active or indices is None:
+            return self.freezer.prefix_forward(training_data.to(self.device))
+        cached, hit, missing = self.activation_cache.get(indices, self.device)
+        if not missing:
+            return cached
+        # The frozen prefix is in eval mode, the output of a sample does not depend on the rest of its batch
+        computed = self.freezer.prefix_forward(training_data[missing].to(self.device))
+        self.activation_cache.put([indices[position] for position in missing], computed)
+        if not hit:
+            return computed
+        output = torch.empty((len(hit) + len(missing),) + tuple(computed.shape[1:]), dtype=computed.dtype, device=computed.device)
+        output[hit] = cached.to(computed.dtype)
+        output[missing] = computed
+        return output
+
+    def check_in_flight(self, model, data_store, in_flight, label_count, micro_batch_timeout, max_retransmit, cluster, special):
+        """
+        Retransmit the micro-batches whose gradient did not come back in time, drop them after
+        `max_retransmit` attempts. Return the number of dropped micro-batches.
+        """
+        dropped = 0
+        now = time.time()
+        for data_id, (sent_time, retransmits, labels) in list(in_flight.items()):
+            if now - sent_time < micro_batch_timeout:
+                continue
+            if retransmits < max_retransmit:
+                with torch.no_grad():
+                    intermediate_output = self.freezer.forward(data_store[data_id])
+                self.send_intermediate_output(data_id, label_count, intermediate_output, labels, trace=None, test=False, cluster=cluster, special=special)
+                if self.stash is not None:
+                    # The retransmitted activation comes from the current weights
+                    self.stash.forward(data_id)
+                in_flight[data_id] = [now, retransmits + 1, labels]
+                self.retransmits += 1
+            else:
+                src.Log.print_with_color(f"Drop micro-batch {data_id}, no gradient after {retransmits} retransmits", "yellow")
+                data_store.pop(data_id)
+                in_flight.pop(data_id)
+                if self.stash is not None:
+                    self.stash.forget(data_id)
+                if self.router is not None:
+                    self.router.forget(data_id)
+                self.timeouts += 1
+                dropped += 1
+        return dropped
+
+    def train_on_last_layer(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, cluster, special=False,
+                            routed=False, send_gradients=True):
+        optimizer = self.optimizers.get(model, lr, momentum, self.device, self.optimizer_state)
+        result = True
+
+        if routed:
+            forward_queue_name = f'intermediate_queue_{self.layer_id - 1}_{self.client_id}'
+        elif special:
             forward_queue_name = f'intermediate_queue_{self.layer_id - 1}'
         else:
             forward_queue_name = f'intermediate_queue_{self.layer_id - 1}_{cluster}'
@@ -174,42 +470,37 @@ class Scheduler:
         self.channel.basic_qos(prefetch_count=10)
         print('Waiting for intermediate output. To exit press CTRL+C')
         model.to(self.device)
+        draining = None
+        last_data = time.time()
         while True:
+            if draining is not None and self.drained(draining, last_data):
+                self.transport.flush(force=True)
+                return result
             # Training model
-            model.train()
+            self.freezer.train()
             optimizer.zero_grad()
+            self.transport.flush()
             # Process gradient
-            method_frame, header_frame, body = self.channel.basic_get(queue=forward_queue_name, auto_ack=True)
-            if method_frame and body:
+            body = self.transport.get(forward_queue_name)
+            if body:
+                last_data = time.time()
+                received_data = pickle.loads(body)
+                if "end" in received_data:
+                    self.receive_end_of_round(received_data, forward_queue_name)
+                    continue
                 if self.event_time:
                     self.time_event_forward.append(time.time())
-                received_data = pickle.loads(body)
                 intermediate_output_numpy = received_data["data"]
                 trace = received_data["trace"]
                 data_id = received_data["data_id"]
                 labels = received_data["label"].to(self.device)
                 label_count = received_data["label_count"]
 
-                intermediate_output = torch.tensor(intermediate_output_numpy, requires_grad=True).to(self.device)
+                intermediate_output = torch.tensor(intermediate_output_numpy, requires_grad=send_gradients).to(self.device)
 
                 output = model(intermediate_output)
 
-                # choose loss mode
-                if compute_loss["mode"] == 'FedProx':
-                    loss = criterion(output, labels)
-                    prox_term = 0.0
-                    for param, global_param in zip(model.parameters(), global_model.parameters()):
-                        prox_term += torch.norm(param - global_param, p=2)
-                    loss += (compute_loss["FedProx"]["mu"] / 2) * prox_term
-                elif compute_loss["mode"] == 'ReBaFL':
-                    loss = self.balanced_softmax_loss(output, labels, label_count)
-                    prox_term = sum(torch.norm(param - global_param, p=2) for param, global_param in
-                                    zip(model.parameters(), global_model.parameters()))
-                    loss += (compute_loss["ReBaFL"]["mu"] / 2) * prox_term
-                    feature_aug_loss = compute_loss["ReBaFL"]["lambda_aug"] * torch.norm(output.mean(dim=0) - global_model(intermediate_output).mean(dim=0), p=2)
-                    loss += feature_aug_loss
-                else:
-                    loss = criterion(output, labels)
+                loss = self.loss(output, labels, label_count, intermediate_output)
                 print(f"Loss: {loss.item()}")
                 if torch.isnan(loss).any():
                     src.Log.print_with_color("NaN detected in loss", "yellow")
@@ -218,17 +509,18 @@ class Scheduler:
                 if self.event_time:
                     self.time_event_forward.append(time.time())
                     self.time_event_backward.append(time.time())
-                intermediate_output.retain_grad()
+                if send_gradients:
+                    intermediate_output.retain_grad()
                 loss.backward()
                 if clip_grad_norm and clip_grad_norm > 0:
                     torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm)
                 optimizer.step()
                 self.data_count += 1
 
-                gradient = intermediate_output.grad
                 if self.event_time:
                     self.time_event_backward.append(time.time())
-                self.send_gradient(data_id, gradient, trace)  # 1F1B
+                if send_gradients:
+                    self.send_gradient(data_id, intermediate_output.grad, trace)  # 1F1B
             # Check training process
             else:
                 broadcast_queue_name = f'reply_{self.client_id}'
@@ -237,47 +529,81 @@ class Scheduler:
                     received_data = pickle.loads(body)
                     src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
                     if received_data["action"] == "PAUSE":
-                        return result
-
-    def train_on_middle_layer(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, control_count=5, cluster=None, special=False):
-        optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
-
-        forward_queue_name = f'intermediate_queue_{self.layer_id - 1}'
+                        self.transport.flush(force=True)
+                        draining = self.drain_round(received_data)
+                        if draining is None:
+                            return result
+                        last_data = time.time()
+
+    def train_on_middle_layer(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, control_count=5, cluster=None, special=False,
+                              micro_batch_timeout=0, routed=False):
+        optimizer = self.optimizers.get(model, lr, momentum, self.device, self.optimizer_state)
+
+        if routed:
+            forward_queue_name = f'intermediate_queue_{self.layer_id - 1}_{self.client_id}'
+        else:
+            forward_queue_name = f'intermediate_queue_{self.layer_id - 1}'
         backward_queue_name = f'gradient_queue_{self.layer_id}_{self.client_id}'
         self.channel.queue_declare(queue=forward_queue_name, durable=False)
         self.channel.queue_declare(queue=backward_queue_name, durable=False)
         self.channel.basic_qos(prefetch_count=10)
         data_store = {}
+        store_time = {}
         print('Waiting for intermediate output. To exit press CTRL+C')
         model.to(self.device)
         while True:
             # Training model
-            model.train()
+            self.freezer.train()
             optimizer.zero_grad()
+            if micro_batch_timeout:
+                # The first layer retransmits or drops these micro-batches, forget them
+                now = time.time()
+                for data_id in [data_id for data_id, stored in store_time.items() if now - stored > micro_batch_timeout]:
+                    data_store.pop(data_id)
+                    store_time.pop(data_id)
+                    if self.stash is not None:
+                        self.stash.forget(data_id)
+                    if self.router is not None and data_id in self.router.in_flight:
+                        self.router.forget(data_id)
+                    self.timeouts += 1
+            self.transport.flush()
             # Process gradient
-            method_frame, header_frame, body = self.channel.basic_get(queue=backward_queue_name, auto_ack=True)
-            if method_frame and body:
+            body = self.transport.get(backward_queue_name)
+            if body:
+                received_data = pickle.loads(body)
+                if received_data["data_id"] not in data_store:
+                    # Gradient of an expired micro-batch
+                    continue
                 if self.event_time:
                     self.time_event_backward.append(time.time())
-                received_data = pickle.loads(body)
                 gradient_numpy = received_data["data"]
                 gradient = torch.tensor(gradient_numpy).to(self.device)
                 trace = received_data["trace"]
                 data_id = received_data["data_id"]
 
                 data_input = data_store.pop(data_id)
-                output = model(data_input)
-                data_input.retain_grad()
-                output.backward(gradient=gradient, retain_graph=True)
-                optimizer.step()
-
-                gradient = data_input.grad
+                store_time.pop(data_id, None)
+                if self.router is not None:
+                    self.router.answered(data_id)
+                if self.stash is not None:
+                    applied, gradient = self.stash.backward(data_id, data_input, gradient, input_grad=not self.upstream_frozen)
+                    if applied:
+                        optimizer.step()
+                        self.stash.step()
+                else:
+                    output = model(data_input)
+                    if not self.upstream_frozen:
+                        data_input.retain_grad()
+                    output.backward(gradient=gradient, retain_graph=True)
+                    optimizer.step()
+                    gradient = data_input.grad
                 if self.event_time:
                     self.time_event_backward.append(time.time())
-                self.send_gradient(data_id, gradient, trace)
+                if not self.upstream_frozen:
+                    self.send_gradient(data_id, gradient, trace)
             else:
-                method_frame, header_frame, body = self.channel.basic_get(queue=forward_queue_name, auto_ack=True)
-                if method_frame and body:
+                body = self.transport.get(forward_queue_name)
+                if body:
                     if self.event_time:
                         self.time_event_forward.append(time.time())
                     received_data = pickle.loads(body)
@@ -288,67 +614,61 @@ class Scheduler:
                     labels = received_data["label"].to(self.device)
                     label_count = received_data["label_count"]
 
-                    intermediate_output = torch.tensor(intermediate_output_numpy, requires_grad=True).to(self.device)
-                    data_store[data_id] = intermediate_output
+                    # The stages before are frozen, they are not sent a gradient of this input
+                    intermediate_output = torch.tensor(intermediate_output_numpy, requires_grad=not self.upstream_frozen).to(self.device)
+                    if self.wait_gradients:
+                        data_store[data_id] = intermediate_output
+                        store_time[data_id] = time.time()
 
                     output = model(intermediate_output)
                     output = output.detach().requires_grad_(True)
+                    if self.stash is not None:
+                        self.stash.forward(data_id)
 
                     self.data_count += 1
                     if self.event_time:
                         self.time_event_forward.append(time.time())
                     self.send_intermediate_output(data_id, label_count, output, labels, trace, test, cluster=cluster, special=special)
+                    if not self.wait_gradients and self.router is not None and data_id in self.router.in_flight:
+                        self.router.forget(data_id)
                     # speed control
                     if len(data_store) > control_count:
                         continue
             # Check training process
-            if method_frame is None:
+            if body is None:
                 broadcast_queue_name = f'reply_{self.client_id}'
                 method_frame, header_frame, body = self.channel.basic_get(queue=broadcast_queue_name, auto_ack=True)
                 if body:
                     received_data = pickle.loads(body)
                     src.Log.print_with_color(f"[<<<] Received message from server {received_data}", "blue")
                     if received_data["action"] == "PAUSE":
+                        self.transport.flush(force=True)
                         return True
 
     def alone_training(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, train_loader=None, cluster=None):
-        optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
-        criterion = nn.CrossEntropyLoss()
+        optimizer = self.optimizers.get(model, lr, momentum, self.device, self.optimizer_state)
         print('Waiting for training. To exit press CTRL+C')
         for training_data, labels in tqdm(train_loader):
-            model.train()
+            self.freezer.train()
             optimizer.zero_grad()
             training_data = training_data.to(self.device)
             labels = labels.to(self.device)
             output = model(training_data)
 
-            if compute_loss["mode"] == 'FedProx':
-                loss = criterion(output, labels)
-                prox_term = 0.0
-                for param, global_param in zip(model.parameters(), global_model.parameters()):
-                    prox_term += torch.norm(param - global_param, p=2)
-                loss += (compute_loss["FedProx"]["mu"] / 2) * prox_term
-            elif compute_loss["mode"] == 'ReBaFL':
-                loss = self.balanced_softmax_loss(output, labels, label_count)
-                prox_term = sum(torch.norm(param - global_param, p=2) for param, global_param in
-                                zip(model.parameters(), global_model.parameters()))
-                loss += (compute_loss["ReBaFL"]["mu"] / 2) * prox_term
-                feature_aug_loss = compute_loss["ReBaFL"]["lambda_aug"] * torch.norm(
-                    output.mean(dim=0) - global_model(training_data).mean(dim=0), p=2)
-                loss += feature_aug_loss
-            else:
-                loss = criterion(output, labels)
+            loss = self.loss(output, labels, label_count, training_data)
             if torch.isnan(loss).any():
                 src.Log.print_with_color("NaN detected in loss", "yellow")
                 result = False
-            loss.backward()
-            if clip_grad_norm and clip_grad_norm > 0:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm)
-            optimizer.step()
+            if not self.freezer.all_frozen:
+                loss.backward()
+                if clip_grad_norm and clip_grad_norm > 0:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm)
+                optimizer.step()
             self.data_count += 1
 
         notify_data = {"action": "NOTIFY", "client_id": self.client_id, "layer_id": self.layer_id,
-                       "message": "Finish training!", "cluster": cluster}
+                       "message": "Finish training!", "cluster": cluster, "paused": False,
+                       "timeouts": 0, "retransmits": 0, "routing": None}
         src.Log.print_with_color("[>>>] Finish training!", "red")
         self.send_to_server(notify_data)
 
@@ -362,17 +682,89 @@ class Scheduler:
                     return True
             time.sleep(0.5)
 
-    def train_on_device(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, train_loader=None, cluster=None, special=False, alone_train=False):
+    def train_on_device(self, model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, num_layers, control_count, train_loader=None, cluster=None, special=False, alone_train=False,
+                        micro_batch_timeout=0, max_retransmit=0, routing=src.Routing.SHARED, next_clients=None, batching=None,
+                        peers=None, network=None, optimizers=None, optimizer_state=None, frozen=None, activation_cache=None,
+                        local_loss=False, pipeline=None, round_id=None, previous_clients=None, upstream_frozen=False):
         self.data_count = 0
+        if optimizers is not None:
+            # Owned by the client, it outlives the rounds together with the model
+            self.optimizers = optimizers
+        self.optimizer_state = optimizer_state
+        # Snapshot of the parameters received for this round, the reference of the proximal terms
+        model.to(self.device)
+        # Before the optimizer and the loss, frozen parameters are left out of both
+        self.freezer = src.Freezing.Freezer(model, frozen or ())
+        self.upstream_frozen = upstream_frozen
+        self.wait_gradients = not (upstream_frozen and self.freezer.all_frozen)
+        self.cache_active = bool(activation_cache and activation_cache["enable"]) and self.layer_id == 1 \
+            and self.freezer.prefix is not None
+        # Weight stashing of the stages that wait for gradients, they may then keep more micro-batches in flight
+        self.stash = None
+        if pipeline and pipeline["weight-stashing"] and not local_loss and not alone_train and self.layer_id != num_layers \
+                and not self.freezer.all_frozen:
+            self.stash = src.Stash.WeightStash(self.freezer.rest if self.layer_id == 1 else model, pipeline["max-staleness"])
+            control_count = pipeline["max-in-flight"]
+        if self.cache_active:
+            if self.activation_cache is None:
+                self.activation_cache = src.Cache.ActivationCache(activation_cache["dtype"], activation_cache["max-bytes"],
+                                                                  activation_cache["path"], f"activations_{self.client_id}")
+            # Rows of other frozen parameters are dropped
+            self.activation_cache.reset(src.Cache.version({key: value for key, value in model.state_dict().items()
+                                                           if key in self.freezer.frozen}))
+        # Auxiliary heads of the local loss mode output logits, not the features of the global model
+        local_head = local_loss and self.layer_id != num_layers and not alone_train
+        self.loss = src.Loss.RegularizedLoss(compute_loss, model, None if local_head else global_model, self.device)
+        data_transport = self.data_transport
+        if network and network["enable"]:
+            # Kept across rounds so the random loss and jitter sequence of a seed is reproducible
+            if self.emulation is None:
+                self.emulation = src.Transport.EmulatedTransport(self.data_transport, network["links"],
+                                                                 f'{network["seed"]}-{self.layer_id}-{self.client_id}')
+            data_transport = self.emulation
+        if batching:
+            self.transport = src.Transport.BatchingTransport(data_transport, batching["max-messages"], batching["max-bytes"],
+                                                             batching["max-delay"])
+        else:
+            self.transport = src.Transport.BatchingTransport(data_transport)
+        if peers:
+            self.transport.set_peers(peers)
+        self.timeouts = 0
+        self.retransmits = 0
+        routed = routing != src.Routing.SHARED
+        # Only the local loss closes its runs with markers, the other modes are closed by the gradients
+        self.round_id = round_id if local_loss else None
+        self.next_clients = [str(client_id) for client_id in next_clients or []]
+        self.previous_clients = [str(client_id) for client_id in previous_clients or []] if local_loss else []
+        self.round_ends = {}
+        self.closed_rounds = set()
+        # Clients of the previous layer route to us, we route to the next layer
+        self.router = src.Routing.Router(routing, next_clients) if routed and next_clients else None
         if self.layer_id == 1:
-            if alone_train is False:
-                result = self.train_on_first_layer(model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, control_count, train_loader, cluster, special)
+            if alone_train is False and local_loss:
+                result = self.train_on_first_layer_local(model, label_count, lr, momentum, clip_grad_norm, train_loader, cluster, special)
+            elif alone_train is False:
+                result = self.train_on_first_layer(model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, control_count, train_loader, cluster, special,
+                                                   micro_batch_timeout, max_retransmit)
             else:
                 result = self.alone_training(model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, train_loader=train_loader, cluster=cluster)
         elif self.layer_id == num_layers:
-            result = self.train_on_last_layer(model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, cluster=cluster, special=special)
+            result = self.train_on_last_layer(model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, cluster=cluster, special=special,
+                                              routed=routed, send_gradients=not local_loss and not upstream_frozen)
+        elif local_loss:
+            result = self.train_on_middle_layer_local(model, lr, momentum, clip_grad_norm, cluster=cluster, special=special, routed=routed)
         else:
-            result = self.train_on_middle_layer(model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, control_count, cluster=cluster, special=special)
+            result = self.train_on_middle_layer(model, global_model, label_count, lr, momentum, clip_grad_norm, compute_loss, control_count, cluster=cluster, special=special,
+                                                micro_batch_timeout=micro_batch_timeout, routed=routed)
+        if self.router is not None:
+            src.Log.print_with_color(f"Routing ({routing}) to next layer: {self.router.stats()}", "yellow")
+        src.Log.print_with_color(f"Transport: {self.transport.stats()}", "yellow")
+        if self.emulation is not None:
+            src.Log.print_with_color(f"Network emulation: {self.emulation.stats()}", "yellow")
+        if self.cache_active:
+            src.Log.print_with_color(f"Activation cache: {self.activation_cache.stats()}", "yellow")
+        if self.stash is not None:
+            src.Log.print_with_color(f"Weight stashing: {self.stash.stats()}", "yellow")
         if self.event_time:
             src.Log.print_with_color(f"Forward training time events {self.time_event_forward}", "yellow")
             src.Log.print_with_color(f"Backward Training time events {self.time_event_backward}", "yellow")
@@ -1,20 +1,32 @@
-import os
+import uuid
 import random
 import pika
 import pickle
+import hashlib
 import sys
 import numpy as np
 import copy
+import time
+import math
+import functools
 import src.Model
+import src.Checkpoint
 import src.Log
 import src.Utils
 import src.Validation
+import src.Round
+import src.Aggregation
+import src.Freezing
+import src.Optimizer
+import src.Stream
+
+from concurrent.futures import ThreadPoolExecutor
 
 from src.Cluster import clustering_algorithm
 from src.model import *
 
 class Server:
-    def __init__(self, config):
+    def __init__(self, config, connection_factory=None):
         # RabbitMQ
         address = config["rabbit"]["address"]
         username = config["rabbit"]["username"]
@@ -31,6 +43,15 @@ class Server:
         self.round = self.global_round
         self.save_parameters = config["server"]["parameters"]["save"]
         self.load_parameters = config["server"]["parameters"]["load"]
+        self.chunk_size = config["server"]["parameters"]["chunk-size"]
+        self.uploads = src.Stream.Uploads()  # chunked UPDATEs per client
+        self.checkpoint = None
+        self.checkpoint_round = 0  # last round saved by earlier runs, checkpoint ids keep growing after a resume
+        if self.save_parameters or self.load_parameters:
+            self.checkpoint = src.Checkpoint.CheckpointStore(f'{self.model_name}_{self.data_name}', self.model_name,
+                                                             config["server"]["parameters"]["keep-rounds"],
+                                                             legacy_file=f'{self.model_name}_{self.data_name}.pth')
+            self.checkpoint_round = self.checkpoint.latest_round() or 0
         self.validation = config["server"]["validation"]
 
         # Clients
@@ -40,6 +61,10 @@ class Server:
         self.control_count = config["learning"]["control-count"]
         self.clip_grad_norm = config["learning"]["clip-grad-norm"]
         self.compute_loss = config["learning"]["compute-loss"]
+        self.freeze_schedule = config["learning"]["freeze"]
+        self.activation_cache = config["learning"]["activation-cache"]
+        self.local_loss = config["learning"]["local-loss"]
+        self.pipeline = config["learning"]["pipeline"]
         self.data_distribution = config["server"]["data-distribution"]
 
         # Cluster
@@ -50,6 +75,59 @@ class Server:
         if not self.mode_cluster:
             self.local_round = 1
 
+        # Aggregation
+        self.aggregation_config = config["server"]["aggregation"]
+        self.async_mode = self.aggregation_config["mode"] == "async"
+        # Per-cluster edge aggregators average the parameters, the server only runs the rounds
+        self.aggregators = self.aggregation_config["aggregators"] and not self.async_mode
+        self.aggregator_updates = {}
+        self.averager = src.Aggregation.ParallelAverager(self.aggregation_config["workers"])
+        # Local rounds between two aggregations of each stage, and the share of its clients that must upload
+        self.aggregation_periods = self.aggregation_config["periods"]
+        self.stage_participation = self.aggregation_config["participation"]
+        self.async_buffers = []
+        self.async_active = []
+        self.async_versions = {}
+        self.round_start_time = None
+        self.idle_since = {}
+        self.idle_time = {}
+
+        # Stragglers
+        self.straggler_config = config["server"]["straggler"]
+        self.round_deadline = self.straggler_config["round-deadline"]
+        self.update_deadline = self.straggler_config["update-deadline"]
+        self.min_participation = self.straggler_config["min-participation"]
+        self.micro_batch_timeout = config["learning"]["micro-batch-timeout"]
+        self.max_retransmit = config["learning"]["max-retransmit"]
+        self.routing = config["learning"]["routing"]
+        self.batching = config["learning"]["batching"]
+        self.client_endpoints = {}
+        self.network = config["network"]
+        if self.network["enable"] and not self.micro_batch_timeout and not self.local_loss \
+                and any(link["loss"] > 0 for link in self.network["links"]):
+            raise ValueError("network.links drop messages but learning.micro-batch-timeout is 0, "
+                             "a lost micro-batch would stall the round.")
+        self.optimizer_config = config["learning"]["optimizer"]
+        self.average_optimizer = self.optimizer_config["state"] == src.Optimizer.AVERAGE
+        self.routing_stats = {}
+        self.timers = {}
+        self.start_time = {}
+        self.client_status = {}
+        self.client_stats = {}
+
+        # Membership
+        self.membership_config = config["server"]["membership"]
+        self.heartbeat_timeout = self.membership_config["heartbeat-timeout"]
+        heartbeat_interval = self.membership_config["heartbeat-interval"]
+        if self.heartbeat_timeout and not 0 < heartbeat_interval < self.heartbeat_timeout:
+            raise ValueError(f"membership.heartbeat-interval ({heartbeat_interval}) must be above 0 and below "
+                             f"heartbeat-timeout ({self.heartbeat_timeout}), or every client would be removed.")
+        self.last_seen = {}
+        self.pending_clients = []
+        self.fresh_clients = set()
+        self.membership_changed = False
+        self.stalled = False
+
         # Data distribution
         self.non_iid = self.data_distribution["non-iid"]
         self.num_label = self.data_distribution["num-label"]
@@ -63,14 +141,16 @@ class Server:
 
         log_path = config["log_path"]
 
-        credentials = pika.PlainCredentials(username, password)
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(address, 5672, f'{virtual_host}', credentials))
+        if connection_factory is not None:
+            # In-process simulation
+            self.connection = connection_factory()
+        else:
+            credentials = pika.PlainCredentials(username, password)
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(address, 5672, f'{virtual_host}', credentials))
         self.channel = self.connection.channel()
         self.channel.queue_declare(queue='rpc_queue')
 
-        self.current_clients = [0 for _ in range(len(self.total_clients))]
         self.register_clients = [0 for _ in range(len(self.total_clients))]
-        self.first_layer_clients_in_each_cluster = []
         self.responses = {}  # Save response
         self.list_clients = []
         self.global_avg_state_dict = [[] for _ in range(len(self.total_clients))]
@@ -81,349 +161,820 @@ class Server:
         self.local_model_parameters = None
         self.local_client_sizes = None
         self.local_avg_state_dict = None
+        self.local_optimizer_states = None
+        self.local_avg_optimizer_state = None
         self.total_cluster_size = None
 
         self.num_cluster = None
-        self.current_local_training_round = None
         self.infor_cluster = None
-        self.current_infor_cluster = None
+        self.cluster_rounds = []
         self.local_update_count = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.handlers = {"REGISTER": self.on_register,
+                         "NOTIFY": self.on_notify,
+                         "UPDATE": self.on_update,
+                         "UPDATE_CHUNK": self.on_update_chunk,
+                         "FETCH": self.on_fetch,
+                         "HEARTBEAT": self.on_heartbeat,
+                         "LEAVE": self.on_leave,
+                         "AGGREGATED": self.on_aggregated}
 
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=10)
         self.reply_channel = self.connection.channel()
+        self.reply_channel.exchange_declare(exchange='parameters', exchange_type='direct')
+        self.parameters_bindings = set()
+        self.published_tensors = {}
+        self.client_hashes = {}
         self.channel.basic_consume(queue='rpc_queue', on_message_callback=self.on_request)
 
         debug_mode = config["debug_mode"]
         self.logger = src.Log.Logger(f"{log_path}/app.log", debug_mode)
         self.logger.log_info(f"Application start. Server is waiting for {self.total_clients} clients.")
+        if self.heartbeat_timeout:
+            self.connection.call_later(self.heartbeat_timeout / 2, self.check_heartbeats)
 
     def distribution(self):
+        # One data shard per current first-layer client, recomputed whenever the membership changes
+        num_clients = sum(1 for (_, layer_id, _, _) in self.list_clients if layer_id == 1)
         if self.non_iid:
-            label_distribution = np.random.dirichlet([self.data_distribution["dirichlet"]["alpha"]] * self.num_label, self.total_clients[0])
+            label_distribution = np.random.dirichlet([self.data_distribution["dirichlet"]["alpha"]] * self.num_label, num_clients)
             self.label_counts = (label_distribution * self.num_sample).astype(int)
         else:
-            self.label_counts = np.full((self.total_clients[0], self.num_label), self.num_sample // self.num_label)
+            self.label_counts = np.full((num_clients, self.num_label), self.num_sample // self.num_label)
 
     def on_request(self, ch, method, props, body):
         message = pickle.loads(body)
         routing_key = props.reply_to
         action = message["action"]
+        self.responses[routing_key] = message
+        client_id = str(message["client_id"])
+        if client_id in self.last_seen:
+            self.last_seen[client_id] = time.time()
+
+        handler = self.handlers.get(action)
+        if handler is None:
+            self.logger.log_warning(f"Unknown action {action} from client {client_id}")
+        elif action in ("NOTIFY", "UPDATE", "UPDATE_CHUNK") and self.find_client(client_id) is None:
+            self.logger.log_warning(f"Drop {action} from client {client_id}, it is no longer a member")
+        else:
+            handler(message)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def on_register(self, message):
         client_id = message["client_id"]
         layer_id = message["layer_id"]
-        self.responses[routing_key] = message
+        performance = message['performance']
+        src.Log.print_with_color(f"[<<<] Received message from client: {message}", "blue")
+        self.last_seen[str(client_id)] = time.time()
+        # Data-plane endpoint: host for shared memory, address of the tcp transport
+        self.client_endpoints[str(client_id)] = {"host": message["host"], "address": message["address"]}
 
-        if action == "REGISTER":
-            performance = message['performance']
-            if (str(client_id), layer_id, performance, 0) not in self.list_clients:
-                self.list_clients.append((str(client_id), layer_id, performance, -1))
-
-            src.Log.print_with_color(f"[<<<] Received message from client: {message}", "blue")
-            # Save messages from clients
-            self.register_clients[layer_id - 1] += 1
-
-            # If consumed all clients - Register for first time
-            if self.register_clients == self.total_clients:
-                self.distribution()
-                self.cluster_client()
-                print(self.list_cut_layers)
-                src.Log.print_with_color("All clients are connected. Sending notifications.", "green")
-                self.logger.log_info(f"Start training round {self.global_round - self.round + 1}")
-                self.notify_clients()
-        elif action == "NOTIFY":
-            cluster = message["cluster"]
-            src.Log.print_with_color(f"[<<<] Received message from client: {message}", "blue")
-            message = {"action": "PAUSE",
-                       "message": "Pause training and please send your parameters",
-                       "parameters": None}
-            if layer_id == 1:
-                self.first_layer_clients_in_each_cluster[cluster] += 1
-
-            if self.first_layer_clients_in_each_cluster[cluster] == self.infor_cluster[cluster][0]:
-                self.first_layer_clients_in_each_cluster[cluster] = 0
-                src.Log.print_with_color(f"Received finish training notification cluster {cluster}", "yellow")
-
-                for (client_id, layer_id, _, clustering) in self.list_clients:
-                    if clustering == cluster:
-                        if self.special is False:
-                            self.send_to_response(client_id, pickle.dumps(message))
-                        else:
-                            if layer_id == 1:
-                                self.send_to_response(client_id, pickle.dumps(message))
-                self.local_update_count += 1
+        if self.cluster_rounds or self.register_clients[layer_id - 1] >= self.total_clients[layer_id - 1]:
+            # Training already started (or this layer is full), join at the next round boundary
+            self.pending_clients.append((str(client_id), layer_id, performance))
+            self.logger.log_info(f"Client {client_id} of layer {layer_id} will join at the next round boundary")
+            if self.stalled:
+                self.start_global_round()
+            return
 
-            if self.special and self.local_update_count == self.num_cluster * self.local_round:
-                self.local_update_count = 0
-                for (client_id, layer_id, _) in self.list_clients:
-                    if layer_id != 1:
-                        self.send_to_response(client_id, pickle.dumps(message))
-
-        elif action == "UPDATE":
-            # self.distribution()
-            data_message = message["message"]
-            result = message["result"]
-            src.Log.print_with_color(f"[<<<] Received message from {client_id}: {data_message}", "blue")
-            cluster = message["cluster"]
-            # Global update
-            if self.current_local_training_round[cluster] == self.local_round - 1:
-                self.current_clients[layer_id - 1] += 1
-                if not result:
-                    self.round_result = False
-
-                # Save client's model parameters
-                if self.save_parameters and self.round_result:
-                    model_state_dict = message["parameters"]
-                    client_size = message["size"]
-                    self.local_model_parameters[cluster][layer_id - 1].append(model_state_dict)
-                    self.local_client_sizes[cluster][layer_id - 1].append(client_size)
-
-                # If consumed all client's parameters
-                if self.current_clients == self.total_clients:
-                    src.Log.print_with_color("Collected all parameters.", "yellow")
-                    if self.save_parameters and self.round_result:
-                        for i in range(0, self.num_cluster):
-                            self.total_cluster_size[i] = sum(self.local_client_sizes[i][0])
-                            self.avg_all_parameters(i)
-                            self.local_model_parameters[i] = [[] for _ in range(len(self.total_clients))]
-                            self.local_client_sizes[i] = [[] for _ in range(len(self.total_clients))]
-                    self.current_clients = [0 for _ in range(len(self.total_clients))]
-                    self.current_local_training_round = [0 for _ in range(self.num_cluster)]
-                    # Test
-                    if self.save_parameters and self.validation and self.round_result:
-                        state_dict_full = self.concatenate_state_dict()
-                        if not src.Validation.test(self.model_name, self.data_name, state_dict_full, self.logger):
-                            self.logger.log_warning("Training failed!")
-                        else:
-                            # Save to files
-                            torch.save(state_dict_full, f'{self.model_name}_{self.data_name}.pth')
-                            self.round -= 1
-                    else:
-                        self.round -= 1
+        if (str(client_id), layer_id, performance, 0) not in self.list_clients:
+            self.list_clients.append((str(client_id), layer_id, performance, -1))
 
-                    # Start a new training round
-                    self.round_result = True
+        # Save messages from clients
+        self.register_clients[layer_id - 1] += 1
 
-                    if self.round > 0:
-                        self.logger.log_info(f"Start training round {self.global_round - self.round + 1}")
-                        if self.save_parameters:
-                            self.notify_clients(special=self.special)
-                        else:
-                            self.notify_clients(register=False, special=self.special)
-                    else:
-                        self.logger.log_info("Stop training !!!")
-                        self.notify_clients(start=False)
-                        sys.exit()
+        # If consumed all clients - Register for first time
+        if self.register_clients == self.total_clients:
+            self.distribution()
+            self.cluster_client()
+            self.logger.log_info(f"Cut layers of the clusters: {self.list_cut_layers}")
+            src.Log.print_with_color("All clients are connected. Sending notifications.", "green")
+            self.logger.log_info(f"Start training round {self.global_round - self.round + 1}")
+            self.notify_clients()
+
+    def on_notify(self, message):
+        client_id = str(message["client_id"])
+        layer_id = message["layer_id"]
+        cluster = message["cluster"]
+        src.Log.print_with_color(f"[<<<] Received message from client: {message}", "blue")
+        self.idle_since[client_id] = time.time()
+        stats = self.stats_of(client_id)
+        stats["rounds"] += 1
+        stats["train_time"] += time.time() - self.start_time.get(client_id, time.time())
+        stats["timeouts"] += message["timeouts"]
+        stats["retransmits"] += message["retransmits"]
+        if message["routing"]:
+            for target, target_stats in message["routing"].items():
+                routed = self.routing_stats.setdefault(target, {"sent": 0, "latency": []})
+                routed["sent"] += target_stats["sent"]
+                if target_stats["latency"] is not None:
+                    routed["latency"].append(target_stats["latency"])
+
+        cluster_round = self.cluster_rounds[cluster]
+        if message["paused"]:
+            # Straggler stopped by a round deadline, its PAUSE was already sent
+            return
+        if cluster_round.state != src.Round.TRAINING:
+            self.logger.log_warning(f"Unexpected NOTIFY in {cluster_round}")
+            return
+        if self.async_mode and layer_id == 1:
+            # No barrier, collect the parameters of this client right away
+            self.send_pause(client_id)
+            return
+        if layer_id == 1 and cluster_round.finish_training(client_id):
+            src.Log.print_with_color(f"Received finish training notification cluster {cluster}", "yellow")
+            self.pause_cluster(cluster)
+
+    def aggregation_period(self, layer_id):
+        if self.special and layer_id > 1:
+            # Deeper stages are shared by all clusters, they are only aggregated in the global round
+            return 0
+        if layer_id <= len(self.aggregation_periods):
+            return self.aggregation_periods[layer_id - 1]
+        return 1
+
+    def due_layers(self, cluster, local_round):
+        """Stages (layer ids) of a cluster that are aggregated at the end of `local_round`, all of them in the global round."""
+        num_layers = len(self.total_clients)
+        if local_round >= self.cluster_rounds[cluster].local_round - 1:
+            return set(range(1, num_layers + 1))
+        return {layer_id for layer_id in range(1, num_layers + 1)
+                if self.aggregation_period(layer_id) and (local_round + 1) % self.aggregation_period(layer_id) == 0}
+
+    def collected_layers(self, cluster):
+        """Layer indices that send an UPDATE this round, the first layer always restarts on its data."""
+        due = self.due_layers(cluster, self.cluster_rounds[cluster].current_local_round)
+        return sorted(layer_id - 1 for layer_id in due | {1})
+
+    def pause_cluster(self, cluster):
+        cluster_round = self.cluster_rounds[cluster]
+        cluster_round.stop_training()
+        due = self.due_layers(cluster, cluster_round.current_local_round)
+        if not cluster_round.is_global():
+            self.logger.log_info(f"Cluster {cluster} local round {cluster_round.current_local_round + 1}: "
+                                 f"aggregate stages {sorted(due)}")
+        for (client_id, layer_id, _, clustering) in self.list_clients:
+            if clustering == cluster:
+                # Stages that are not due keep training on their model
+                if layer_id == 1 or (layer_id in due and not self.special):
+                    self.send_pause(client_id, self.round_id(cluster))
+        self.local_update_count += 1
+
+        if self.special and self.local_update_count == self.num_cluster * self.local_round:
+            self.local_update_count = 0
+            for (client_id, layer_id, _, _) in self.list_clients:
+                if layer_id != 1:
+                    self.send_pause(client_id, self.round_id(cluster))
+        self.arm_timer(cluster, self.update_deadline, self.on_update_deadline)
+
+    def send_pause(self, client_id, round_id=None):
+        # With the local loss, a stage drains its queue until the end-of-round markers of `round_id` arrive
+        pause = {"action": "PAUSE",
+                 "message": "Pause training and please send your parameters",
+                 "parameters": None, "round": round_id}
+        self.client_status[str(client_id)] = "paused"
+        self.send_to_response(client_id, pickle.dumps(pause))
+
+    def arm_timer(self, cluster, delay, callback):
+        if not delay:
+            return
+        if cluster in self.timers:
+            self.connection.remove_timeout(self.timers[cluster])
+        self.timers[cluster] = self.connection.call_later(delay, functools.partial(callback, cluster))
+
+    def on_round_deadline(self, cluster):
+        cluster_round = self.cluster_rounds[cluster]
+        if cluster_round.state != src.Round.TRAINING:
+            return
+        first_layer = [client_id for (client_id, layer_id, _, clustering) in self.list_clients
+                       if clustering == cluster and layer_id == 1]
+        if len(cluster_round.finished_first_layer) < math.ceil(self.min_participation * len(first_layer)):
+            self.logger.log_warning(f"Round deadline of cluster {cluster}: only {len(cluster_round.finished_first_layer)}"
+                                    f"/{len(first_layer)} clients finished, waiting for quorum")
+            self.arm_timer(cluster, self.round_deadline, self.on_round_deadline)
+            return
+
+        stragglers = [client_id for client_id in first_layer if client_id not in cluster_round.finished_first_layer]
+        for client_id in stragglers:
+            self.stats_of(client_id)["late"] += 1
+        self.logger.log_warning(f"Round deadline of cluster {cluster}: pause stragglers {stragglers}")
+        self.pause_cluster(cluster)
+
+    def on_update_deadline(self, cluster):
+        cluster_round = self.cluster_rounds[cluster]
+        if cluster_round.state != src.Round.COLLECTING:
+            return
+        layers = self.collected_layers(cluster)
+        total = sum(cluster_round.expected[layer] for layer in layers)
+        received = sum(cluster_round.updated[layer] for layer in layers)
+        below_stage_quorum = any(cluster_round.updated[layer] < math.ceil(self.stage_participation[layer] * cluster_round.expected[layer])
+                                 for layer in layers if layer < len(self.stage_participation))
+        if any(cluster_round.updated[layer] == 0 for layer in layers) or received < math.ceil(self.min_participation * total) \
+                or below_stage_quorum:
+            self.logger.log_warning(f"Update deadline of cluster {cluster}: {received}/{total} updates, waiting for quorum")
+            self.arm_timer(cluster, self.update_deadline, self.on_update_deadline)
+            return
 
-            # Local update
+        excluded = [client_id for (client_id, layer_id, _, clustering) in self.list_clients
+                    if clustering == cluster and layer_id - 1 in layers and self.client_status.get(client_id) == "paused"]
+        for client_id in excluded:
+            self.client_status[client_id] = "excluded"
+            self.stats_of(client_id)["excluded"] += 1
+        self.logger.log_warning(f"Update deadline of cluster {cluster}: aggregate {received}/{total} updates, "
+                                f"exclude {excluded}")
+        cluster_round.close()
+        self.check_collected(cluster)
+
+    def on_heartbeat(self, message):
+        # `on_request` already refreshed the last time this client was seen
+        pass
+
+    def on_leave(self, message):
+        self.remove_client(str(message["client_id"]), "left")
+
+    def check_heartbeats(self):
+        now = time.time()
+        for client_id, seen in list(self.last_seen.items()):
+            if now - seen > self.heartbeat_timeout:
+                self.remove_client(client_id, f"no heartbeat for {now - seen:.0f}s")
+        self.connection.call_later(self.heartbeat_timeout / 2, self.check_heartbeats)
+
+    def find_client(self, client_id):
+        for index, (other_client_id, _, _, _) in enumerate(self.list_clients):
+            if other_client_id == client_id:
+                return index
+        return None
+
+    def remove_client(self, client_id, reason):
+        """
+        Drop a client that left or stopped sending heartbeats. Its round accounting is released so the
+        rest of its cluster can finish the round, its place is refilled at the next round boundary.
+        """
+        self.last_seen.pop(client_id, None)
+        for pending in self.pending_clients:
+            if pending[0] == client_id:
+                self.pending_clients.remove(pending)
+                self.logger.log_warning(f"Pending client {client_id} {reason}")
+                return
+        index = self.find_client(client_id)
+        if index is None:
+            return
+        _, layer_id, _, cluster = self.list_clients.pop(index)
+        self.logger.log_warning(f"Client {client_id} of layer {layer_id} in cluster {cluster} {reason}")
+        if not self.cluster_rounds:
+            # Still registering
+            self.register_clients[layer_id - 1] -= 1
+            return
+
+        status = self.client_status.pop(client_id, None)
+        self.client_hashes.pop(client_id, None)
+        self.client_endpoints.pop(client_id, None)
+        self.uploads.discard(client_id)
+        self.forget_published(lambda key: key[2] == client_id)
+        self.fresh_clients.discard(client_id)
+        self.unbind_parameters(client_id)
+        self.membership_changed = True
+
+        cluster_round = self.cluster_rounds[cluster]
+        cluster_round.remove_client(layer_id, client_id, counted=status in ("updated", "excluded"))
+        if self.async_mode and layer_id == 1:
+            self.async_active[cluster].discard(client_id)
+
+        if cluster_round.state == src.Round.TRAINING:
+            if self.async_mode:
+                if not cluster_round.is_complete():
+                    for active_client_id in self.async_active[cluster]:
+                        self.send_pause(active_client_id)
+                elif not self.async_active[cluster]:
+                    self.close_async_round(cluster)
+            elif not cluster_round.is_complete() or len(cluster_round.finished_first_layer) >= cluster_round.clients_per_layer[0]:
+                # A stage of the pipeline is gone or the remaining first-layer clients are done
+                self.pause_cluster(cluster)
+        elif cluster_round.state == src.Round.COLLECTING:
+            self.check_collected(cluster)
+
+    def unbind_parameters(self, client_id):
+        for (bound_client_id, routing_key) in list(self.parameters_bindings):
+            if bound_client_id == client_id:
+                self.reply_channel.queue_unbind(queue=f'reply_{client_id}', exchange='parameters', routing_key=routing_key)
+                self.parameters_bindings.discard((bound_client_id, routing_key))
+
+    def update_membership(self):
+        """Round boundary: admit pending clients, refill empty clusters and redistribute the data shards."""
+        changed = self.membership_changed or bool(self.pending_clients)
+        for (client_id, layer_id, performance) in self.pending_clients:
+            if self.mode_cluster and 0 <= performance < self.num_cluster:
+                cluster = performance
             else:
-                if not result:
-                    self.round_result = False
-                if self.round_result:
-                    model_state_dict = message["parameters"]
-                    client_size = message["size"]
-                    self.local_model_parameters[cluster][layer_id - 1].append(model_state_dict)
-                    self.local_client_sizes[cluster][layer_id - 1].append(client_size)
-                self.current_infor_cluster[cluster][layer_id - 1] += 1
-
-                if self.special is False:
-                    if self.current_infor_cluster[cluster] == self.infor_cluster[cluster]:
-                        self.avg_all_parameters(cluster=cluster)
-                        self.notify_clients(cluster=cluster, special=False)
-                        self.current_local_training_round[cluster] += 1
-
-                        self.local_model_parameters[cluster] = [[] for _ in range(len(self.total_clients))]
-                        self.local_client_sizes[cluster] = [[] for _ in range(len(self.total_clients))]
-                        self.current_infor_cluster[cluster] = [0 for _ in range(len(self.total_clients))]
-                else:
-                    if self.current_infor_cluster[cluster][0] == self.infor_cluster[cluster][0]:
-                        self.avg_all_parameters(cluster=cluster)
-                        self.notify_clients(cluster=cluster, special=True)
-                        self.current_local_training_round[cluster] += 1
+                cluster = min(range(self.num_cluster), key=lambda c: self.cluster_rounds[c].clients_per_layer[layer_id - 1])
+            self.list_clients.append((client_id, layer_id, performance, cluster))
+            self.cluster_rounds[cluster].add_client(layer_id)
+            self.fresh_clients.add(client_id)
+            self.logger.log_info(f"Client {client_id} joined layer {layer_id} of cluster {cluster}")
+        self.pending_clients = []
+        self.rebalance_clusters()
+        if changed:
+            self.distribution()
+            self.membership_changed = False
 
-                        self.local_model_parameters[cluster] = [[] for _ in range(len(self.total_clients))]
-                        self.local_client_sizes[cluster] = [[] for _ in range(len(self.total_clients))]
-                        self.current_infor_cluster[cluster] = [0 for _ in range(len(self.total_clients))]
+    def rebalance_clusters(self):
+        # Move a client (and so its cut layers) from the cluster with most clients of a layer into a cluster that has none
+        for cluster_round in self.cluster_rounds:
+            for layer in range(len(self.total_clients)):
+                if cluster_round.clients_per_layer[layer] > 0:
+                    continue
+                donor = max(self.cluster_rounds, key=lambda c: c.clients_per_layer[layer])
+                if donor.clients_per_layer[layer] < 2:
+                    continue
+                for index, (client_id, layer_id, performance, cluster) in enumerate(self.list_clients):
+                    if cluster == donor.cluster and layer_id == layer + 1:
+                        self.list_clients[index] = (client_id, layer_id, performance, cluster_round.cluster)
+                        donor.remove_client(layer_id, client_id)
+                        cluster_round.add_client(layer_id)
+                        self.unbind_parameters(client_id)
+                        self.fresh_clients.add(client_id)
+                        self.logger.log_info(f"Move client {client_id} of layer {layer_id} from cluster {cluster} "
+                                             f"to cluster {cluster_round.cluster}")
+                        break
 
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    def on_fetch(self, message):
+        # Client cache miss, send the requested tensors directly
+        tensors = {}
+        for published_tensors in self.published_tensors.values():
+            for tensor_hash in message["hashes"]:
+                if tensor_hash in published_tensors:
+                    tensors[tensor_hash] = published_tensors[tensor_hash]
+        unknown = len(set(message["hashes"]) - set(tensors))
+        if unknown:
+            self.logger.log_warning(f"FETCH of {message['client_id']}: {unknown} tensors are not published any more")
+        response = {"action": "PARAMETERS",
+                    "message": f"Sent {len(tensors)} missing tensors",
+                    "digest": None,
+                    "parameters": pickle.dumps(tensors),
+                    "chunks": None,
+                    "error": f"{unknown} tensors are not published any more" if unknown else None}
+        self.send_to_response(message["client_id"], pickle.dumps(response))
+
+    def on_update_chunk(self, message):
+        # Tensors are rebuilt as their blocks arrive, the UPDATE that follows closes the transfer
+        update = self.uploads.add_chunk(str(message["client_id"]), message)
+        if update is not None:
+            self.on_update(update)
+
+    def on_update(self, message):
+        client_id = message["client_id"]
+        layer_id = message["layer_id"]
+        cluster = message["cluster"]
+        src.Log.print_with_color(f"[<<<] Received message from {client_id}: {message['message']}", "blue")
+        if message["chunks"] is not None:
+            if not self.uploads.ready(str(client_id), message):
+                # Some blocks are still on their way, the last one hands this UPDATE back
+                return
+            error = self.uploads.assemble(str(client_id), message)
+            if error is not None:
+                self.logger.log_error(f"Chunked parameters of {client_id} are broken ({error}), the round result is dropped")
+        if message["parameters_hashes"] is not None:
+            known = self.client_hashes.setdefault(str(client_id), {"uploaded": set(), "sent": set()})
+            known["uploaded"] = set(message["parameters_hashes"].values())
+
+        cluster_round = self.cluster_rounds[cluster]
+        if cluster_round.state not in (src.Round.TRAINING, src.Round.COLLECTING):
+            self.logger.log_warning(f"Unexpected UPDATE from {client_id} in {cluster_round}")
+            return
+        if self.client_status.get(str(client_id)) != "paused":
+            self.logger.log_warning(f"Drop late UPDATE from straggler {client_id}")
+            return
+        self.client_status[str(client_id)] = "updated"
+        if self.async_mode and layer_id == 1:
+            self.on_async_update(message)
+            return
+        if not message["result"]:
+            self.round_result = False
+
+        # Save client's model parameters, a stage that is not due this round only reports its result
+        uploaded = message["parameters_hashes"] is not None
+        if uploaded and self.round_result and (self.save_parameters or not cluster_round.is_global()) and self.aggregators:
+            # Kept by the aggregator of the cluster until AGGREGATE
+            self.aggregator_updates.setdefault(cluster, set()).add(str(client_id))
+        elif uploaded and message["parameters"] and self.round_result and (self.save_parameters or not cluster_round.is_global()):
+            # A fully frozen stage sends nothing new, the last average of its layer is kept
+            self.local_model_parameters[cluster][layer_id - 1].append(message["parameters"])
+            self.local_client_sizes[cluster][layer_id - 1].append(message["size"])
+            self.local_optimizer_states[cluster][layer_id - 1].append(message["optimizer_state"])
+        cluster_round.update(layer_id)
+        self.check_collected(cluster)
+
+    def check_collected(self, cluster):
+        cluster_round = self.cluster_rounds[cluster]
+        if not cluster_round.collected(self.collected_layers(cluster)):
+            return
+        if self.aggregator_updates.get(cluster):
+            # The parameters are on the aggregator of the cluster, get their average first
+            cluster_round.state = src.Round.AGGREGATING
+            message = {"action": "AGGREGATE", "clients": list(self.aggregator_updates[cluster]),
+                       "num_layers": len(self.total_clients)}
+            self.reply_channel.queue_declare(f'aggregate_queue_{cluster}', durable=False)
+            self.reply_channel.basic_publish(exchange='', routing_key=f'aggregate_queue_{cluster}', body=pickle.dumps(message))
+        else:
+            self.on_collected(cluster)
+
+    def on_collected(self, cluster):
+        cluster_round = self.cluster_rounds[cluster]
+        # Global update
+        if cluster_round.is_global():
+            cluster_round.state = src.Round.WAITING
+            self.try_aggregate_global()
+        # Local update
+        else:
+            cluster_round.state = src.Round.AGGREGATING
+            self.run_in_executor(self.avg_all_parameters, self.on_local_aggregated, cluster)
+
+    def on_aggregated(self, message):
+        cluster = message["cluster"]
+        src.Log.print_with_color(f"[<<<] Received the parameters of cluster {cluster} from its aggregator", "blue")
+        self.aggregator_updates.pop(cluster, None)
+        # One model per layer, weighted by the data size of the whole cluster
+        for layer, state_dict in enumerate(message["parameters"]):
+            if state_dict is not None:
+                self.local_model_parameters[cluster][layer] = [state_dict]
+                self.local_client_sizes[cluster][layer] = [message["sizes"][layer]]
+                self.local_optimizer_states[cluster][layer] = [message["optimizer_states"][layer]]
+        self.on_collected(cluster)
+
+    def on_async_update(self, message):
+        client_id = str(message["client_id"])
+        cluster = message["cluster"]
+        cluster_round = self.cluster_rounds[cluster]
+        buffer = self.async_buffers[cluster]
+
+        if message["result"] and not message["parameters"]:
+            # Fully frozen stage, nothing to merge
+            pass
+        elif message["result"]:
+            version = self.async_versions.get(client_id, buffer.version)
+            if not buffer.add(message["parameters"], message["size"], version):
+                self.logger.log_warning(f"Drop update of {client_id}, staleness {buffer.version - version} is too high")
+        else:
+            self.logger.log_warning(f"Drop failed update of {client_id}")
+        cluster_round.update(1)
+        self.async_active[cluster].discard(client_id)
+
+        if cluster_round.is_complete() and cluster_round.updated[0] < cluster_round.clients_per_layer[0] * self.local_round:
+            # Quota of the round is not reached yet, keep this client training
+            self.start_async_client(client_id, cluster)
+        elif not self.async_active[cluster]:
+            self.close_async_round(cluster)
+
+    def close_async_round(self, cluster):
+        # Every first-layer client of the cluster has stopped, close the first layer of the round
+        cluster_round = self.cluster_rounds[cluster]
+        buffer = self.async_buffers[cluster]
+        buffer.flush()
+        self.local_model_parameters[cluster][0] = [buffer.state_dict] if buffer.state_dict else []
+        self.local_client_sizes[cluster][0] = [buffer.merged_size] if buffer.state_dict else []
+        cluster_round.updated[0] = cluster_round.clients_per_layer[0]
+        cluster_round.state = src.Round.COLLECTING
+        self.logger.log_info(f"Cluster {cluster}: merged {buffer.merged_size} samples in async mode, "
+                             f"model version {buffer.version}, dropped {buffer.dropped} stale updates")
+
+        if self.special:
+            if all(c.state == src.Round.COLLECTING for c in self.cluster_rounds):
+                for (other_client_id, layer_id, _, _) in self.list_clients:
+                    if layer_id != 1:
+                        self.send_pause(other_client_id, self.round_id(cluster))
+        else:
+            for (other_client_id, layer_id, _, clustering) in self.list_clients:
+                if layer_id != 1 and clustering == cluster:
+                    self.send_pause(other_client_id, self.round_id(cluster))
+        self.arm_timer(cluster, self.update_deadline, self.on_update_deadline)
+        if cluster_round.collected():
+            cluster_round.state = src.Round.WAITING
+            self.try_aggregate_global()
+
+    def start_async_client(self, client_id, cluster):
+        buffer = self.async_buffers[cluster]
+        parameters_ref, parameters_hashes = self.publish_parameters(cluster, 1, buffer.state_dict, {}, client_id=client_id)
+        self.async_versions[client_id] = buffer.version
+        self.async_active[cluster].add(client_id)
+        response = self.start_message([0, self.list_cut_layers[cluster][0]], parameters_ref, parameters_hashes,
+                                      data_name=self.data_name, special=self.special,
+                                      next_clients=self.next_clients(cluster, 1), peers=self.peers(cluster, 1),
+                                      freeze=self.freeze_policy(1), round_id=self.round_id(cluster),
+                                      upstream_frozen=self.upstream_frozen(cluster, 1))
+        self.record_start(client_id)
+        self.send_to_response(client_id, pickle.dumps(response))
+
+    def stats_of(self, client_id):
+        return self.client_stats.setdefault(client_id, {"rounds": 0, "train_time": 0, "late": 0, "excluded": 0,
+                                                        "timeouts": 0, "retransmits": 0})
+
+    def record_start(self, client_id):
+        self.client_status[client_id] = "training"
+        self.start_time[client_id] = time.time()
+        since = self.idle_since.pop(client_id, None)
+        if since is not None:
+            self.idle_time[client_id] = self.idle_time.get(client_id, 0) + time.time() - since
+
+    def report_round(self):
+        now = time.time()
+        for client_id, since in self.idle_since.items():
+            self.idle_time[client_id] = self.idle_time.get(client_id, 0) + now - since
+            self.idle_since[client_id] = now
+        first_layer_clients = [client_id for (client_id, layer_id, _, _) in self.list_clients if layer_id == 1]
+        idle = [self.idle_time.get(client_id, 0) for client_id in first_layer_clients]
+        wall_time = now - self.round_start_time
+        self.logger.log_info(f"Round {self.global_round - self.round + 1} ({self.aggregation_config['mode']}): "
+                             f"wall time {wall_time:.2f}s, first-layer idle time mean {sum(idle) / max(len(idle), 1):.2f}s, "
+                             f"max {max(idle, default=0):.2f}s")
+        self.idle_time = {}
+        for client_id, stats in self.client_stats.items():
+            self.logger.log_info(f"Client {client_id}: rounds {stats['rounds']}, "
+                                 f"mean train time {stats['train_time'] / max(stats['rounds'], 1):.2f}s, "
+                                 f"late {stats['late']}, excluded {stats['excluded']}, "
+                                 f"micro-batch timeouts {stats['timeouts']}, retransmits {stats['retransmits']}")
+        if self.routing_stats:
+            sent = [routed["sent"] for routed in self.routing_stats.values()]
+            for target, routed in self.routing_stats.items():
+                latency = sum(routed["latency"]) / len(routed["latency"]) if routed["latency"] else 0
+                self.logger.log_info(f"Routing ({self.routing}) to {target}: {routed['sent']} micro-batches, "
+                                     f"round-trip {latency * 1000:.1f}ms")
+            self.logger.log_info(f"Routing ({self.routing}) imbalance max/mean {max(sent) / max(sum(sent) / len(sent), 1e-9):.2f}")
+            self.routing_stats = {}
+
+    def run_in_executor(self, func, callback, *args):
+        """
+        Run heavy work (aggregation, validation, checkpoint) off the pika thread, then hand the result
+        back to `callback` on the pika thread, where publishing is safe.
+        """
+        def done(future):
+            self.connection.add_callback_threadsafe(functools.partial(callback_with_result, future))
+
+        def callback_with_result(future):
+            callback(future.result(), *args)
+
+        self.executor.submit(func, *args).add_done_callback(done)
+
+    def try_aggregate_global(self):
+        if all(c.state == src.Round.WAITING for c in self.cluster_rounds):
+            src.Log.print_with_color("Collected all parameters.", "yellow")
+            self.report_round()
+            for c in self.cluster_rounds:
+                c.state = src.Round.AGGREGATING
+            self.run_in_executor(self.aggregate_global, self.on_global_aggregated)
+
+    def on_local_aggregated(self, _, cluster):
+        cluster_round = self.cluster_rounds[cluster]
+        self.notify_clients(cluster=cluster, special=self.special)
+        cluster_round.next_local_round()
+
+        self.local_model_parameters[cluster] = [[] for _ in range(len(self.total_clients))]
+        self.local_client_sizes[cluster] = [[] for _ in range(len(self.total_clients))]
+        self.local_optimizer_states[cluster] = [[] for _ in range(len(self.total_clients))]
+
+    def aggregate_global(self):
+        if self.save_parameters and self.round_result:
+            # Every cluster is averaged at once on the pool
+            averages = [self.submit_averages(i) for i in range(0, self.num_cluster)]
+            for i in range(0, self.num_cluster):
+                self.total_cluster_size[i] = sum(self.local_client_sizes[i][0])
+                self.collect_averages(i, averages[i])
+                self.local_model_parameters[i] = [[] for _ in range(len(self.total_clients))]
+                self.local_client_sizes[i] = [[] for _ in range(len(self.total_clients))]
+                self.local_optimizer_states[i] = [[] for _ in range(len(self.total_clients))]
+            self.report_aggregation("global")
+        # Test
+        if self.save_parameters and self.validation and self.round_result:
+            state_dict_full = self.concatenate_state_dict()
+            self.report_aggregation("clusters merge")
+            if not src.Validation.test(self.model_name, self.data_name, state_dict_full, self.logger):
+                self.logger.log_warning("Training failed!")
+                return False
+            # Save to files
+            self.checkpoint.save(state_dict_full, self.checkpoint_round + self.global_round - self.round + 1)
+        return True
+
+    def on_global_aggregated(self, success):
+        if success:
+            self.round -= 1
+
+        # Start a new training round
+        self.round_result = True
+
+        if self.round > 0:
+            self.start_global_round()
+        else:
+            self.logger.log_info("Stop training !!!")
+            self.notify_clients(start=False)
+            self.executor.shutdown(wait=False)
+            sys.exit()
+
+    def start_global_round(self):
+        self.stalled = False
+        self.update_membership()
+        for cluster_round in self.cluster_rounds:
+            cluster_round.next_global_round()
+            if not cluster_round.is_complete():
+                # Sit this round out until a client joins the empty layer
+                self.logger.log_warning(f"Cluster {cluster_round.cluster} has no client in some layer "
+                                        f"{cluster_round.clients_per_layer}, skip this round")
+                cluster_round.state = src.Round.WAITING
+        if all(c.state == src.Round.WAITING for c in self.cluster_rounds):
+            self.logger.log_warning("No cluster can train, waiting for new clients")
+            self.stalled = True
+            return
+
+        self.logger.log_info(f"Start training round {self.global_round - self.round + 1}")
+        if self.save_parameters:
+            self.notify_clients(special=self.special)
+        else:
+            self.notify_clients(register=False, special=self.special)
 
     def notify_clients(self, start=True, register=True, cluster=None, special=False):
         label_counts = copy.copy(self.label_counts)
         label_counts = label_counts.tolist()
-        if cluster is not None and special is False:
+        published = {}
+        if cluster is not None:
+            # Restart the first layer and the stages aggregated this round, only those get new parameters
+            cluster_round = self.cluster_rounds[cluster]
+            aggregated = self.due_layers(cluster, cluster_round.current_local_round)
+            upload = 1 in self.due_layers(cluster, cluster_round.current_local_round + 1)
+            self.forget_published(lambda key: key[0] == cluster and (key[1] == 1 or (key[1] in aggregated and not special)))
             for (client_id, layer_id, _, clustering) in self.list_clients:
-                if clustering == cluster:
-                    if layer_id == 1:
-                        layers = [0, self.list_cut_layers[cluster][0]]
-                    elif layer_id == len(self.total_clients):
-                        layers = [self.list_cut_layers[cluster][-1], -1]
-                    else:
-                        layers = [self.list_cut_layers[cluster][layer_id - 2], self.list_cut_layers[cluster][layer_id - 1]]
+                if clustering == cluster and (layer_id == 1 or (layer_id in aggregated and not special)):
+                    layers = self.client_layers(cluster, layer_id)
+                    state_dict = self.local_avg_state_dict[cluster][layer_id - 1] if layer_id in aggregated else None
+                    optimizer_state = self.local_avg_optimizer_state[cluster][layer_id - 1] if layer_id in aggregated else None
+                    state_dict = self.trainable_parameters(cluster, layer_id, state_dict)
+                    parameters_ref, parameters_hashes = self.publish_parameters(cluster, layer_id, state_dict, published)
                     src.Log.print_with_color(f"[>>>] Sent start training request to client {client_id}", "red")
-                    if layer_id == 1:
-                        response = {"action": "START",
-                                    "message": "Server accept the connection!",
-                                    "parameters": self.local_avg_state_dict[cluster][layer_id - 1],
-                                    "num_layers": len(self.total_clients),
-                                    "layers": layers,
-                                    "model_name": self.model_name,
-                                    "data_name": self.data_name,
-                                    "control_count": self.control_count,
-                                    "batch_size": self.batch_size,
-                                    "lr": self.lr,
-                                    "momentum": self.momentum,
-                                    "compute_loss": self.compute_loss,
-                                    "clip_grad_norm": self.clip_grad_norm,
-                                    "label_count": None,
-                                    "cluster": None,
-                                    "special": False}
-                    else:
-                        response = {"action": "START",
-                                    "message": "Server accept the connection!",
-                                    "parameters": self.local_avg_state_dict[cluster][layer_id - 1],
-                                    "num_layers": len(self.total_clients),
-                                    "layers": layers,
-                                    "model_name": self.model_name,
-                                    "data_name": None,
-                                    "control_count": self.control_count,
-                                    "batch_size": self.batch_size,
-                                    "lr": self.lr,
-                                    "momentum": self.momentum,
-                                    "compute_loss": self.compute_loss,
-                                    "clip_grad_norm": self.clip_grad_norm,
-                                    "label_count": None,
-                                    "cluster": None,
-                                    "special": False}
+                    response = self.start_message(layers, parameters_ref, parameters_hashes,
+                                                  data_name=self.data_name if layer_id == 1 else None, special=special,
+                                                  next_clients=self.next_clients(cluster, layer_id), peers=self.peers(cluster, layer_id),
+                                                  optimizer_state=optimizer_state, upload=upload or layer_id != 1,
+                                                  freeze=self.freeze_policy(layer_id),
+                                                  upstream_frozen=self.upstream_frozen(cluster, layer_id),
+                                                  round_id=self.round_id(cluster, cluster_round.current_local_round + 1),
+                                                  previous_clients=self.previous_clients(cluster, layer_id))
+                    self.record_start(client_id)
                     self.send_to_response(client_id, pickle.dumps(response))
         if cluster is None:
             # Send message to clients when consumed all clients
-            if 'MNIST' in self.data_name:
-                klass = globals()[f'{self.model_name}_MNIST']
-            else:
-                klass = globals()[f'{self.model_name}_{self.data_name}']
-            full_model = klass()
-            if self.model_name != 'ViT':
-                full_model = nn.Sequential(*nn.ModuleList(full_model.children()))
-
+            self.round_start_time = time.time()
+            # Every START of the last round is superseded
+            self.published_tensors = {}
+            reset_buffers = set()
             for (client_id, layer_id, _, clustering) in self.list_clients:
-                # Read parameters file
-                filepath = f'{self.model_name}_{self.data_name}.pth'
                 state_dict = None
+                optimizer_state = None
 
+                if start and self.cluster_rounds[clustering].state != src.Round.TRAINING:
+                    # Cluster sits this round out
+                    continue
                 if start:
-                    if layer_id == 1:
-                        layers = [0, self.list_cut_layers[clustering][0]]
-                    elif layer_id == len(self.total_clients):
-                        layers = [self.list_cut_layers[clustering][-1], -1]
-                    else:
-                        layers = [self.list_cut_layers[clustering][layer_id - 2], self.list_cut_layers[clustering][layer_id - 1]]
-
+                    layers = self.client_layers(clustering, layer_id)
                     if self.load_parameters and register:
-                        if os.path.exists(filepath):
-                            full_state_dict = torch.load(filepath, weights_only=True)
-                            if self.model_name != 'ViT':
-                                full_model.load_state_dict(full_state_dict)
-
-                                if layer_id == 1:
-                                    if layers == [0, 0]:
-                                        model_part = nn.Sequential(*nn.ModuleList(full_model.children())[:])
-                                    else:
-                                        model_part = nn.Sequential(*nn.ModuleList(full_model.children())[:layers[1]])
-                                elif layer_id == len(self.total_clients):
-                                    model_part = nn.Sequential(*nn.ModuleList(full_model.children())[layers[0]:])
-                                else:
-                                    model_part = nn.Sequential(*nn.ModuleList(full_model.children())[layers[0]:layers[1]])
-
-                                state_dict = model_part.state_dict()
-                                self.logger.log_info("Model loaded successfully.")
-                            else:
-                                if layer_id == 1:
-                                    if layers == [0,0]:
-                                        model = klass()
-                                    else:
-                                        model = klass(end_layer=layers[1])
-                                elif layer_id == len(self.total_clients):
-                                    model = klass(start_layer=layers[0])
-                                else:
-                                    model = klass(start_layer=layers[0], end_layer=layers[1])
-                                state_dict = model.state_dict()
-                                keys = state_dict.keys()
-
-                                for key in keys:
-                                    state_dict[key] = full_state_dict[key]
-
+                        if self.checkpoint.exists():
+                            # Read parameters shards
+                            state_dict = self.checkpoint.load_stage(layers[0], layers[1])
+                            self.logger.log_info(f"Model loaded successfully (round {self.checkpoint.latest_round()}).")
                         else:
-                            self.logger.log_info(f"File {filepath} does not exist.")
+                            self.logger.log_info(f"Checkpoint {self.checkpoint.root} does not exist.")
 
-                    src.Log.print_with_color(f"[>>>] Sent start training request to client {client_id}", "red")
-                    if layer_id == 1:
-                        response = {"action": "START",
-                                    "message": "Server accept the connection!",
-                                    "parameters": state_dict,
-                                    "num_layers": len(self.total_clients),
-                                    "layers": layers,
-                                    "model_name": self.model_name,
-                                    "data_name": self.data_name,
-                                    "control_count": self.control_count,
-                                    "batch_size": self.batch_size,
-                                    "lr": self.lr,
-                                    "momentum": self.momentum,
-                                    "clip_grad_norm": self.clip_grad_norm,
-                                    "compute_loss": self.compute_loss,
-                                    "label_count": label_counts.pop(),
-                                    "cluster": clustering,
-                                    "special": self.special}
+                    if state_dict is None and client_id in self.fresh_clients and self.local_avg_state_dict[clustering][layer_id - 1]:
+                        # New or moved client, start it from the last aggregated model of its cluster
+                        state_dict = self.local_avg_state_dict[clustering][layer_id - 1]
+                        optimizer_state = self.local_avg_optimizer_state[clustering][layer_id - 1]
+                        parameters_ref, parameters_hashes = self.publish_parameters(clustering, layer_id, state_dict, {}, client_id=client_id)
                     else:
-                        response = {"action": "START",
-                                    "message": "Server accept the connection!",
-                                    "parameters": state_dict,
-                                    "num_layers": len(self.total_clients),
-                                    "layers": layers,
-                                    "model_name": self.model_name,
-                                    "data_name": self.data_name,
-                                    "control_count": self.control_count,
-                                    "batch_size": self.batch_size,
-                                    "lr": self.lr,
-                                    "momentum": self.momentum,
-                                    "clip_grad_norm": self.clip_grad_norm,
-                                    "compute_loss": self.compute_loss,
-                                    "label_count": None,
-                                    "cluster": clustering,
-                                    "special": self.special}
-
+                        state_dict = self.trainable_parameters(clustering, layer_id, state_dict)
+                        parameters_ref, parameters_hashes = self.publish_parameters(clustering, layer_id, state_dict, published)
+                    if self.async_mode and layer_id == 1:
+                        if clustering not in reset_buffers:
+                            self.async_buffers[clustering].reset(state_dict)
+                            reset_buffers.add(clustering)
+                        self.async_versions[client_id] = self.async_buffers[clustering].version
+                        self.async_active[clustering].add(client_id)
+                    src.Log.print_with_color(f"[>>>] Sent start training request to client {client_id}", "red")
+                    response = self.start_message(layers, parameters_ref, parameters_hashes, data_name=self.data_name,
+                                                  label_count=label_counts.pop() if layer_id == 1 else None,
+                                                  cluster=clustering, special=self.special,
+                                                  next_clients=self.next_clients(clustering, layer_id), peers=self.peers(clustering, layer_id),
+                                                  optimizer_state=optimizer_state,
+                                                  upload=layer_id != 1 or self.async_mode or 1 in self.due_layers(clustering, 0),
+                                                  freeze=self.freeze_policy(layer_id), round_id=self.round_id(clustering),
+                                                  upstream_frozen=self.upstream_frozen(clustering, layer_id),
+                                                  previous_clients=self.previous_clients(clustering, layer_id))
                 else:
                     src.Log.print_with_color(f"[>>>] Sent stop training request to client {client_id}", "red")
                     response = {"action": "STOP",
                                 "message": "Stop training!",
                                 "parameters": None}
+                self.record_start(client_id)
                 self.send_to_response(client_id, pickle.dumps(response))
-        if cluster is not None and special is True:
-            for (client_id, layer_id, _, clustering) in self.list_clients:
-                if clustering == cluster:
-                    if layer_id == 1:
-                        layers = [0, self.list_cut_layers[cluster][0]]
-                    elif layer_id == len(self.total_clients):
-                        layers = [self.list_cut_layers[cluster][-1], -1]
-                    else:
-                        layers = [self.list_cut_layers[cluster][layer_id - 2], self.list_cut_layers[cluster][layer_id - 1]]
+            self.fresh_clients = set()
 
-                    src.Log.print_with_color(f"[>>>] Sent start training request to client {client_id}", "red")
-                    if layer_id == 1:
-                        response = {"action": "START",
-                                    "message": "Server accept the connection!",
-                                    "parameters": self.local_avg_state_dict[cluster][layer_id - 1],
-                                    "num_layers": len(self.total_clients),
-                                    "layers": layers,
-                                    "model_name": self.model_name,
-                                    "data_name": self.data_name,
-                                    "control_count": self.control_count,
-                                    "batch_size": self.batch_size,
-                                    "lr": self.lr,
-                                    "momentum": self.momentum,
-                                    "compute_loss": self.compute_loss,
-                                    "clip_grad_norm": self.clip_grad_norm,
-                                    "label_count": None,
-                                    "cluster": None,
-                                    "special": True}
-                        self.send_to_response(client_id, pickle.dumps(response))
+        if start and not self.async_mode:
+            for round_cluster in ([cluster] if cluster is not None else range(self.num_cluster)):
+                self.arm_timer(round_cluster, self.round_deadline, self.on_round_deadline)
+
+    def freeze_policy(self, layer_id):
+        return src.Freezing.schedule_policy(self.freeze_schedule, self.global_round - self.round + 1, layer_id)
+
+    def upstream_frozen(self, cluster, layer_id):
+        """Every stage before `layer_id` is frozen this round, so no gradient has to cross its input cut."""
+        clusters = range(len(self.list_cut_layers)) if self.special else [cluster]
+        return all(src.Freezing.stage_frozen(self.freeze_policy(upstream), self.client_layers(other, upstream))
+                   for other in clusters for upstream in range(1, layer_id))
+
+    def trainable_parameters(self, cluster, layer_id, state_dict):
+        """
+        Leave the frozen tensors out of a START once every client of (cluster, layer) has uploaded its stage,
+        they already hold them. New clients get the whole stage.
+        """
+        policy = self.freeze_policy(layer_id)
+        if not state_dict or policy is None:
+            return state_dict
+        for (client_id, client_layer_id, _, clustering) in self.list_clients:
+            if clustering == cluster and client_layer_id == layer_id and \
+                    (client_id in self.fresh_clients or not self.client_hashes.get(client_id, {}).get("uploaded")):
+                return state_dict
+        frozen = src.Freezing.frozen_keys(self.model_name, state_dict.keys(), self.client_layers(cluster, layer_id), policy)
+        return {key: value for key, value in state_dict.items() if key not in frozen}
+
+    def client_layers(self, cluster, layer_id):
+        if layer_id == 1:
+            return [0, self.list_cut_layers[cluster][0]]
+        elif layer_id == len(self.total_clients):
+            return [self.list_cut_layers[cluster][-1], -1]
+        else:
+            return [self.list_cut_layers[cluster][layer_id - 2], self.list_cut_layers[cluster][layer_id - 1]]
+
+    def next_clients(self, cluster, layer_id):
+        # Downstream clients a client of (cluster, layer) can route its activations to
+        if layer_id == len(self.total_clients):
+            return []
+        return [client_id for (client_id, other_layer_id, _, clustering) in self.list_clients
+                if other_layer_id == layer_id + 1 and (self.special or clustering == cluster)]
+
+    def previous_clients(self, cluster, layer_id):
+        # Upstream clients sending their activations to a client of (cluster, layer)
+        if layer_id == 1:
+            return []
+        return [str(client_id) for (client_id, other_layer_id, _, clustering) in self.list_clients
+                if other_layer_id == layer_id - 1 and (self.special or clustering == cluster)]
+
+    def round_id(self, cluster, local_round=None):
+        """Global and local round of a training run of a cluster, closed by the end-of-round markers."""
+        if local_round is None:
+            local_round = self.cluster_rounds[cluster].current_local_round
+        return [self.global_round - self.round + 1, local_round]
+
+    def peers(self, cluster, layer_id):
+        # Data-plane endpoints of the clients exchanging activations and gradients with (cluster, layer)
+        neighbours = [client_id for (client_id, other_layer_id, _, clustering) in self.list_clients
+                      if abs(other_layer_id - layer_id) == 1 and (self.special or clustering == cluster)]
+        return {client_id: self.client_endpoints[client_id] for client_id in neighbours if client_id in self.client_endpoints}
+
+    def start_message(self, layers, parameters_ref, parameters_hashes, data_name=None, label_count=None, cluster=None,
+                      special=False, next_clients=None, peers=None, optimizer_state=None, upload=True, freeze=None,
+                      round_id=None, previous_clients=None, upstream_frozen=False):
+        return {"action": "START",
+                "message": "Server accept the connection!",
+                "parameters": None,
+                "parameters_ref": parameters_ref,
+                "parameters_hashes": parameters_hashes,
+                "num_layers": len(self.total_clients),
+                "layers": layers,
+                "model_name": self.model_name,
+                "data_name": data_name,
+                "control_count": self.control_count,
+                "batch_size": self.batch_size,
+                "lr": self.lr,
+                "momentum": self.momentum,
+                "compute_loss": self.compute_loss,
+                "clip_grad_norm": self.clip_grad_norm,
+                "label_count": label_count,
+                "cluster": cluster,
+                "special": special,
+                "micro_batch_timeout": self.micro_batch_timeout,
+                "max_retransmit": self.max_retransmit,
+                "routing": self.routing,
+                "next_clients": next_clients,
+                "previous_clients": previous_clients,
+                "round": round_id,
+                "batching": self.batching,
+                "peers": peers,
+                "network": self.network,
+                "optimizer": self.optimizer_config,
+                "optimizer_state": optimizer_state,
+                "upload": upload,
+                "freeze": freeze,
+                "upstream_frozen": upstream_frozen,
+                "activation_cache": self.activation_cache,
+                "local_loss": self.local_loss,
+                "pipeline": self.pipeline,
+                "aggregator": self.aggregators,
+                "chunk_size": self.chunk_size}
 
     def cluster_client(self):
         list_performance = [-1 for _ in range(len(self.list_clients))]
@@ -450,13 +1001,18 @@ class Server:
         self.local_model_parameters = [[[] for _ in range(len(self.total_clients))] for _ in range(self.num_cluster)]
         self.local_client_sizes = [[[] for _ in range(len(self.total_clients))] for _ in range(self.num_cluster)]
         self.local_avg_state_dict = [[[] for _ in range(len(self.total_clients))] for _ in range(self.num_cluster)]
+        self.local_optimizer_states = [[[] for _ in range(len(self.total_clients))] for _ in range(self.num_cluster)]
+        self.local_avg_optimizer_state = [[None for _ in range(len(self.total_clients))] for _ in range(self.num_cluster)]
         self.total_cluster_size = [0 for _ in range(self.num_cluster)]
-        if self.mode_cluster:
-            self.first_layer_clients_in_each_cluster = [0 for _ in range(self.num_cluster)]
-        else:
-            self.first_layer_clients_in_each_cluster = [0]
-        self.current_infor_cluster = [[0] * len(row) for row in self.infor_cluster]
-        self.current_local_training_round = [0 for _ in range(len(self.infor_cluster))]
+        # In async mode the local rounds of the first layer are replaced by the update quota
+        self.cluster_rounds = [src.Round.ClusterRound(cluster, self.infor_cluster[cluster], 1 if self.async_mode else self.local_round)
+                               for cluster in range(self.num_cluster)]
+        if self.async_mode:
+            async_config = self.aggregation_config["async"]
+            self.async_buffers = [src.Aggregation.AsyncBuffer(async_config["buffer-size"], async_config["mixing"],
+                                                              async_config["staleness-exponent"], async_config["max-staleness"])
+                                  for _ in range(self.num_cluster)]
+            self.async_active = [set() for _ in range(self.num_cluster)]
 
     def start(self):
         self.channel.start_consuming()
@@ -472,38 +1028,121 @@ class Server:
             body=message
         )
 
+    def forget_published(self, superseded):
+        # Tensors of earlier STARTs, (cluster, layer, client) keys matching `superseded`, are no longer served by FETCH
+        self.published_tensors = {key: tensors for key, tensors in self.published_tensors.items() if not superseded(key)}
+
+    def publish_parameters(self, cluster, layer_id, state_dict, published, client_id=None):
+        """
+        Hash the parameters of (cluster, layer) per tensor and publish, once through the `parameters`
+        exchange, only the tensors that some client of that group does not hold yet. START messages
+        carry the digest of that blob and the hash of every tensor. With `client_id` the blob is sent
+        to that client only.
+        """
+        if not state_dict:
+            return None, None
+        if (cluster, layer_id) in published:
+            return published[(cluster, layer_id)]
+
+        hashes = src.Utils.state_dict_hashes(state_dict)
+        tensors = {hashes[key]: value for key, value in state_dict.items()}
+        self.published_tensors[(cluster, layer_id, client_id)] = tensors
+        routing_key = f'{cluster}.{layer_id}'
+
+        missing = set()
+        for (group_client_id, client_layer_id, _, clustering) in self.list_clients:
+            if clustering == cluster and client_layer_id == layer_id and client_id in (None, group_client_id):
+                known = self.client_hashes.setdefault(group_client_id, {"uploaded": set(), "sent": set()})
+                missing |= set(tensors) - known["uploaded"] - known["sent"]
+                known["sent"] = set(tensors)
+                if client_id is None and (group_client_id, routing_key) not in self.parameters_bindings:
+                    reply_queue_name = f'reply_{group_client_id}'
+                    self.reply_channel.queue_declare(reply_queue_name, durable=False)
+                    self.reply_channel.queue_bind(queue=reply_queue_name, exchange='parameters', routing_key=routing_key)
+                    self.parameters_bindings.add((group_client_id, routing_key))
+
+        digest = None
+        if missing and self.chunk_size:
+            if client_id is None:
+                publish = functools.partial(self.reply_channel.basic_publish, exchange='parameters', routing_key=routing_key)
+            else:
+                publish = functools.partial(self.reply_channel.basic_publish, exchange='', routing_key=f'reply_{client_id}')
+            digest = self.stream_parameters({tensor_hash: tensors[tensor_hash] for tensor_hash in missing}, publish,
+                                            f"Parameters of layer {layer_id} in cluster {cluster}")
+        elif missing:
+            payload = pickle.dumps({tensor_hash: tensors[tensor_hash] for tensor_hash in missing})
+            digest = hashlib.sha256(payload).hexdigest()
+            message = {"action": "PARAMETERS",
+                       "message": f"Parameters of layer {layer_id} in cluster {cluster}",
+                       "digest": digest,
+                       "parameters": payload,
+                       "chunks": None}
+            if client_id is None:
+                self.reply_channel.basic_publish(exchange='parameters', routing_key=routing_key, body=pickle.dumps(message))
+            else:
+                self.send_to_response(client_id, pickle.dumps(message))
+        src.Log.print_with_color(f"[>>>] Broadcast {len(missing)}/{len(tensors)} tensors of layer {layer_id} in cluster {cluster}", "red")
+        published[(cluster, layer_id)] = (digest, hashes)
+        return digest, hashes
+
+    def stream_parameters(self, tensors, publish, description):
+        """
+        Publish `tensors` as PARAMETERS_CHUNK blocks of `chunk-size` bytes, then a PARAMETERS message that
+        closes the transfer. Return the digest of the blocks, the reference used by START.
+        """
+        transfer = str(uuid.uuid4())
+        sha256 = hashlib.sha256()
+        chunks = 0
+        for chunk in src.Stream.chunk_tensors(tensors, self.chunk_size):
+            sha256.update(chunk["data"])
+            chunks += 1
+            publish(body=pickle.dumps(dict(chunk, action="PARAMETERS_CHUNK", transfer=transfer)))
+        digest = sha256.hexdigest()
+        publish(body=pickle.dumps({"action": "PARAMETERS", "message": description, "digest": digest, "parameters": None,
+                                   "transfer": transfer, "chunks": chunks}))
+        return digest
+
     def avg_all_parameters(self, cluster=None):
+        self.collect_averages(cluster, self.submit_averages(cluster))
+        self.report_aggregation(f"cluster {cluster}")
+
+    def submit_averages(self, cluster):
+        """Start averaging every layer of a cluster on the pool, return the futures by layer."""
         size = self.local_client_sizes[cluster]
         parameters = self.local_model_parameters[cluster]
+        averages = {}
         for layer, state_dicts in enumerate(parameters):
             local_layer_client_size = size[layer]
-            num_models = len(state_dicts)
-            if num_models == 0:
-                return
+            if len(state_dicts) == 0:
+                # Stage not due this round
+                continue
 
-            denominator = sum(local_layer_client_size)
-            if denominator == 0:
-                print(f"Warning: denominator is zero at layer {layer}, skipping...")
+            if sum(local_layer_client_size) == 0:
+                self.logger.log_warning(f"Denominator is zero at layer {layer}, skipping...")
                 continue
 
-            self.local_avg_state_dict[cluster][layer] = state_dicts[0]
+            name = f"cluster {cluster} layer {layer + 1}"
+            optimizer_futures = None
+            optimizer_states = self.local_optimizer_states[cluster][layer]
+            if self.average_optimizer and len(optimizer_states) == len(state_dicts) and all(optimizer_states):
+                # Momentum buffers, weighted like the parameters
+                optimizer_futures = self.averager.submit(f"{name} momentum", optimizer_states, local_layer_client_size)
+            averages[layer] = (self.averager.submit(name, state_dicts, local_layer_client_size), optimizer_futures)
+        return averages
 
-            for key in state_dicts[0].keys():
-                for i in range(num_models):
-                    if torch.isnan(state_dicts[i][key]).any():
-                        print(f"Warning: NaN detected in {key} at model {i}, replacing with zero.")
-                        state_dicts[i][key] = torch.nan_to_num(state_dicts[i][key])
+    def collect_averages(self, cluster, averages):
+        for layer, (futures, optimizer_futures) in averages.items():
+            # Frozen tensors are not uploaded again, keep the ones of the previous average
+            previous = self.local_avg_state_dict[cluster][layer] or {}
+            self.local_avg_state_dict[cluster][layer] = {**previous, **self.averager.result(futures)}
+            if optimizer_futures is not None:
+                self.local_avg_optimizer_state[cluster][layer] = self.averager.result(optimizer_futures)
 
-                if state_dicts[0][key].dtype != torch.long:
-                    self.local_avg_state_dict[cluster][layer][key] = sum(
-                        state_dicts[i][key].float() * local_layer_client_size[i]
-                        for i in range(num_models)
-                    ) / denominator
-                else:
-                    self.local_avg_state_dict[cluster][layer][key] = sum(
-                        state_dicts[i][key] * local_layer_client_size[i]
-                        for i in range(num_models)
-                    ) // denominator
+    def report_aggregation(self, name):
+        wall_time, timings = self.averager.report()
+        if timings:
+            breakdown = ", ".join(f"{task} {seconds * 1000:.1f}ms" for task, seconds in timings.items())
+            self.logger.log_info(f"Aggregation ({name}) {wall_time * 1000:.1f}ms on {self.averager.workers} workers: {breakdown}")
 
     def concatenate_state_dict(self):
         state_dict_cluster = {}
@@ -519,15 +1158,5 @@ class Server:
                 list_state_dict_cluster[cluster].update(self.local_avg_state_dict[cluster][0])
 
         # Avg all cluster
-        state_dict_full = list_state_dict_cluster[0]
-        for key in list_state_dict_cluster[0].keys():
-            if list_state_dict_cluster[0][key].dtype != torch.long:
-                state_dict_full[key] = sum(
-                    list_state_dict_cluster[i][key]
-                    for i in range(self.num_cluster)) / self.num_cluster
-            else:
-                state_dict_full[key] = sum(
-                    list_state_dict_cluster[i][key]
-                    for i in range(self.num_cluster)) // self.num_cluster
-
-        return state_dict_full
+        futures = self.averager.submit("clusters", list_state_dict_cluster, [1] * self.num_cluster)
+        return self.averager.result(futures)
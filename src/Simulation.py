@@ -0,0 +1,208 @@
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+
+
+class Method:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class Properties:
+    reply_to = None
+
+
+class MemoryBroker:
+    """
+    In-memory stand-in for RabbitMQ, shared by a server and its clients running as threads of one process.
+    `delay(queue, size)` may return (link, latency, bandwidth) to hold a message back as if it crossed a
+    network link: a link sends one message at a time at `bandwidth` bytes/s, then adds `latency` seconds.
+    """
+    def __init__(self, delay=None):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.queues = {}    # queue -> heap of (delivery time, sequence, body)
+        self.bindings = {}  # (exchange, routing key) -> queues
+        self.link_free = {}
+        self.link_stats = {}
+        self.sequence = itertools.count()
+
+    def connect(self):
+        return MemoryConnection(self)
+
+    def declare(self, queue):
+        with self.lock:
+            self.queues.setdefault(queue, [])
+
+    def bind(self, queue, exchange, routing_key):
+        with self.lock:
+            self.bindings.setdefault((exchange, routing_key), set()).add(queue)
+
+    def unbind(self, queue, exchange, routing_key):
+        with self.lock:
+            self.bindings.get((exchange, routing_key), set()).discard(queue)
+
+    def delete(self, queue):
+        with self.lock:
+            self.queues.pop(queue, None)
+
+    def publish(self, exchange, routing_key, body):
+        with self.lock:
+            if exchange == '':
+                queues = [routing_key]
+            else:
+                queues = list(self.bindings.get((exchange, routing_key), ()))
+            now = time.time()
+            for queue in queues:
+                delivery = now
+                link = self.delay(queue, len(body)) if self.delay else None
+                if link is not None:
+                    name, latency, bandwidth = link
+                    sent = max(now, self.link_free.get(name, now)) + (len(body) / bandwidth if bandwidth else 0)
+                    self.link_free[name] = sent
+                    delivery = sent + latency
+                    stats = self.link_stats.setdefault(name, {"messages": 0, "bytes": 0})
+                    stats["messages"] += 1
+                    stats["bytes"] += len(body)
+                heapq.heappush(self.queues.setdefault(queue, []), (delivery, next(self.sequence), body))
+
+    def get(self, queue):
+        message = self.pop(queue)
+        return message[2] if message is not None else None
+
+    def pop(self, queue):
+        with self.lock:
+            messages = self.queues.get(queue)
+            if messages and messages[0][0] <= time.time():
+                return heapq.heappop(messages)
+        return None
+
+    def requeue(self, queue, message):
+        # Back to its place in the queue, as RabbitMQ does with a rejected message
+        with self.lock:
+            heapq.heappush(self.queues.setdefault(queue, []), message)
+
+
+class MemoryConnection:
+    """The part of `pika.BlockingConnection` the server and clients use, on top of a `MemoryBroker`."""
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.callbacks = deque()
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.cancelled = set()
+
+    def channel(self):
+        channel = MemoryChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def call_later(self, delay, callback):
+        timer_id = next(self.timer_ids)
+        heapq.heappush(self.timers, (time.time() + delay, timer_id, callback))
+        return timer_id
+
+    def remove_timeout(self, timer_id):
+        self.cancelled.add(timer_id)
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+
+    def process_data_events(self, time_limit=0):
+        while self.callbacks:
+            self.callbacks.popleft()()
+        while self.timers and self.timers[0][0] <= time.time():
+            _, timer_id, callback = heapq.heappop(self.timers)
+            if timer_id in self.cancelled:
+                self.cancelled.discard(timer_id)
+            else:
+                callback()
+        delivered = False
+        for channel in self.channels:
+            delivered = channel.deliver() or delivered
+        if not delivered and time_limit:
+            time.sleep(time_limit)
+
+    def sleep(self, duration):
+        time.sleep(duration)
+
+    def close(self):
+        pass
+
+
+class MemoryChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.consumers = []
+        self.consuming = False
+        self.delivery_tags = itertools.count(1)
+        self.unacked = {}  # delivery tag -> (queue, message) got without auto_ack
+
+    def queue_declare(self, queue, passive=False, durable=False, exclusive=False, auto_delete=False, arguments=None):
+        self.broker.declare(queue)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        self.broker.bind(queue, exchange, routing_key)
+
+    def queue_unbind(self, queue, exchange=None, routing_key=None, arguments=None):
+        self.broker.unbind(queue, exchange, routing_key)
+
+    def queue_delete(self, queue, if_unused=False, if_empty=False):
+        self.broker.delete(queue)
+
+    def queue_purge(self, queue):
+        self.broker.delete(queue)
+        self.broker.declare(queue)
+
+    def exchange_declare(self, exchange, exchange_type='direct', **kwargs):
+        pass
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.broker.publish(exchange, routing_key, body)
+
+    def basic_get(self, queue, auto_ack=False):
+        message = self.broker.pop(queue)
+        if message is None:
+            return None, None, None
+        delivery_tag = next(self.delivery_tags)
+        if not auto_ack:
+            self.unacked[delivery_tag] = (queue, message)
+        return Method(delivery_tag), Properties(), message[2]
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.unacked.pop(delivery_tag, None)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        queue, message = self.unacked.pop(delivery_tag)
+        if requeue:
+            self.broker.requeue(queue, message)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        self.consumers.append((queue, on_message_callback))
+
+    def deliver(self):
+        delivered = False
+        for queue, callback in self.consumers:
+            body = self.broker.get(queue)
+            if body is not None:
+                callback(self, Method(next(self.delivery_tags)), Properties(), body)
+                delivered = True
+        return delivered
+
+    def start_consuming(self):
+        self.consuming = True
+        while self.consuming:
+            self.connection.process_data_events(time_limit=0.001)
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def close(self):
+        pass
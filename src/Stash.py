@@ -0,0 +1,70 @@
+import torch
+
+
+class WeightStash:
+    """
+    PipeDream weight stashing for the micro-batches of a stage that wait for their gradient. Each
+    micro-batch remembers the weight version it was forwarded with (a copy of the trainable parameters,
+    shared by all micro-batches of that version and freed with the last one), and its backward is
+    replayed through those weights while the optimizer step still updates the current ones. A gradient
+    older than `max_staleness` optimizer steps does not update the weights, 0 accepts any staleness.
+    """
+    def __init__(self, module, max_staleness=0):
+        self.module = module
+        self.max_staleness = max_staleness
+        self.version = 0
+        self.weights = {}   # version -> {name: tensor}
+        self.refs = {}      # version -> micro-batches forwarded with it
+        self.batches = {}   # data_id -> version
+        self.stale = 0
+
+    def forward(self, data_id):
+        """Stash the current weights for a micro-batch that was just forwarded."""
+        self.forget(data_id)
+        if self.version not in self.weights:
+            self.weights[self.version] = {name: param.detach().clone() for name, param in self.module.named_parameters()
+                                          if param.requires_grad}
+        self.refs[self.version] = self.refs.get(self.version, 0) + 1
+        self.batches[data_id] = self.version
+
+    def forget(self, data_id):
+        version = self.batches.pop(data_id, None)
+        if version is None:
+            return
+        self.refs[version] -= 1
+        if self.refs[version] == 0 and version != self.version:
+            self.weights.pop(version)
+            self.refs.pop(version)
+
+    def step(self):
+        """The optimizer updated the weights, later forwards use a new version."""
+        if self.refs.get(self.version) == 0:
+            self.weights.pop(self.version, None)
+            self.refs.pop(self.version)
+        self.version += 1
+
+    def backward(self, data_id, data_input, gradient, input_grad=False):
+        """
+        Backward of a micro-batch through its stashed weights, the gradients are set on the parameters of
+        the module. Return (applied, gradient of `data_input` if `input_grad`). A stale micro-batch only
+        gets its input gradient, through the current weights, so the previous stage is still answered.
+        """
+        stale = self.max_staleness and self.version - self.batches[data_id] > self.max_staleness
+        if stale:
+            self.stale += 1
+            if not input_grad:
+                self.forget(data_id)
+                return False, None
+        params = {} if stale else {name: weight.detach().requires_grad_(True)
+                                   for name, weight in self.weights[self.batches[data_id]].items()}
+        output = torch.func.functional_call(self.module, params, (data_input,))
+        inputs = list(params.values()) + ([data_input] if input_grad else [])
+        grads = torch.autograd.grad(output, inputs, grad_outputs=gradient, allow_unused=True)
+        current = dict(self.module.named_parameters())
+        for name, grad in zip(params, grads):
+            current[name].grad = grad
+        self.forget(data_id)
+        return not stale, grads[-1] if input_grad else None
+
+    def stats(self):
+        return {"versions": len(self.weights), "in_flight": len(self.batches), "stale": self.stale}
@@ -0,0 +1,123 @@
+import zlib
+import pickle
+import hashlib
+
+
+def chunk_tensors(tensors, chunk_size):
+    """
+    Cut a dict of tensors into blocks of at most `chunk_size` bytes. Each tensor is pickled on its own and
+    split into `parts`, so only one serialized tensor is held at a time. Blocks are numbered by `sequence`
+    and carry the CRC-32 of their data.
+    """
+    sequence = 0
+    for key, tensor in tensors.items():
+        data = pickle.dumps(tensor)
+        parts = max(1, -(-len(data) // chunk_size))
+        for part in range(parts):
+            block = data[part * chunk_size:(part + 1) * chunk_size]
+            yield {"sequence": sequence, "key": key, "part": part, "parts": parts, "data": block, "crc": zlib.crc32(block)}
+            sequence += 1
+
+
+class ChunkAssembler:
+    """
+    Rebuild the tensors of a chunked transfer as their blocks arrive, each tensor is unpickled as soon as
+    its last part is in. The transfer is only valid if every block came in order with a matching CRC-32;
+    `digest` is the SHA-256 of all block data.
+    """
+    def __init__(self):
+        self.tensors = {}
+        self.parts = {}
+        self.sequence = 0
+        self.sha256 = hashlib.sha256()
+        self.error = None
+
+    def add(self, chunk):
+        if self.error is not None:
+            return
+        if chunk["sequence"] != self.sequence:
+            self.error = f"expected block {self.sequence}, received {chunk['sequence']}"
+            return
+        if zlib.crc32(chunk["data"]) != chunk["crc"]:
+            self.error = f"CRC mismatch in block {chunk['sequence']}"
+            return
+        self.sequence += 1
+        self.sha256.update(chunk["data"])
+        parts = self.parts.setdefault(chunk["key"], [])
+        parts.append(chunk["data"])
+        if len(parts) == chunk["parts"]:
+            self.tensors[chunk["key"]] = pickle.loads(b"".join(self.parts.pop(chunk["key"])))
+
+    def digest(self):
+        return self.sha256.hexdigest()
+
+    def complete(self, chunks):
+        """All `chunks` blocks are in, or the transfer is already broken, either way it can be closed."""
+        return self.error is not None or self.sequence >= chunks
+
+    def check(self, chunks, digest=None):
+        """Return None if all `chunks` blocks were assembled (and match `digest`), otherwise the problem."""
+        if self.error is None and (self.sequence != chunks or self.parts):
+            self.error = f"{self.sequence}/{chunks} blocks received"
+        if self.error is None and digest is not None and digest != self.digest():
+            self.error = "digest mismatch"
+        return self.error
+
+
+def chunk_update(parameters, optimizer_state, chunk_size):
+    """Blocks of the tensors of an UPDATE, keyed by (field, name)."""
+    tensors = {("parameters", key): value for key, value in parameters.items()}
+    for key, value in (optimizer_state or {}).items():
+        tensors[("optimizer_state", key)] = value
+    return chunk_tensors(tensors, chunk_size)
+
+
+class Uploads:
+    """
+    Chunked UPDATEs being received, per client. The broker only keeps the order of one channel, so a
+    closing UPDATE that overtakes its blocks is held back and handed out again by its last block.
+    """
+    def __init__(self):
+        self.assemblers = {}
+        self.pending = {}
+
+    def add_chunk(self, client_id, chunk):
+        """Add a block, return the held back UPDATE once this block completes it."""
+        if chunk["sequence"] == 0:
+            # A new transfer, whatever is left of a previous one is stale
+            self.assemblers[client_id] = ChunkAssembler()
+        assembler = self.assemblers.setdefault(client_id, ChunkAssembler())
+        assembler.add(chunk)
+        pending = self.pending.get(client_id)
+        if pending is not None and assembler.complete(pending["chunks"]):
+            return self.pending.pop(client_id)
+        return None
+
+    def ready(self, client_id, message):
+        """True if the blocks of a closing UPDATE are all in, otherwise it is held back until they are."""
+        assembler = self.assemblers.get(client_id)
+        if message["chunks"] and (assembler is None or not assembler.complete(message["chunks"])):
+            self.pending[client_id] = message
+            return False
+        return True
+
+    def assemble(self, client_id, message):
+        return assemble_update(message, self.assemblers.pop(client_id, ChunkAssembler()))
+
+    def discard(self, client_id):
+        self.assemblers.pop(client_id, None)
+        self.pending.pop(client_id, None)
+
+
+def assemble_update(message, assembler):
+    """Put the tensors of a chunked UPDATE back into `message`, a broken transfer fails the round result."""
+    error = assembler.check(message["chunks"])
+    fields = {"parameters": {}, "optimizer_state": {}}
+    for (field, key), value in assembler.tensors.items():
+        fields[field][key] = value
+    message["parameters"] = fields["parameters"]
+    message["optimizer_state"] = fields["optimizer_state"] or None
+    message["chunks"] = None
+    if error is not None:
+        message["result"] = False
+    return error
@@ -0,0 +1,461 @@
+import abc
+import time
+import heapq
+import atexit
+import pickle
+import random
+import itertools
+import socket
+import struct
+import hashlib
+import threading
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+
+import src.Log
+
+FRAME_MAGIC = b"SLFRAME1"
+CREATED_RINGS = set()  # rings created by this process, already tracked by its resource tracker
+
+
+class Transport(abc.ABC):
+    """
+    Data-plane interface of `Scheduler`: publish a message body to a named queue and get the next body of
+    a queue. Control messages (REGISTER, START, PAUSE...) always go through RabbitMQ.
+    """
+    address = None
+
+    @abc.abstractmethod
+    def publish(self, queue, body):
+        pass
+
+    @abc.abstractmethod
+    def get(self, queue):
+        """Return the next message body of `queue`, or None."""
+
+    def set_peers(self, peers):
+        pass
+
+    def flush(self, force=False):
+        pass
+
+    def stats(self):
+        return {}
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class RabbitTransport(Transport):
+    def __init__(self, channel):
+        self.channel = channel
+        self.declared = set()
+
+    def declare(self, queue):
+        if queue not in self.declared:
+            self.channel.queue_declare(queue=queue, durable=False)
+            self.declared.add(queue)
+
+    def publish(self, queue, body):
+        self.declare(queue)
+        self.channel.basic_publish(exchange='', routing_key=queue, body=body)
+
+    def get(self, queue):
+        method_frame, header_frame, body = self.channel.basic_get(queue=queue, auto_ack=True)
+        if method_frame and body:
+            return body
+        return None
+
+    def close(self):
+        # The channel belongs to the client
+        pass
+
+
+class TcpTransport(Transport):
+    """
+    Direct peer-to-peer transport. A queue whose name ends with the id of a known peer
+    (`gradient_queue_{layer}_{client_id}`, routed `intermediate_queue_{layer}_{client_id}`) is sent over a
+    TCP connection to that peer, every other queue goes through `fallback`. Peers and their addresses come
+    from the server in START. Each frame is a `!HQ` header (queue name length, body length), the queue
+    name and the body.
+    """
+    HEADER = struct.Struct("!HQ")
+
+    def __init__(self, fallback=None, host="127.0.0.1", port=0):
+        self.fallback = fallback
+        self.peers = {}
+        self.connections = {}
+        self.inbox = {}
+        self.lock = threading.Lock()
+
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def set_peers(self, peers):
+        for client_id, endpoint in peers.items():
+            if endpoint["address"] is not None:
+                self.peers[str(client_id)] = tuple(endpoint["address"])
+
+    def accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                # Closed
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.receive, args=(connection,), daemon=True).start()
+
+    def receive(self, connection):
+        while True:
+            header = self.recv_exact(connection, self.HEADER.size)
+            if header is None:
+                connection.close()
+                return
+            name_size, body_size = self.HEADER.unpack(header)
+            queue = bytes(self.recv_exact(connection, name_size)).decode()
+            body = self.recv_exact(connection, body_size)
+            with self.lock:
+                inbox = self.inbox.setdefault(queue, deque())
+            inbox.append(body)
+
+    @staticmethod
+    def recv_exact(connection, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = connection.recv_into(view[received:])
+            if count == 0:
+                return None
+            received += count
+        return buffer
+
+    def publish(self, queue, body):
+        peer = queue.rsplit("_", 1)[-1]
+        if peer not in self.peers:
+            if self.fallback is None:
+                raise ValueError(f"No peer for queue '{queue}'.")
+            self.fallback.publish(queue, body)
+            return
+
+        try:
+            connection = self.connections.get(peer)
+            if connection is None:
+                connection = socket.create_connection(self.peers[peer])
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.connections[peer] = connection
+            name = queue.encode()
+            connection.sendall(self.HEADER.pack(len(name), len(body)) + name)
+            connection.sendall(body)
+        except OSError as error:
+            # The message is lost, micro-batch timeouts take care of it
+            src.Log.print_with_color(f"Send to peer {peer} failed: {error}", "yellow")
+            connection = self.connections.pop(peer, None)
+            if connection is not None:
+                connection.close()
+
+    def get(self, queue):
+        inbox = self.inbox.get(queue)
+        if inbox:
+            return inbox.popleft()
+        if self.fallback is not None:
+            return self.fallback.get(queue)
+        return None
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+        self.server.close()
+
+
+class SharedMemoryTransport(Transport):
+    """
+    Transport between clients on the same host. Every (sender, receiver) pair has a single-producer
+    single-consumer ring buffer in shared memory, created by the receiver when it learns its peers. Other
+    peers, full rings and messages larger than a ring go through `fallback`.
+
+    Ring layout: capacity, write and read byte counters (uint64), then `capacity` bytes of records. A record
+    is a `!IH` header (body length, queue name length), the queue name and the body.
+    """
+    COUNTERS = struct.Struct("QQQ")
+    HEADER = struct.Struct("!IH")
+
+    def __init__(self, client_id, fallback=None, size=8 << 20, host=None):
+        self.client_id = str(client_id)
+        self.fallback = fallback
+        self.address = fallback.address if fallback is not None else None
+        self.host = host or socket.gethostname()
+        self.size = size
+
+        self.local_peers = set()
+        self.inbound = {}   # peer -> ring we read
+        self.outbound = {}  # peer -> ring we write
+        self.received = {}  # queue -> bodies read from the rings, not returned yet
+        atexit.register(self.close)
+
+    @staticmethod
+    def ring_name(sender, receiver):
+        # Short enough for every platform's shared memory name limit
+        return "sl_" + hashlib.md5(f"{sender}>{receiver}".encode()).hexdigest()[:24]
+
+    def set_peers(self, peers):
+        if self.fallback is not None:
+            self.fallback.set_peers(peers)
+        for client_id, endpoint in peers.items():
+            client_id = str(client_id)
+            if endpoint["host"] != self.host or client_id == self.client_id:
+                continue
+            self.local_peers.add(client_id)
+            if client_id not in self.inbound:
+                self.inbound[client_id] = self.create(self.ring_name(client_id, self.client_id))
+
+    def create(self, name):
+        try:
+            ring = shared_memory.SharedMemory(name=name, create=True, size=self.COUNTERS.size + self.size)
+        except FileExistsError:
+            # Left over by a crashed client
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            CREATED_RINGS.discard(name)
+            ring = shared_memory.SharedMemory(name=name, create=True, size=self.COUNTERS.size + self.size)
+        self.COUNTERS.pack_into(ring.buf, 0, self.size, 0, 0)
+        CREATED_RINGS.add(name)
+        return ring
+
+    def attach(self, peer):
+        try:
+            ring = shared_memory.SharedMemory(name=self.ring_name(self.client_id, peer))
+        except FileNotFoundError:
+            # The peer did not create it yet, or does not share our /dev/shm
+            return None
+        if ring.name not in CREATED_RINGS:
+            # The receiver owns the ring, do not let our resource tracker unlink it when we exit
+            resource_tracker.unregister(ring._name, "shared_memory")
+        self.outbound[peer] = ring
+        return ring
+
+    def publish(self, queue, body):
+        peer = queue.rsplit("_", 1)[-1]
+        if peer in self.local_peers:
+            ring = self.outbound.get(peer) or self.attach(peer)
+            if ring is not None and self.write(ring, queue, body):
+                return
+        if self.fallback is None:
+            raise ValueError(f"No room or no peer for queue '{queue}'.")
+        self.fallback.publish(queue, body)
+
+    def write(self, ring, queue, body):
+        name = queue.encode()
+        header = self.HEADER.pack(len(body), len(name)) + name
+        capacity, write, read = self.COUNTERS.unpack_from(ring.buf, 0)
+        if len(header) + len(body) > capacity - (write - read):
+            return False
+        self.copy_in(ring, capacity, write, header)
+        self.copy_in(ring, capacity, write + len(header), body)
+        # Publish the record only once it is complete
+        struct.pack_into("Q", ring.buf, 8, write + len(header) + len(body))
+        return True
+
+    def copy_in(self, ring, capacity, position, data):
+        data = memoryview(data)
+        start = position % capacity
+        first = min(len(data), capacity - start)
+        offset = self.COUNTERS.size
+        ring.buf[offset + start:offset + start + first] = data[:first]
+        if first < len(data):
+            ring.buf[offset:offset + len(data) - first] = data[first:]
+
+    def copy_out(self, ring, capacity, position, size):
+        start = position % capacity
+        first = min(size, capacity - start)
+        offset = self.COUNTERS.size
+        data = bytes(ring.buf[offset + start:offset + start + first])
+        if first < size:
+            data += bytes(ring.buf[offset:offset + size - first])
+        return data
+
+    def drain(self, ring):
+        capacity, write, read = self.COUNTERS.unpack_from(ring.buf, 0)
+        while read < write:
+            body_size, name_size = self.HEADER.unpack(self.copy_out(ring, capacity, read, self.HEADER.size))
+            read += self.HEADER.size
+            queue = self.copy_out(ring, capacity, read, name_size).decode()
+            read += name_size
+            self.received.setdefault(queue, deque()).append(self.copy_out(ring, capacity, read, body_size))
+            read += body_size
+            struct.pack_into("Q", ring.buf, 16, read)
+
+    def get(self, queue):
+        received = self.received.get(queue)
+        if not received:
+            for ring in self.inbound.values():
+                self.drain(ring)
+            received = self.received.get(queue)
+        if received:
+            return received.popleft()
+        if self.fallback is not None:
+            return self.fallback.get(queue)
+        return None
+
+    def close(self):
+        for ring in self.outbound.values():
+            ring.close()
+        for ring in self.inbound.values():
+            ring.close()
+            if ring.name in CREATED_RINGS:
+                ring.unlink()
+                CREATED_RINGS.discard(ring.name)
+        self.outbound = {}
+        self.inbound = {}
+
+
+class BatchingTransport(Transport):
+    """
+    Messages to the same queue are packed into one frame until `max_messages` or `max_bytes` is reached
+    or the oldest one has waited `max_delay` seconds, and unpacked again on receipt. With `max_messages`
+    = 1 every message is published on its own, as before.
+    """
+    def __init__(self, transport, max_messages=1, max_bytes=1 << 20, max_delay=0.005):
+        self.transport = transport
+        self.address = transport.address
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self.pending = {}   # queue -> [time of the oldest message, bytes, bodies]
+        self.received = {}  # queue -> bodies unpacked from a frame, not read yet
+        self.sent_messages = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+
+    def set_peers(self, peers):
+        self.transport.set_peers(peers)
+
+    def publish(self, queue, body):
+        self.sent_messages += 1
+        if self.max_messages <= 1:
+            self.send(queue, body)
+            return
+        pending = self.pending.setdefault(queue, [time.time(), 0, []])
+        pending[1] += len(body)
+        pending[2].append(body)
+        if len(pending[2]) >= self.max_messages or pending[1] >= self.max_bytes:
+            self.flush_queue(queue)
+
+    def flush(self, force=False):
+        """Send the frames that used up their latency budget, or all of them with `force`."""
+        now = time.time()
+        for queue, (first, _, _) in list(self.pending.items()):
+            if force or now - first >= self.max_delay:
+                self.flush_queue(queue)
+        self.transport.flush(force)
+
+    def flush_queue(self, queue):
+        _, _, bodies = self.pending.pop(queue)
+        if len(bodies) == 1:
+            self.send(queue, bodies[0])
+        else:
+            self.send(queue, FRAME_MAGIC + pickle.dumps(bodies))
+
+    def send(self, queue, body):
+        self.transport.publish(queue, body)
+        self.sent_frames += 1
+        self.sent_bytes += len(body)
+
+    def get(self, queue):
+        received = self.received.get(queue)
+        if received:
+            return received.popleft()
+        body = self.transport.get(queue)
+        if body is None or body[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+            return body
+        received = self.received.setdefault(queue, deque())
+        received.extend(pickle.loads(body[len(FRAME_MAGIC):]))
+        return received.popleft()
+
+    def close(self):
+        # The wrapped transport outlives this one
+        self.flush(force=True)
+
+    def stats(self):
+        return {"messages": self.sent_messages, "frames": self.sent_frames, "bytes": self.sent_bytes}
+
+
+class EmulatedTransport(Transport):
+    """
+    Hold activations and gradients back as if they crossed an edge link. `links[i]` is the link between
+    layer i + 1 and layer i + 2, in both directions: `latency` and up to `jitter` more seconds, `bandwidth`
+    in bytes/s (0 is unlimited) and `loss`, the probability of dropping a message. Each direction of a link
+    sends one message at a time. Messages are handed to the wrapped transport once delivered.
+    """
+    def __init__(self, transport, links, seed=None):
+        self.transport = transport
+        self.address = transport.address
+        self.links = links
+        self.random = random.Random(seed)
+
+        self.link_free = {}  # (link, direction) -> time the link is done sending
+        self.pending = []    # heap of (delivery time, sequence, queue, body)
+        self.sequence = itertools.count()
+        self.dropped = 0
+
+    def link(self, queue):
+        # Layer l sends activations through `intermediate_queue_{l}...`, layer l + 1 answers with gradients
+        # through `gradient_queue_{l}_...`, both cross link l
+        for prefix, direction in (("intermediate_queue_", "forward"), ("gradient_queue_", "backward")):
+            if queue.startswith(prefix):
+                layer = int(queue[len(prefix):].split("_", 1)[0])
+                if layer <= len(self.links):
+                    return layer, direction
+        return None
+
+    def set_peers(self, peers):
+        self.transport.set_peers(peers)
+
+    def publish(self, queue, body):
+        link = self.link(queue)
+        if link is None:
+            self.transport.publish(queue, body)
+            return
+        config = self.links[link[0] - 1]
+        if config["loss"] and self.random.random() < config["loss"]:
+            self.dropped += 1
+            return
+
+        now = time.time()
+        sent = max(now, self.link_free.get(link, now))
+        if config["bandwidth"]:
+            sent += len(body) / config["bandwidth"]
+        self.link_free[link] = sent
+        delivery = sent + config["latency"] + self.random.uniform(0, config["jitter"])
+        heapq.heappush(self.pending, (delivery, next(self.sequence), queue, body))
+        self.deliver()
+
+    def deliver(self, wait=False):
+        while self.pending:
+            delay = self.pending[0][0] - time.time()
+            if delay > 0:
+                if not wait:
+                    return
+                time.sleep(delay)
+            _, _, queue, body = heapq.heappop(self.pending)
+            self.transport.publish(queue, body)
+
+    def flush(self, force=False):
+        self.deliver(wait=force)
+        self.transport.flush(force)
+
+    def get(self, queue):
+        self.deliver()
+        return self.transport.get(queue)
+
+    def close(self):
+        self.deliver(wait=True)
+
+    def stats(self):
+        return {"dropped": self.dropped, "in_flight": len(self.pending)}
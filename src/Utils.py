@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import hashlib
 import pika
 from requests.auth import HTTPBasicAuth
 import requests
@@ -19,7 +20,7 @@ def delete_old_queues(address, username, password, virtual_host):
         for queue in queues:
             queue_name = queue['name']
             if queue_name.startswith("reply") or queue_name.startswith("intermediate_queue") or queue_name.startswith(
-                    "gradient_queue") or queue_name.startswith("rpc_queue"):
+                    "gradient_queue") or queue_name.startswith("rpc_queue") or queue_name.startswith("aggregate_queue"):
 
                 http_channel.queue_delete(queue=queue_name)
 
@@ -45,6 +46,17 @@ def change_state_dict(state_dicts, i):
     return new_state_dict
 
 
+def tensor_hash(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    digest = hashlib.sha256(f"{tensor.dtype}{tuple(tensor.shape)}".encode())
+    digest.update(tensor.numpy().reshape(-1).data)
+    return digest.hexdigest()
+
+
+def state_dict_hashes(state_dict):
+    return {key: tensor_hash(value) for key, value in state_dict.items()}
+
+
 def non_iid_rate(num_data, rate):
     result = []
     for _ in range(num_data):
@@ -1,5 +1,4 @@
 import torch
-import torch.nn as nn
 import numpy as np
 import math
 from tqdm import tqdm
@@ -34,16 +33,7 @@ def test(model_name, data_name, state_dict_full, logger):
 
     test_loader = torch.utils.data.DataLoader(testset, batch_size=100, shuffle=False, num_workers=2)
 
-    if 'MNIST' in data_name:
-        klass = globals()[f'{model_name}_MNIST']
-    else:
-        klass = globals()[f'{model_name}_{data_name}']
-    if klass is None:
-        raise ValueError(f"Class '{model_name}' does not exist.")
-
-    model = klass()
-    if model_name != 'ViT':
-         model = nn.Sequential(*nn.ModuleList(model.children()))
+    model = build_stage(model_name, data_name, 0, 0)
     model.load_state_dict(state_dict_full)
     # evaluation mode
     model.eval()
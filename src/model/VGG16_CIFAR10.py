@@ -1,112 +1,71 @@
 import torch.nn as nn
 
 class VGG16_CIFAR10(nn.Module):
-    def __init__(self):
+    def __init__(self, start_layer=0, end_layer=52):
         super(VGG16_CIFAR10, self).__init__()
-        self.layer1 = nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1)
-        self.layer2 = nn.BatchNorm2d(64)
-        self.layer3 = nn.ReLU()
-        self.layer4 = nn.Conv2d(64, 64, kernel_size=3, stride=1, padding=1)
-        self.layer5 = nn.BatchNorm2d(64)
-        self.layer6 = nn.ReLU()
-        self.layer7 = nn.MaxPool2d(kernel_size=2, stride=2)
-        self.layer8 = nn.Conv2d(64, 128, kernel_size=3, stride=1, padding=1)
-        self.layer9 = nn.BatchNorm2d(128)
-        self.layer10 = nn.ReLU()
-        self.layer11 = nn.Conv2d(128, 128, kernel_size=3, stride=1, padding=1)
-        self.layer12 = nn.BatchNorm2d(128)
-        self.layer13 = nn.ReLU()
-        self.layer14 = nn.MaxPool2d(kernel_size=2, stride=2)
-        self.layer15 = nn.Conv2d(128, 256, kernel_size=3, stride=1, padding=1)
-        self.layer16 = nn.BatchNorm2d(256)
-        self.layer17 = nn.ReLU()
-        self.layer18 = nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1)
-        self.layer19 = nn.BatchNorm2d(256)
-        self.layer20 = nn.ReLU()
-        self.layer21 = nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1)
-        self.layer22 = nn.BatchNorm2d(256)
-        self.layer23 = nn.ReLU()
-        self.layer24 = nn.MaxPool2d(kernel_size=2, stride=2)
-        self.layer25 = nn.Conv2d(256, 512, kernel_size=3, stride=1, padding=1)
-        self.layer26 = nn.BatchNorm2d(512)
-        self.layer27 = nn.ReLU()
-        self.layer28 = nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1)
-        self.layer29 = nn.BatchNorm2d(512)
-        self.layer30 = nn.ReLU()
-        self.layer31 = nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1)
-        self.layer32 = nn.BatchNorm2d(512)
-        self.layer33 = nn.ReLU()
-        self.layer34 = nn.MaxPool2d(kernel_size=2, stride=2)
-        self.layer35 = nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1)
-        self.layer36 = nn.BatchNorm2d(512)
-        self.layer37 = nn.ReLU()
-        self.layer38 = nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1)
-        self.layer39 = nn.BatchNorm2d(512)
-        self.layer40 = nn.ReLU()
-        self.layer41 = nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1)
-        self.layer42 = nn.BatchNorm2d(512)
-        self.layer43 = nn.ReLU()
-        self.layer44 = nn.MaxPool2d(kernel_size=2, stride=2)
-        self.layer45 = nn.Flatten(1, -1)
-        self.layer46 = nn.Dropout(0.5)
-        self.layer47 = nn.Linear(1 * 1 * 512, 4096)
-        self.layer48 = nn.ReLU()
-        self.layer49 = nn.Dropout(0.5)
-        self.layer50 = nn.Linear(4096, 4096)
-        self.layer51 = nn.ReLU()
-        self.layer52 = nn.Linear(4096, 10)
+        self.start_layer = start_layer
+        self.end_layer = end_layer
 
-    def forward(self, input0):
-        out1 = self.layer1(input0)
-        out2 = self.layer2(out1)
-        out3 = self.layer3(out2)
-        out4 = self.layer4(out3)
-        out5 = self.layer5(out4)
-        out6 = self.layer6(out5)
-        out7 = self.layer7(out6)
-        out8 = self.layer8(out7)
-        out9 = self.layer9(out8)
-        out10 = self.layer10(out9)
-        out11 = self.layer11(out10)
-        out12 = self.layer12(out11)
-        out13 = self.layer13(out12)
-        out14 = self.layer14(out13)
-        out15 = self.layer15(out14)
-        out16 = self.layer16(out15)
-        out17 = self.layer17(out16)
-        out18 = self.layer18(out17)
-        out19 = self.layer19(out18)
-        out20 = self.layer20(out19)
-        out21 = self.layer21(out20)
-        out22 = self.layer22(out21)
-        out23 = self.layer23(out22)
-        out24 = self.layer24(out23)
-        out25 = self.layer25(out24)
-        out26 = self.layer26(out25)
-        out27 = self.layer27(out26)
-        out28 = self.layer28(out27)
-        out29 = self.layer29(out28)
-        out30 = self.layer30(out29)
-        out31 = self.layer31(out30)
-        out32 = self.layer32(out31)
-        out33 = self.layer33(out32)
-        out34 = self.layer34(out33)
-        out35 = self.layer35(out34)
-        out36 = self.layer36(out35)
-        out37 = self.layer37(out36)
-        out38 = self.layer38(out37)
-        out39 = self.layer39(out38)
-        out40 = self.layer40(out39)
-        out41 = self.layer41(out40)
-        out42 = self.layer42(out41)
-        out43 = self.layer43(out42)
-        out44 = self.layer44(out43)
-        out45 = self.layer45(out44)
-        out46 = self.layer46(out45)
-        out47 = self.layer47(out46)
-        out48 = self.layer48(out47)
-        out49 = self.layer49(out48)
-        out50 = self.layer50(out49)
-        out51 = self.layer51(out50)
-        out52 = self.layer52(out51)
-        return out52
\ No newline at end of file
+        # Only the layers in [start_layer, end_layer) are instantiated, so a stage never
+        # allocates the parameters of the layers held by other clients.
+        layers = [
+            lambda: nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(64),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(64, 64, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(64),
+            lambda: nn.ReLU(),
+            lambda: nn.MaxPool2d(kernel_size=2, stride=2),
+            lambda: nn.Conv2d(64, 128, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(128),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(128, 128, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(128),
+            lambda: nn.ReLU(),
+            lambda: nn.MaxPool2d(kernel_size=2, stride=2),
+            lambda: nn.Conv2d(128, 256, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(256),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(256),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(256),
+            lambda: nn.ReLU(),
+            lambda: nn.MaxPool2d(kernel_size=2, stride=2),
+            lambda: nn.Conv2d(256, 512, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(512),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(512),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(512),
+            lambda: nn.ReLU(),
+            lambda: nn.MaxPool2d(kernel_size=2, stride=2),
+            lambda: nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(512),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(512),
+            lambda: nn.ReLU(),
+            lambda: nn.Conv2d(512, 512, kernel_size=3, stride=1, padding=1),
+            lambda: nn.BatchNorm2d(512),
+            lambda: nn.ReLU(),
+            lambda: nn.MaxPool2d(kernel_size=2, stride=2),
+            lambda: nn.Flatten(1, -1),
+            lambda: nn.Dropout(0.5),
+            lambda: nn.Linear(1 * 1 * 512, 4096),
+            lambda: nn.ReLU(),
+            lambda: nn.Dropout(0.5),
+            lambda: nn.Linear(4096, 4096),
+            lambda: nn.ReLU(),
+            lambda: nn.Linear(4096, 10),
+        ]
+        for idx in range(self.start_layer, self.end_layer):
+            setattr(self, f'layer{idx + 1}', layers[idx]())
+
+    def forward(self, x):
+        for layer in self.children():
+            x = layer(x)
+        return x
@@ -1,6 +1,74 @@
+import torch.nn as nn
+
 from .MobileNetv1_CIFAR10 import *
 from .MobileNetv1_MNIST import *
 from .VGG16_CIFAR10 import *
 from .VGG16_MNIST import *
 from .ViT_CIFAR10 import *
 from .ViT_MNIST import *
+
+
+def get_model_class(model_name, data_name):
+    if 'MNIST' in data_name:
+        klass = globals().get(f'{model_name}_MNIST')
+    else:
+        klass = globals().get(f'{model_name}_{data_name}')
+    if klass is None:
+        raise ValueError(f"Class '{model_name}' does not exist.")
+    return klass
+
+
+def stage_range(start, end):
+    """
+    Normalize the `layers` pair sent by the server: `[0, 0]` is the whole model and an end of -1 is
+    the last layer.
+    """
+    if end == 0:
+        return 0, None
+    if end == -1:
+        return start, None
+    return start, end
+
+
+def build_stage(model_name, data_name, start, end):
+    """
+    Build only the layers [start, end) of a model. CNN stages are returned as `nn.Sequential` with
+    keys relative to `start` (the format exchanged with the server), ViT stages keep their own keys.
+    """
+    klass = get_model_class(model_name, data_name)
+    start, end = stage_range(start, end)
+    if end is None:
+        model = klass(start_layer=start)
+    else:
+        model = klass(start_layer=start, end_layer=end)
+    if model_name != 'ViT':
+        model = nn.Sequential(*nn.ModuleList(model.children()))
+    return model
+
+
+def vit_layer_index(key):
+    if key.startswith('cls_token'):
+        return 3
+    if key.startswith('pos_embed'):
+        return 4
+    return int(key.split(".", 1)[0][len('layer'):])
+
+
+def stage_state_dict(model_name, full_state_dict, start, end):
+    """
+    Slice a full-model state dict down to the stage [start, end), mapping keys the same way as
+    `build_stage`.
+    """
+    start, end = stage_range(start, end)
+    state_dict = {}
+    for key, value in full_state_dict.items():
+        if model_name != 'ViT':
+            index, name = key.split(".", 1)
+            index = int(index)
+            if index >= start and (end is None or index < end):
+                state_dict[f"{index - start}.{name}"] = value
+        else:
+            index = vit_layer_index(key)
+            if index > start and (end is None or index <= end):
+                state_dict[key] = value
+    return state_dict
@@ -0,0 +1,67 @@
+import torch
+
+import src.Aggregation
+
+
+def test_parallel_average_matches_the_plain_average():
+    state_dicts = [{"0.weight": torch.randn(64, 32), "0.bias": torch.randn(64), "1.weight": torch.randn(10, 64),
+                    "1.num_batches_tracked": torch.tensor(step)} for step in (3, 4, 8)]
+    sizes = [10, 20, 30]
+    averager = src.Aggregation.ParallelAverager(workers=4, group_size=100)
+    threads = torch.get_num_threads()
+    futures = averager.submit("cluster 0, layer 1", state_dicts, sizes)
+    assert len(futures) > 1
+    average = averager.result(futures)
+    expected = src.Aggregation.weighted_average(state_dicts, sizes)
+    assert average.keys() == expected.keys()
+    for key, value in expected.items():
+        assert torch.equal(average[key], value)
+    assert torch.get_num_threads() == threads
+    wall_time, timings = averager.report()
+    assert list(timings) == ["cluster 0, layer 1"]
+
+
+def test_parallel_average_skips_keys_not_held_by_every_client():
+    state_dicts = [{"w": torch.ones(4), "frozen": torch.ones(4)}, {"w": torch.zeros(4)}]
+    averager = src.Aggregation.ParallelAverager(workers=2)
+    average = averager.result(averager.submit("layer", state_dicts, [1, 1]))
+    assert list(average) == ["w"]
+    assert torch.equal(average["w"], torch.full((4,), 0.5))
+
+
+def test_parallel_average_divides_the_torch_threads_while_running(monkeypatch):
+    seen = []
+    weighted_average = src.Aggregation.weighted_average
+
+    def recorded(state_dicts, sizes):
+        seen.append(torch.get_num_threads())
+        return weighted_average(state_dicts, sizes)
+
+    monkeypatch.setattr(src.Aggregation, "weighted_average", recorded)
+    averager = src.Aggregation.ParallelAverager(workers=2)
+    threads = torch.get_num_threads()
+    averager.result(averager.submit("layer", [{"w": torch.ones(4)}, {"w": torch.zeros(4)}], [1, 1]))
+    assert seen == [averager.threads]
+    assert torch.get_num_threads() == threads
+
+
+def test_async_buffer_without_staleness_is_the_plain_average():
+    buffer = src.Aggregation.AsyncBuffer(buffer_size=2)
+    buffer.reset({"w": torch.zeros(3)})
+    assert buffer.add({"w": torch.full((3,), 2.0)}, 10, 0)
+    assert buffer.version == 0
+    assert buffer.add({"w": torch.full((3,), 5.0)}, 20, 0)
+    assert buffer.version == 1 and buffer.merged_size == 30
+    assert torch.allclose(buffer.state_dict["w"], torch.full((3,), 4.0))
+
+
+def test_async_buffer_discounts_stale_updates():
+    buffer = src.Aggregation.AsyncBuffer(buffer_size=1, staleness_exponent=1.0, max_staleness=2)
+    buffer.reset({"w": torch.zeros(1)})
+    buffer.version = 3
+    # Staleness 1: the delta is weighted by (1 + 1) ^ -1
+    assert buffer.add({"w": torch.ones(1)}, 10, 2)
+    assert torch.allclose(buffer.state_dict["w"], torch.tensor([0.5]))
+    # Staleness 3 is beyond max_staleness
+    assert not buffer.add({"w": torch.ones(1)}, 10, 1)
+    assert buffer.dropped == 1 and buffer.version == 4
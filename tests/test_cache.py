@@ -0,0 +1,38 @@
+import torch
+import torch.nn as nn
+
+import src.Cache
+import src.Freezing
+from src.Scheduler import Scheduler
+from src.Simulation import MemoryBroker
+
+
+def test_partly_cached_batch():
+    cache = src.Cache.ActivationCache(dtype="float32")
+    rows = torch.randn(2, 3)
+    cache.put(torch.tensor([5, 7]), rows)
+    cached, hit, missing = cache.get(torch.tensor([1, 7, 5, 9]), "cpu")
+    assert hit == [1, 2] and missing == [0, 3]
+    assert torch.equal(cached, rows[[1, 0]])
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+    assert cache.get(torch.tensor([2]), "cpu") == (None, [], [0])
+
+
+def test_prefix_output_runs_only_the_missing_samples():
+    model = nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Linear(8, 2))
+    scheduler = Scheduler("client", 1, MemoryBroker().connect().channel(), "cpu")
+    scheduler.freezer = src.Freezing.Freezer(model, {"0.weight", "0.bias"})
+    scheduler.freezer.train()
+    scheduler.activation_cache = src.Cache.ActivationCache(dtype="float32")
+    scheduler.cache_active = True
+
+    data = torch.randn(6, 4)
+    with torch.no_grad():
+        expected = model[1](model[0](data))
+    first = scheduler.prefix_output(data[:3], torch.tensor([0, 1, 2]))
+    assert torch.allclose(first, expected[:3])
+    # Second epoch, shuffled: samples 2 and 0 are cached, 4 and 5 are not
+    order = [4, 2, 5, 0]
+    output = scheduler.prefix_output(data[order], torch.tensor(order))
+    assert torch.allclose(output, expected[order])
+    assert scheduler.activation_cache.stats() == {"rows": 5, "hits": 2, "misses": 5, "evictions": 0}
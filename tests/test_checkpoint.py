@@ -0,0 +1,41 @@
+import os
+
+import torch
+
+import src.Checkpoint
+
+
+def full_state_dict(value):
+    return {f"{layer}.weight": torch.full((2, 2), float(value)) for layer in range(3)}
+
+
+def test_save_and_load_a_stage(tmp_path):
+    store = src.Checkpoint.CheckpointStore(str(tmp_path / "VGG16_CIFAR10"), "VGG16")
+    assert not store.exists()
+    store.save(full_state_dict(1), 1)
+    stage = store.load_stage(1, 3)
+    assert sorted(stage) == ["0.weight", "1.weight"]
+    assert torch.equal(stage["0.weight"], torch.ones(2, 2))
+    assert store.load_stage(1, 3) is stage
+
+
+def test_prune_keeps_the_last_rounds(tmp_path):
+    root = tmp_path / "VGG16_CIFAR10"
+    store = src.Checkpoint.CheckpointStore(str(root), "VGG16", keep_rounds=2)
+    for round_id in range(1, 5):
+        store.save(full_state_dict(round_id), round_id)
+    assert sorted(name for name in os.listdir(root) if name.startswith("round_")) == ["round_3", "round_4"]
+    assert store.latest_round() == 4
+
+
+def test_resume_reads_the_manifest_and_imports_a_legacy_file(tmp_path):
+    legacy_file = tmp_path / "VGG16_CIFAR10.pth"
+    torch.save(full_state_dict(7), legacy_file)
+    root = str(tmp_path / "VGG16_CIFAR10")
+    store = src.Checkpoint.CheckpointStore(root, "VGG16", legacy_file=str(legacy_file))
+    assert store.latest_round() == 0
+    store.save(full_state_dict(8), store.latest_round() + 1)
+
+    resumed = src.Checkpoint.CheckpointStore(root, "VGG16", legacy_file=str(legacy_file))
+    assert resumed.latest_round() == 1
+    assert torch.equal(resumed.load_stage(0, 0)["2.weight"], torch.full((2, 2), 8.0))
@@ -0,0 +1,21 @@
+import torch
+import torch.nn as nn
+
+import src.Loss
+
+
+def test_prox_term_is_the_sum_of_tensor_norms():
+    model = nn.Sequential(nn.Linear(8, 4), nn.ReLU(), nn.Linear(4, 2))
+    loss = src.Loss.RegularizedLoss({"mode": src.Loss.FEDPROX, "FedProx": {"mu": 0.1}}, model)
+    assert loss.prox_term().item() == 0
+    global_params = [param.detach().clone() for param in model.parameters()]
+    with torch.no_grad():
+        model[0].weight.add_(torch.randn_like(model[0].weight))
+        model[2].bias.add_(1.0)
+    expected = sum(torch.norm(param - global_param) for param, global_param in zip(model.parameters(), global_params))
+    prox = loss.prox_term()
+    assert torch.allclose(prox, expected)
+    prox.backward()
+    # Unchanged tensors get a zero subgradient
+    assert torch.count_nonzero(model[0].bias.grad) == 0
+    assert torch.count_nonzero(model[0].weight.grad) > 0
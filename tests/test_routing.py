@@ -0,0 +1,52 @@
+import pytest
+
+import src.Routing
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        src.Routing.Router(src.Routing.SHARED, ["a", "b"])
+
+
+def test_least_outstanding_balances_unanswered_micro_batches():
+    router = src.Routing.Router(src.Routing.LEAST_OUTSTANDING, ["a", "b"])
+    targets = [router.route(data_id) for data_id in range(4)]
+    assert sorted(targets) == ["a", "a", "b", "b"]
+    for data_id, target in enumerate(targets):
+        if target == "a":
+            router.answered(data_id)
+    assert router.route(4) == "a"
+    assert router.outstanding == {"a": 1, "b": 2}
+
+
+def test_throughput_prefers_the_faster_target():
+    router = src.Routing.Router(src.Routing.THROUGHPUT, ["a", "b"])
+    assert router.route(0) == "a"
+    router.answered(0)
+    # Untried targets are chosen first
+    assert router.route(1) == "b"
+    router.answered(1)
+    router.latency = {"a": 0.01, "b": 1.0}
+    assert [router.route(data_id) for data_id in range(2, 5)] == ["a", "a", "a"]
+    # The expected completion grows with the micro-batches already waiting
+    router.latency = {"a": 0.5, "b": 1.0}
+    assert router.route(5) == "b"
+
+
+def test_hash_is_stable_and_spreads_micro_batches():
+    router = src.Routing.Router(src.Routing.HASH, ["a", "b", "c"])
+    other = src.Routing.Router(src.Routing.HASH, ["a", "b", "c"])
+    targets = [router.route(f"batch-{i}") for i in range(300)]
+    assert targets == [other.route(f"batch-{i}") for i in range(300)]
+    assert all(targets.count(target) > 50 for target in ("a", "b", "c"))
+
+
+def test_retransmission_gives_up_the_previous_target():
+    router = src.Routing.Router(src.Routing.LEAST_OUTSTANDING, ["a", "b"])
+    router.route(0)
+    router.route(0)
+    assert sum(router.outstanding.values()) == 1
+    assert router.stats()["a"]["sent"] + router.stats()["b"]["sent"] == 2
+    router.forget(0)
+    router.answered(0)
+    assert router.outstanding == {"a": 0, "b": 0}
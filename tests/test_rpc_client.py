@@ -0,0 +1,50 @@
+import pickle
+
+import torch
+
+import src.Utils
+from src.RpcClient import RpcClient
+from src.Simulation import MemoryBroker
+
+
+def fetch_reply(tensors, error=None):
+    return pickle.dumps({"action": "PARAMETERS", "message": "", "digest": None, "parameters": pickle.dumps(tensors),
+                         "chunks": None, "error": error})
+
+
+def client_with_replies(*bodies):
+    broker = MemoryBroker()
+    client = RpcClient("client", 1, None, None, None, None, "cpu", connection_factory=broker.connect)
+    client.channel.queue_declare("reply_client")
+    for body in bodies:
+        client.channel.basic_publish(exchange='', routing_key="reply_client", body=body)
+    return client
+
+
+def test_fetch_keeps_the_control_messages_in_order():
+    state_dict = {"0.weight": torch.randn(3, 3)}
+    hashes = src.Utils.state_dict_hashes(state_dict)
+    pause = pickle.dumps({"action": "PAUSE", "message": "", "parameters": None, "round": None})
+    client = client_with_replies(pause, fetch_reply({hashes["0.weight"]: state_dict["0.weight"]}))
+
+    # The broadcast blob of an unknown reference was lost, the tensors are fetched
+    loaded = client.load_parameters("unknown-digest", hashes)
+    assert torch.equal(loaded["0.weight"], state_dict["0.weight"])
+    assert pickle.loads(client.channel.basic_get("reply_client", auto_ack=True)[2])["action"] == "PAUSE"
+    assert client.channel.basic_get("reply_client", auto_ack=True)[2] is None
+
+
+def test_fetch_of_tensors_no_longer_published():
+    client = client_with_replies(fetch_reply({}, error="1 tensors are not published any more"))
+    assert client.load_parameters(None, {"0.weight": "hash"}) is None
+
+
+def test_blobs_not_referenced_by_start_are_dropped():
+    state_dict = {"0.weight": torch.randn(3, 3)}
+    hashes = src.Utils.state_dict_hashes(state_dict)
+    client = client_with_replies()
+    client.parameters["current"] = pickle.dumps({hashes["0.weight"]: state_dict["0.weight"]})
+    client.parameters["other layer"] = pickle.dumps({})
+    loaded = client.load_parameters("current", hashes)
+    assert torch.equal(loaded["0.weight"], state_dict["0.weight"])
+    assert client.parameters == {}
@@ -0,0 +1,69 @@
+import pickle
+import threading
+import time
+import uuid
+
+import torch
+import torch.nn as nn
+
+import src.Routing
+from src.Scheduler import Scheduler
+from src.Simulation import MemoryBroker
+
+
+def activation(sender):
+    return pickle.dumps({"data_id": uuid.uuid4(), "label_count": [2, 1, 1], "data": torch.randn(4, 8).numpy(),
+                         "label": torch.tensor([0, 1, 2, 0]), "trace": [sender], "test": False})
+
+
+def marker(sender, to, round_id):
+    return pickle.dumps({"end": round_id, "sender": sender, "to": to})
+
+
+def train_middle_stage(broker, results):
+    scheduler = Scheduler("b", 2, broker.connect().channel(), "cpu")
+    results["result"] = scheduler.train_on_device(nn.Sequential(nn.Linear(8, 8)), None, [2, 1, 1], 0.01, 0.0, 0,
+                                                  {"mode": "normal"}, 3, 1, cluster=0, routing=src.Routing.SHARED,
+                                                  next_clients=["c"], local_loss=True, round_id=[1, 0],
+                                                  previous_clients=["a"])
+
+
+def test_pause_waits_for_the_end_of_round_marker():
+    broker = MemoryBroker()
+    channel = broker.connect().channel()
+    for queue in ("reply_b", "intermediate_queue_1", "intermediate_queue_2_0"):
+        channel.queue_declare(queue)
+    # The PAUSE overtakes the activations still on their way
+    channel.basic_publish(exchange='', routing_key="reply_b", body=pickle.dumps({"action": "PAUSE", "round": [1, 0]}))
+    results = {}
+    thread = threading.Thread(target=train_middle_stage, args=(broker, results), daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+
+    # A marker of an earlier run, then the two micro-batches of this one and its marker
+    channel.basic_publish(exchange='', routing_key="intermediate_queue_1", body=marker("a", "b", [0, 0]))
+    for _ in range(2):
+        channel.basic_publish(exchange='', routing_key="intermediate_queue_1", body=activation("a"))
+    channel.basic_publish(exchange='', routing_key="intermediate_queue_1", body=marker("a", "b", [1, 0]))
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert results["result"] == (True, 2)
+
+    downstream = []
+    while (body := channel.basic_get("intermediate_queue_2_0", auto_ack=True)[2]) is not None:
+        downstream.append(pickle.loads(body))
+    assert [message.get("end") for message in downstream] == [[0, 0], None, None, [1, 0]]
+    assert downstream[-1]["to"] == "c"
+
+
+def test_marker_of_another_consumer_is_put_back():
+    broker = MemoryBroker()
+    channel = broker.connect().channel()
+    scheduler = Scheduler("b", 2, channel, "cpu")
+    scheduler.previous_clients = ["a"]
+    assert scheduler.receive_end_of_round(pickle.loads(marker("a", "other", [1, 0])), "intermediate_queue_1") is None
+    assert pickle.loads(channel.basic_get("intermediate_queue_1", auto_ack=True)[2])["to"] == "other"
+    assert scheduler.drain_round({"action": "PAUSE", "round": [1, 0]}) == (1, 0)
+    assert scheduler.receive_end_of_round(pickle.loads(marker("a", "b", [1, 0])), "intermediate_queue_1") == (1, 0)
+    assert scheduler.drain_round({"action": "PAUSE", "round": [1, 0]}) is None
@@ -0,0 +1,50 @@
+import os
+import copy
+
+import pytest
+import yaml
+
+from src.Server import Server
+from src.Simulation import MemoryBroker
+
+with open(os.path.join(os.path.dirname(__file__), "..", "config.yaml")) as file:
+    CONFIG = yaml.safe_load(file)
+
+
+def server_config(tmp_path, **changes):
+    config = copy.deepcopy(CONFIG)
+    config["log_path"] = str(tmp_path)
+    for path, value in changes.items():
+        section = config
+        keys = path.split("/")
+        for key in keys[:-1]:
+            section = section[key]
+        section[keys[-1]] = value
+    return config
+
+
+def test_lossy_links_need_a_micro_batch_timeout(tmp_path):
+    links = [dict(CONFIG["network"]["links"][0], loss=0.01)]
+    config = server_config(tmp_path, **{"network/enable": True, "network/links": links})
+    with pytest.raises(ValueError, match="micro-batch-timeout"):
+        Server(config, connection_factory=MemoryBroker().connect)
+    config["learning"]["micro-batch-timeout"] = 5
+    Server(config, connection_factory=MemoryBroker().connect)
+
+
+def test_heartbeat_timeout_needs_shorter_heartbeats(tmp_path):
+    config = server_config(tmp_path, **{"server/membership/heartbeat-timeout": 10})
+    with pytest.raises(ValueError, match="heartbeat-interval"):
+        Server(config, connection_factory=MemoryBroker().connect)
+    config["server"]["membership"]["heartbeat-interval"] = 2
+    Server(config, connection_factory=MemoryBroker().connect)
+
+
+def test_upstream_frozen_follows_the_freeze_schedule(tmp_path):
+    prefix = {"policy": "prefix", "layers": 7}
+    config = server_config(tmp_path, **{"learning/freeze": [{"round": 1, "stages": [prefix, {"policy": "none"}]}]})
+    server = Server(config, connection_factory=MemoryBroker().connect)
+    assert server.upstream_frozen(0, 1)
+    assert server.upstream_frozen(0, 2)
+    server.freeze_schedule[0]["stages"][0] = dict(prefix, layers=6)
+    assert not server.upstream_frozen(0, 2)
@@ -0,0 +1,62 @@
+import torch
+import torch.nn as nn
+
+import src.Stash
+
+
+def linear_stage():
+    torch.manual_seed(0)
+    return nn.Linear(4, 2)
+
+
+def test_versions_are_released_with_their_last_micro_batch():
+    module = linear_stage()
+    stash = src.Stash.WeightStash(module)
+    stash.forward("a")
+    stash.forward("b")
+    stash.step()
+    stash.forward("c")
+    assert sorted(stash.weights) == [0, 1]
+
+    data_input, gradient = torch.randn(3, 4), torch.ones(3, 2)
+    stash.backward("a", data_input, gradient)
+    assert sorted(stash.weights) == [0, 1]
+    stash.backward("b", data_input, gradient)
+    assert sorted(stash.weights) == [1]
+    stash.backward("c", data_input, gradient)
+    # Still the current version, later forwards share it
+    assert sorted(stash.weights) == [1]
+    stash.step()
+    assert stash.weights == {} and stash.refs == {}
+    assert stash.stats() == {"versions": 0, "in_flight": 0, "stale": 0}
+
+
+def test_backward_uses_the_stashed_weights():
+    module = linear_stage()
+    stash = src.Stash.WeightStash(module)
+    old_weight = module.weight.detach().clone()
+    stash.forward("a")
+    with torch.no_grad():
+        module.weight.add_(1.0)
+    stash.step()
+
+    data_input, gradient = torch.randn(3, 4, requires_grad=True), torch.randn(3, 2)
+    applied, input_grad = stash.backward("a", data_input, gradient, input_grad=True)
+    assert applied
+    assert torch.allclose(module.weight.grad, gradient.t() @ data_input.detach())
+    assert torch.allclose(input_grad, gradient @ old_weight)
+
+
+def test_stale_micro_batch_only_gets_its_input_gradient():
+    module = linear_stage()
+    stash = src.Stash.WeightStash(module, max_staleness=1)
+    stash.forward("a")
+    stash.forward("b")
+    stash.step()
+    stash.step()
+    data_input, gradient = torch.randn(3, 4, requires_grad=True), torch.randn(3, 2)
+    applied, input_grad = stash.backward("a", data_input, gradient, input_grad=True)
+    assert not applied and module.weight.grad is None
+    assert torch.allclose(input_grad, gradient @ module.weight.detach())
+    assert stash.backward("b", data_input, gradient) == (False, None)
+    assert stash.stats() == {"versions": 0, "in_flight": 0, "stale": 2}
@@ -0,0 +1,90 @@
+import torch
+
+import src.Stream
+
+
+def update_message(chunks):
+    return {"action": "UPDATE", "chunks": chunks, "parameters": None, "optimizer_state": None, "result": True}
+
+
+def test_chunk_assemble_round_trip():
+    parameters = {"0.weight": torch.randn(64, 32), "0.bias": torch.randn(64), "1.num_batches_tracked": torch.tensor(3)}
+    optimizer_state = {"0.weight": torch.randn(64, 32)}
+    chunks = list(src.Stream.chunk_update(parameters, optimizer_state, 1024))
+    assert len(chunks) > len(parameters) + len(optimizer_state)
+
+    assembler = src.Stream.ChunkAssembler()
+    for chunk in chunks:
+        assembler.add(chunk)
+    message = update_message(len(chunks))
+    assert src.Stream.assemble_update(message, assembler) is None
+    assert message["result"] is True and message["chunks"] is None
+    for key, value in parameters.items():
+        assert torch.equal(message["parameters"][key], value)
+    assert torch.equal(message["optimizer_state"]["0.weight"], optimizer_state["0.weight"])
+
+
+def test_missing_block_fails_the_round_result():
+    chunks = list(src.Stream.chunk_update({"w": torch.randn(256)}, None, 128))
+    assembler = src.Stream.ChunkAssembler()
+    for chunk in chunks[:1] + chunks[2:]:
+        assembler.add(chunk)
+    message = update_message(len(chunks))
+    assert src.Stream.assemble_update(message, assembler) is not None
+    assert message["result"] is False
+
+
+def test_corrupt_block_is_rejected():
+    chunks = list(src.Stream.chunk_update({"w": torch.randn(256)}, None, 128))
+    chunks[0] = dict(chunks[0], data=b"x" + chunks[0]["data"][1:])
+    assembler = src.Stream.ChunkAssembler()
+    for chunk in chunks:
+        assembler.add(chunk)
+    assert "CRC" in assembler.check(len(chunks))
+
+
+def test_digest_of_a_download():
+    tensors = {"hash-a": torch.randn(100), "hash-b": torch.randn(3, 3)}
+    assembler = src.Stream.ChunkAssembler()
+    for chunk in src.Stream.chunk_tensors(tensors, 64):
+        assembler.add(chunk)
+    digest = assembler.digest()
+    assert assembler.check(assembler.sequence, digest) is None
+    assert src.Stream.ChunkAssembler().check(0, digest) == "digest mismatch"
+
+
+def test_closing_update_before_its_blocks_is_held_back():
+    parameters = {"w": torch.randn(512)}
+    chunks = list(src.Stream.chunk_update(parameters, None, 256))
+    uploads = src.Stream.Uploads()
+    message = update_message(len(chunks))
+    assert not uploads.ready("client", message)
+
+    released = [uploads.add_chunk("client", chunk) for chunk in chunks]
+    assert released[:-1] == [None] * (len(chunks) - 1)
+    assert released[-1] is message
+    assert uploads.ready("client", message)
+    assert uploads.assemble("client", message) is None
+    assert torch.equal(message["parameters"]["w"], parameters["w"])
+
+
+def test_new_transfer_replaces_a_broken_one():
+    uploads = src.Stream.Uploads()
+    first = list(src.Stream.chunk_update({"w": torch.zeros(512)}, None, 256))
+    uploads.add_chunk("client", first[0])
+    second = list(src.Stream.chunk_update({"w": torch.ones(512)}, None, 256))
+    for chunk in second:
+        uploads.add_chunk("client", chunk)
+    message = update_message(len(second))
+    assert uploads.ready("client", message)
+    assert uploads.assemble("client", message) is None
+    assert torch.equal(message["parameters"]["w"], torch.ones(512))
+
+
+def test_empty_update_of_a_frozen_stage():
+    assert list(src.Stream.chunk_update({}, None, 256)) == []
+    uploads = src.Stream.Uploads()
+    message = update_message(0)
+    assert uploads.ready("client", message)
+    assert uploads.assemble("client", message) is None
+    assert message["result"] is True and message["parameters"] == {}
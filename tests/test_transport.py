@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+import src.Transport
+
+
+class QueueTransport(src.Transport.Transport):
+    def __init__(self):
+        self.queues = {}
+
+    def publish(self, queue, body):
+        self.queues.setdefault(queue, []).append(body)
+
+    def get(self, queue):
+        messages = self.queues.get(queue)
+        return messages.pop(0) if messages else None
+
+    def close(self):
+        self.queues = {}
+
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        src.Transport.Transport()
+
+
+def test_batching_packs_and_unpacks_frames():
+    inner = QueueTransport()
+    transport = src.Transport.BatchingTransport(inner, max_messages=3)
+    for body in (b"a", b"b", b"c", b"d"):
+        transport.publish("queue", body)
+    assert len(inner.queues["queue"]) == 1
+    transport.close()
+    assert [transport.get("queue") for _ in range(5)] == [b"a", b"b", b"c", b"d", None]
+
+
+def test_tcp_peers_exchange_messages():
+    first, second = src.Transport.TcpTransport(QueueTransport()), src.Transport.TcpTransport()
+    try:
+        first.set_peers({"second": {"address": second.address}})
+        first.publish("gradient_queue_1_second", b"to the peer")
+        first.publish("intermediate_queue_1", b"to the fallback")
+        deadline = time.time() + 5
+        body = None
+        while body is None and time.time() < deadline:
+            body = second.get("gradient_queue_1_second")
+        assert body == b"to the peer"
+        assert first.get("intermediate_queue_1") == b"to the fallback"
+    finally:
+        first.close()
+        second.close()